@@ -0,0 +1,16 @@
+@echo off
+echo ========================================
+echo Audio Quality Test
+echo ========================================
+echo.
+
+cd /d "%~dp0.."
+
+echo Checking the clean-recording estimate and Demucs gate...
+python tests/test_audio_quality.py
+
+echo.
+echo ========================================
+echo Test completed!
+echo ========================================
+pause
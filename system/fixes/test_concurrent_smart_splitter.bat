@@ -0,0 +1,16 @@
+@echo off
+echo ========================================
+echo Concurrent Smart Splitter Test
+echo ========================================
+echo.
+
+cd /d "%~dp0.."
+
+echo Splitting several files in parallel and reusing existing parts...
+python tests/test_concurrent_smart_splitter.py
+
+echo.
+echo ========================================
+echo Test completed!
+echo ========================================
+pause
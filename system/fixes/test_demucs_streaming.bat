@@ -0,0 +1,16 @@
+@echo off
+echo ========================================
+echo Demucs Streaming Test
+echo ========================================
+echo.
+
+cd /d "%~dp0.."
+
+echo Checking streaming Demucs windows and crossfades...
+python tests/test_demucs_streaming.py
+
+echo.
+echo ========================================
+echo Test completed!
+echo ========================================
+pause
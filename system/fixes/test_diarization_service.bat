@@ -0,0 +1,16 @@
+@echo off
+echo ========================================
+echo Diarization Service Test
+echo ========================================
+echo.
+
+cd /d "%~dp0.."
+
+echo Checking batched model calls of the shared diarization service...
+python tests/test_diarization_service.py
+
+echo.
+echo ========================================
+echo Test completed!
+echo ========================================
+pause
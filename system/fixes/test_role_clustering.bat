@@ -0,0 +1,16 @@
+@echo off
+echo ========================================
+echo Role Clustering Test
+echo ========================================
+echo.
+
+cd /d "%~dp0.."
+
+echo Checking turn embeddings and role clustering...
+python tests/test_role_clustering.py
+
+echo.
+echo ========================================
+echo Test completed!
+echo ========================================
+pause
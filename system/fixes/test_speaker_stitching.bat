@@ -0,0 +1,16 @@
+@echo off
+echo ========================================
+echo Speaker Stitching Test
+echo ========================================
+echo.
+
+cd /d "%~dp0.."
+
+echo Checking overlapping chunks and speaker stitching...
+python tests/test_speaker_stitching.py
+
+echo.
+echo ========================================
+echo Test completed!
+echo ========================================
+pause
@@ -3,7 +3,10 @@ Audio Processing Package
 Модульная система для обработки аудио файлов
 """
 
-from .managers import GPUMemoryManager, ModelManager
+from .managers import (
+    GPUMemoryManager, ModelManager, ThreadBudget, get_thread_budget,
+    enable_demucs_cpu_fast, DEMUCS_CPU_FAST_MODES
+)
 from .processors import (
     process_audio_file_optimized,
     process_multiple_files_parallel_optimized,
@@ -14,7 +17,13 @@ from .stages import (
     diarize_with_pyannote_optimized,
     diarize_with_role_classification,
     create_speaker_segments_with_metadata,
-    organize_speakers_to_output
+    organize_speakers_to_output,
+    DEMUCS_SOURCES,
+    DENOISE_MODE_GAINS,
+    mix_demucs_sources,
+    SPECTRAL_GATE_MODE,
+    clean_audio_with_spectral_gate,
+    benchmark_demucs_precision
 )
 from .splitters import (
     split_audio_by_duration_optimized,
@@ -22,11 +31,25 @@ from .splitters import (
     split_audio_smart_multithreaded_optimized
 )
 from .utils import (
+    AudioInfo,
+    probe_audio,
+    probe_audio_files,
+    get_audio_duration,
+    format_duration,
+    enable_probe_disk_cache,
+    set_intermediate_format,
+    BackgroundAudioWriter,
+    waveform_input,
+    ensure_audio_file,
     get_mp3_duration,
     setup_logging,
     copy_results_to_output_optimized,
     parallel_audio_processing_optimized
 )
+from .planner import plan_chunks, record_stage_time, get_stage_rtf
+from .cache import AudioCache, enable_denoise_cache, get_denoise_cache
+from .roles import TurnEmbeddingExtractor, RoleClusterer
+from .quality import estimate_audio_quality, enable_quality_gate, assess_denoise_need, get_quality_summary
 from .config import (
     get_optimal_workers, setup_gpu_optimization,
     MAX_WORKERS,
@@ -35,12 +58,22 @@ from .config import (
 )
 
 __all__ = [
-    'GPUMemoryManager', 'ModelManager',
+    'GPUMemoryManager', 'ModelManager', 'ThreadBudget', 'get_thread_budget',
+    'enable_demucs_cpu_fast', 'DEMUCS_CPU_FAST_MODES', 'benchmark_demucs_precision',
     'process_audio_file_optimized', 'parallel_audio_processing_optimized',
     'process_multiple_files_parallel_optimized', 'process_file_multithreaded_optimized',
     'clean_audio_with_demucs_optimized', 'diarize_with_pyannote_optimized',
+    'DEMUCS_SOURCES', 'DENOISE_MODE_GAINS', 'mix_demucs_sources',
+    'SPECTRAL_GATE_MODE', 'clean_audio_with_spectral_gate',
     'split_audio_by_duration_optimized', 'split_audio_at_word_boundary_optimized',
     'split_audio_smart_multithreaded_optimized',
+    'AudioInfo', 'probe_audio', 'probe_audio_files', 'get_audio_duration', 'format_duration', 'enable_probe_disk_cache',
+    'set_intermediate_format', 'BackgroundAudioWriter',
+    'waveform_input', 'ensure_audio_file',
+    'plan_chunks', 'record_stage_time', 'get_stage_rtf',
+    'AudioCache', 'enable_denoise_cache', 'get_denoise_cache',
+    'TurnEmbeddingExtractor', 'RoleClusterer',
+    'estimate_audio_quality', 'enable_quality_gate', 'assess_denoise_need', 'get_quality_summary',
     'get_mp3_duration', 'setup_logging', 'copy_results_to_output_optimized',
     'get_optimal_workers', 'setup_gpu_optimization', 'MAX_WORKERS', 'GPU_MEMORY_LIMIT', 'BATCH_SIZE'
 ]
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""
+Постоянный кэш результатов обработки по содержимому аудио
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+
+# Хэши содержимого по (путь, размер, время изменения) - файл не перечитывается повторно
+_CONTENT_HASHES = {}
+_CONTENT_HASHES_LOCK = threading.Lock()
+
+def file_content_hash(file_path, block_size=1024 * 1024):
+    """
+    SHA-256 содержимого файла (с запоминанием для неизмененных файлов)
+    """
+    stat = os.stat(file_path)
+    memo_key = (str(Path(file_path).resolve()), stat.st_size, stat.st_mtime_ns)
+    with _CONTENT_HASHES_LOCK:
+        if memo_key in _CONTENT_HASHES:
+            return _CONTENT_HASHES[memo_key]
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+
+    with _CONTENT_HASHES_LOCK:
+        _CONTENT_HASHES[memo_key] = content_hash
+    return content_hash
+
+class AudioCache:
+    """Дисковый кэш по содержимому с вытеснением давно не использованных записей по размеру
+
+    Размеры и порядок использования записей хранятся в памяти: папка сканируется один раз
+    при создании, и put() не обходит весь кэш. Запись - все файлы одного ключа
+    (например, стемы .i16 и их .json), они вытесняются только вместе.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=20.0):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_bytes = int(max_size_gb * 1024**3)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # ключ -> {суффикс: размер}, от давно использованных к свежим
+        self._total = 0
+        self._scan()
+
+    def _scan(self):
+        """Строит индекс записей по содержимому папки (порядок - по времени доступа)"""
+        access = {}
+        for entry in self.cache_dir.glob("*/*"):
+            if entry.suffix == ".tmp":
+                continue
+            stat = entry.stat()
+            key, suffix = entry.name[:64], entry.name[64:]
+            self._entries.setdefault(key, {})[suffix] = stat.st_size
+            access[key] = max(access.get(key, 0.0), stat.st_mtime)
+            self._total += stat.st_size
+        for key in sorted(access, key=access.get):
+            self._entries.move_to_end(key)
+
+    def make_key(self, input_audio, **params):
+        """Ключ записи: хэш содержимого входа + модель, режим и параметры обработки"""
+        description = json.dumps(
+            {'content': file_content_hash(input_audio), **params}, sort_keys=True, default=str
+        )
+        return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key, suffix):
+        return self.cache_dir / key[:2] / f"{key}{suffix}"
+
+    def get(self, key, suffix=".wav"):
+        """Путь к записи или None; попадание обновляет время доступа (для LRU)"""
+        path = self._entry_path(key, suffix)
+        with self._lock:
+            if not path.exists():
+                return None
+            os.utime(path)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return path
+
+    def fetch(self, key, target_file, suffix=".wav"):
+        """Копирует запись в target_file (жесткой ссылкой, если возможно). True при попадании"""
+        path = self.get(key, suffix)
+        if path is None:
+            return False
+        target_file = Path(target_file)
+        target_file.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            if target_file.exists():
+                target_file.unlink()
+            os.link(path, target_file)
+        except OSError:
+            shutil.copyfile(path, target_file)
+        return True
+
+    def temp_path(self, key, suffix=".wav"):
+        """Временный путь рядом с записью: туда можно писать напрямую и затем put(..., move=True)"""
+        path = self._entry_path(key, suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+
+    def put(self, key, source_file, suffix=".wav", move=False):
+        """Кладет source_file в кэш (атомарно) и вытесняет старые записи сверх лимита
+        move=True - файл переносится без копирования (например, из temp_path)"""
+        path = self._entry_path(key, suffix)
+        if move:
+            os.replace(source_file, path)
+        else:
+            temp_file = self.temp_path(key, suffix)
+            shutil.copyfile(source_file, temp_file)
+            os.replace(temp_file, path)
+
+        size = path.stat().st_size
+        with self._lock:
+            files = self._entries.setdefault(key, {})
+            self._total += size - files.get(suffix, 0)
+            files[suffix] = size
+            self._entries.move_to_end(key)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Удаляет записи (все файлы ключа) с самым старым доступом, пока кэш больше лимита.
+        Последняя использованная запись не удаляется, даже если одна превышает лимит"""
+        with self._lock:
+            while self._total > self.max_size_bytes and len(self._entries) > 1:
+                key, files = self._entries.popitem(last=False)
+                for suffix, size in files.items():
+                    try:
+                        self._entry_path(key, suffix).unlink()
+                    except FileNotFoundError:
+                        pass
+                    except OSError:
+                        continue
+                    self._total -= size
+            return self._total
+
+# Глобальный кэш шумоподавления (включается из audio_processing.main)
+_DENOISE_CACHE = None
+
+def enable_denoise_cache(cache_dir, max_size_gb=20.0):
+    """
+    Включает постоянный кэш результатов Demucs.
+    :param cache_dir: Папка кэша или None для отключения.
+    :param max_size_gb: Лимит размера; сверх него удаляются давно не использованные записи.
+    """
+    global _DENOISE_CACHE
+    _DENOISE_CACHE = AudioCache(cache_dir, max_size_gb) if cache_dir and max_size_gb > 0 else None
+    return _DENOISE_CACHE
+
+def get_denoise_cache():
+    """Текущий кэш шумоподавления или None"""
+    return _DENOISE_CACHE
@@ -9,7 +9,17 @@ import torch
 # Глобальные настройки для оптимизации производительности
 MAX_WORKERS = min(mp.cpu_count(), 6)  # Ограничено для стабильности
 GPU_MEMORY_LIMIT = 0.95  # 95% GPU памяти для лучшей стабильности
-BATCH_SIZE = 4  # Уменьшенный размер батча
+BATCH_SIZE = 4  # Окон Demucs в одном батче (DemucsBatcher)
+DEMUCS_BATCHING = True  # Параллельные чанки делят батчи Demucs (многопоточный режим)
+DIARIZATION_CONCURRENCY = 4  # Чанков одновременно в сервисе диаризации: их сегментация и эмбеддинги идут общими батчами
+EMBEDDING_BATCH_SIZE = 32  # Реплик в одном батче модели эмбеддингов (классификация ролей)
+EMBEDDING_MAX_TURN_SEC = 10.0  # Длинные реплики для эмбеддинга обрезаются до центрального окна
+WHISPER_BATCH_SIZE = 16  # Окон анализа границ (по 30 сек) за один проход Whisper
+DEMUCS_MEMORY_BUDGET_GB = 2.0  # Бюджет памяти на один вызов Demucs: задает длину окна потоковой обработки
+DEMUCS_STREAM_OVERLAP_SEC = 1.0  # Перекрытие (кроссфейд) соседних окон потокового Demucs
+PIPELINE_SAMPLE_RATE = 16000  # Фиксированная частота (моно) всех этапов: нарезка, вход и выход Demucs, диаризация, файлы спикеров
+INTERMEDIATE_FORMAT = 'wav'  # Формат промежуточных файлов: wav (16 бит), flac или float (см. utils.INTERMEDIATE_FORMATS)
+DEMUCS_SKIP_SCORE = 0.0  # Чанки с оценкой шумности ниже порога идут мимо Demucs (0 - проверка выключена, рекомендуется 0.2)
 
 def get_optimal_workers():
     """
@@ -2,12 +2,25 @@
 Менеджеры для управления GPU памятью и моделями
 """
 
+import os
+import copy
 import threading
+import queue
+import time
 import gc
+import logging
+import contextlib
+import functools
+import psutil
+from concurrent.futures import Future
 import torch
+from tqdm import tqdm
 import whisper
+from demucs.apply import apply_model
 from demucs.pretrained import get_model
 
+from .config import BATCH_SIZE, DEMUCS_BATCHING, DIARIZATION_CONCURRENCY
+
 # Глобальный блокировщик доступа к GPU
 GPU_LOCK = threading.Lock()
 
@@ -68,6 +81,403 @@ class GPUMemoryManager:
             return current, total
         return 0, 0
 
+class DemucsBatcher:
+    """Батчевый Demucs: окна одинаковой длины от разных чанков идут одним вызовом apply_model"""
+    
+    def __init__(self, model, device, batch_size=BATCH_SIZE, max_wait=0.05):
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.stats = {'calls': 0, 'windows': 0}
+        self._worker = threading.Thread(target=self._run, name="demucs-batcher", daemon=True)
+        self._worker.start()
+    
+    def separate(self, wav):
+        """Источники для окна wav (channels, samples): тензор (1, sources, channels, samples)"""
+        future = Future()
+        self.requests.put((wav, future))
+        return future.result()
+    
+    def stop(self):
+        """Обработать оставшиеся окна и остановить поток"""
+        self.requests.put(None)
+        self._worker.join()
+    
+    def _run(self):
+        pending = {}  # длина окна -> список (wav, future)
+        stopping = False
+        
+        while not stopping or pending:
+            if not pending:
+                item = self.requests.get()
+                if item is None:
+                    break
+                pending.setdefault(item[0].shape[-1], []).append(item)
+            
+            # Ждем попутчиков, пока батч не заполнится или не выйдет время
+            deadline = time.monotonic() + self.max_wait
+            while not stopping and max(len(group) for group in pending.values()) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                pending.setdefault(item[0].shape[-1], []).append(item)
+            
+            # Самая полная группа одинаковой длины идет первой
+            length = max(pending, key=lambda key: len(pending[key]))
+            batch, pending[length] = pending[length][:self.batch_size], pending[length][self.batch_size:]
+            if not pending[length]:
+                del pending[length]
+            self._process(batch)
+    
+    def _process(self, batch):
+        try:
+            mix = torch.stack([wav for wav, _ in batch]).to(self.device, dtype=torch.float32)
+            with torch.no_grad(), demucs_autocast(self.model, self.device):
+                sources = apply_model(self.model, mix, device=self.device)
+            sources = sources.float()
+            self.stats['calls'] += 1
+            self.stats['windows'] += len(batch)
+            for i, (_, future) in enumerate(batch):
+                future.set_result(sources[i:i + 1])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+
+class DiarizationService:
+    """
+    Сервис диаризации вместо глобальной блокировки: чанки из входной очереди обрабатываются
+    одновременно, у каждого воркера своя копия пайплайна, а вызовы моделей сегментации и эмбеддингов
+    от разных чанков сливаются в общие батчи в одном потоке. Прогресс всех чанков - один общий индикатор.
+    """
+    
+    def __init__(self, pipeline, concurrency=DIARIZATION_CONCURRENCY, max_wait=0.05):
+        self.pipeline = pipeline
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.calls = queue.Queue()
+        self.stats = {'chunks': 0, 'segmentation_calls': 0, 'embedding_calls': 0, 'merged_calls': 0}
+        self._progress = {}  # Future чанка -> {шаг: (выполнено, всего)}
+        self._progress_lock = threading.Lock()
+        self._bar = None
+        
+        # Модели вызываются только из потока батчера. Воркеры работают с копиями пайплайна,
+        # подмена приватных _segmentation.infer и _embedding pyannote.audio 3.x - см. _worker_pipeline
+        self._batcher = threading.Thread(target=self._run_batcher, name="diarization-batcher", daemon=True)
+        self._batcher.start()
+        self._workers = [
+            threading.Thread(target=self._run_worker, args=(self._worker_pipeline(),),
+                             name=f"diarization-{i}", daemon=True)
+            for i in range(max(1, concurrency))
+        ]
+        for worker in self._workers:
+            worker.start()
+    
+    def submit(self, audio, **options):
+        """
+        Ставит чанк в очередь; Future с результатом пайплайна (аннотация pyannote)
+        options передаются пайплайну, например return_embeddings=True - (аннотация, центроиды спикеров)
+        """
+        future = Future()
+        with self._progress_lock:
+            if self._bar is None:
+                self._bar = tqdm(total=0, desc="Diarization", unit="chunk")
+            self._bar.total += 1
+            self._bar.refresh()
+            self._progress[future] = {}
+        self.requests.put((audio, options, future))
+        return future
+    
+    def diarize(self, audio, **options):
+        """Аннотация для аудио (путь или dict waveform); ждет своей очереди"""
+        return self.submit(audio, **options).result()
+    
+    def _worker_pipeline(self):
+        """
+        Копия пайплайна для одного воркера: общий пайплайн не вызывается из нескольких потоков
+        и не изменяется, модели не копируются - их вызовы уходят в батчер
+        
+        Опирается на приватные атрибуты pyannote.audio 3.x (SpeakerDiarization, проверено на 3.1):
+        _segmentation - Inference, чей метод infer(chunks) вызывается для батча окон,
+        _embedding - модель эмбеддингов, вызываемая как (waveforms, masks=...) и дающая
+        sample_rate, dimension, min_num_samples. Пайплайн при вызове не хранит состояния
+        в себе, поэтому поверхностной копии достаточно. При обновлении pyannote проверить.
+        """
+        pipeline = copy.copy(self.pipeline)
+        segmentation = copy.copy(self.pipeline._segmentation)
+        infer = self.pipeline._segmentation.infer
+        segmentation.infer = lambda chunks: self._call('segmentation', infer, chunks)
+        pipeline._segmentation = segmentation
+        pipeline._embedding = _BatchedEmbedding(self.pipeline._embedding, self)
+        return pipeline
+    
+    def stop(self):
+        """Дождаться чанков в очереди и остановить потоки"""
+        for _ in self._workers:
+            self.requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.calls.put(None)
+        self._batcher.join()
+        with self._progress_lock:
+            if self._bar is not None:
+                self._bar.close()
+                self._bar = None
+    
+    def _run_worker(self, pipeline):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            audio, options, future = item
+            try:
+                future.set_result(pipeline(audio, hook=functools.partial(self._hook, future), **options))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._progress_lock:
+                    self._progress.pop(future, None)
+                    self.stats['chunks'] += 1
+                    self._bar.update(1)
+                    self._bar.set_postfix_str(self._postfix(), refresh=False)
+    
+    def _hook(self, future, step_name, step_artefact, file=None, total=None, completed=None):
+        """Хук pyannote: прогресс шагов чанка сводится в общий индикатор"""
+        if total is None or completed is None:
+            return
+        with self._progress_lock:
+            if future in self._progress:
+                self._progress[future][step_name] = (completed, total)
+                self._bar.set_postfix_str(self._postfix())
+    
+    def _postfix(self):
+        """Средний прогресс шагов по чанкам в работе: 'segmentation 40%, embeddings 10%'"""
+        steps = {}
+        for chunk_steps in self._progress.values():
+            for step_name, (completed, total) in chunk_steps.items():
+                done, all_ = steps.get(step_name, (0, 0))
+                steps[step_name] = (done + completed, all_ + total)
+        return ", ".join(f"{name} {100 * done / max(all_, 1):.0f}%" for name, (done, all_) in steps.items())
+    
+    def _call(self, kind, function, batch, masks=None):
+        """Вызов модели из потока пайплайна: уходит в общий батч, возвращает свою часть результата"""
+        future = Future()
+        self.calls.put((kind, function, batch, masks, future))
+        return future.result()
+    
+    def _run_batcher(self):
+        while True:
+            item = self.calls.get()
+            if item is None:
+                break
+            pending = [item]
+            
+            # Попутные вызовы той же модели с тем же размером окна
+            deadline = time.monotonic() + self.max_wait
+            stopping = False
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.calls.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                pending.append(item)
+            
+            groups = {}
+            for call in pending:
+                kind, _, batch, masks, _ = call
+                shape = (kind, tuple(batch.shape[1:]), None if masks is None else tuple(masks.shape[1:]))
+                groups.setdefault(shape, []).append(call)
+            for group in groups.values():
+                self._process(group)
+            if stopping:
+                break
+    
+    def _process(self, group):
+        kind, function = group[0][0], group[0][1]
+        try:
+            batch = torch.cat([torch.as_tensor(call[2]) for call in group])
+            if group[0][3] is None:
+                outputs = function(batch)
+            else:
+                outputs = function(batch, masks=torch.cat([torch.as_tensor(call[3]) for call in group]))
+            self.stats[f'{kind}_calls'] += 1
+            self.stats['merged_calls'] += len(group) - 1
+            
+            offset = 0
+            for call in group:
+                size = len(call[2])
+                if isinstance(outputs, tuple):
+                    call[4].set_result(tuple(output[offset:offset + size] for output in outputs))
+                else:
+                    call[4].set_result(outputs[offset:offset + size])
+                offset += size
+        except Exception as e:
+            for call in group:
+                call[4].set_exception(e)
+
+class _BatchedEmbedding:
+    """Модель эмбеддингов пайплайна, вызовы которой идут через батчер DiarizationService"""
+    
+    def __init__(self, embedding, service):
+        self._embedding = embedding
+        self._service = service
+    
+    def __call__(self, waveforms, masks=None):
+        return self._service._call('embedding', self._embedding, waveforms, masks)
+    
+    def __getattr__(self, name):
+        return getattr(self._embedding, name)
+
+# Ускоренный CPU-вывод Demucs: 'int8' - динамическое квантование Linear, 'bf16' - autocast bfloat16
+DEMUCS_CPU_FAST_MODES = ('int8', 'bf16')
+_DEMUCS_CPU_FAST = None
+
+def enable_demucs_cpu_fast(mode):
+    """
+    Включает ускоренный CPU-вывод Demucs для всех менеджеров моделей.
+    :param mode: 'int8', 'bf16' или None (fp32).
+    """
+    global _DEMUCS_CPU_FAST
+    if mode is not None and mode not in DEMUCS_CPU_FAST_MODES:
+        raise ValueError(f"Unknown cpu_fast mode: {mode} (expected one of {', '.join(DEMUCS_CPU_FAST_MODES)})")
+    _DEMUCS_CPU_FAST = mode
+
+def demucs_precision(device):
+    """Точность вывода Demucs на устройстве: 'fp32' или режим cpu_fast (только для CPU)"""
+    if _DEMUCS_CPU_FAST and torch.device(device).type == "cpu":
+        return _DEMUCS_CPU_FAST
+    return "fp32"
+
+def demucs_autocast(model, device):
+    """Контекст вызова apply_model: autocast bfloat16 для модели в режиме bf16 на CPU"""
+    if getattr(model, 'precision', 'fp32') == 'bf16' and torch.device(device).type == "cpu":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+class ThreadBudget:
+    """Распределение ядер между воркерами пайплайна и потоками torch, учет загрузки CPU"""
+    
+    def __init__(self, cores=None, logger=None):
+        self.cores = cores or psutil.cpu_count(logical=False) or os.cpu_count() or 1
+        self.logical_cores = os.cpu_count() or self.cores
+        self.logger = logger or logging.getLogger(__name__)
+        self.plan = None
+        self.stage_seconds = {}
+        self._lock = threading.Lock()
+        self._interop_set = False
+        self.start()
+    
+    def start(self):
+        """Начать замер загрузки CPU (время процесса и дочерних ffmpeg)"""
+        self._wall_start = time.time()
+        self._cpu_start = self._cpu_seconds()
+        with self._lock:
+            self.stage_seconds.clear()
+    
+    @staticmethod
+    def _cpu_seconds():
+        times = psutil.Process().cpu_times()
+        return times.user + times.system + times.children_user + times.children_system
+    
+    def configure(self, workers, steps, batched=DEMUCS_BATCHING, processes=1):
+        """
+        Делит ядра между одновременными вызовами torch и выставляет число потоков torch
+        
+        Воркеры пайплайна большую часть времени ждут ffmpeg, батчер Demucs или
+        блокировку диаризации, поэтому ядра делятся не на воркеров, а на потоки,
+        которые одновременно считают в torch: батчер Demucs (или каждый воркер
+        без батчинга) и одна диаризация.
+        Число потоков torch общее для процесса: вызывать один раз на запуск, до старта
+        воркеров, с общим числом одновременных воркеров всех файлов.
+        processes - сколько процессов пула делят ядра машины (у каждого свой бюджет)
+        Возвращает dict: cores, workers, torch_streams, torch_threads, interop_threads
+        """
+        cores = max(1, self.cores // max(1, processes))
+        workers = max(1, min(workers, self.logical_cores))
+        streams = 0
+        if 'denoise' in steps:
+            streams += 1 if batched else workers
+        if 'diar' in steps:
+            streams += 1
+        streams = max(1, min(streams, cores))
+        
+        torch_threads = max(1, cores // streams)
+        interop_threads = 1 if workers > 1 else min(4, cores)
+        torch.set_num_threads(torch_threads)
+        
+        # Число interop потоков задается только до первой параллельной работы torch
+        if not self._interop_set:
+            try:
+                torch.set_num_interop_threads(interop_threads)
+            except RuntimeError:
+                interop_threads = torch.get_num_interop_threads()
+            self._interop_set = True
+        else:
+            interop_threads = torch.get_num_interop_threads()
+        
+        self.plan = {
+            'cores': cores,
+            'workers': workers,
+            'torch_streams': streams,
+            'torch_threads': torch_threads,
+            'interop_threads': interop_threads
+        }
+        self.logger.info(
+            f"Thread budget: {cores} cores, {workers} pipeline workers, "
+            f"{streams} concurrent torch streams x {torch_threads} threads, {interop_threads} interop"
+        )
+        return self.plan
+    
+    def record(self, stage, elapsed_seconds):
+        """Добавить время работы этапа (сумма по всем воркерам)"""
+        with self._lock:
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + elapsed_seconds
+    
+    def report(self):
+        """
+        Загрузка с момента start(): cpu_utilization - доля всех логических ядер,
+        worker_utilization - доля времени воркеров, занятая этапами
+        """
+        wall = max(1e-6, time.time() - self._wall_start)
+        cpu = self._cpu_seconds() - self._cpu_start
+        with self._lock:
+            stage_seconds = dict(self.stage_seconds)
+        workers = self.plan['workers'] if self.plan else 1
+        return {
+            **(self.plan or {'cores': self.cores}),
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'cpu_utilization': cpu / (wall * self.logical_cores),
+            'worker_utilization': sum(stage_seconds.values()) / (wall * workers),
+            'stage_seconds': stage_seconds
+        }
+
+# Общий бюджет потоков процесса
+_THREAD_BUDGET = None
+_THREAD_BUDGET_LOCK = threading.Lock()
+
+def get_thread_budget():
+    """Бюджет потоков процесса (создается при первом обращении)"""
+    global _THREAD_BUDGET
+    with _THREAD_BUDGET_LOCK:
+        if _THREAD_BUDGET is None:
+            _THREAD_BUDGET = ThreadBudget()
+        return _THREAD_BUDGET
+
 class ModelManager:
     """Централизованное управление моделями с кэшированием и GPU оптимизацией"""
     
@@ -75,6 +485,9 @@ class ModelManager:
         self.gpu_manager = gpu_manager
         self.models = {}
         self.device = gpu_manager.device
+        self.demucs_batcher = None
+        self._batcher_lock = threading.Lock()
+        self.diarization_service = None
         
     def get_whisper_model(self, model_size="base"):
         """Получить Whisper модель с кэшированием"""
@@ -88,18 +501,41 @@ class ModelManager:
         
         return self.models[model_key]
     
-    def get_demucs_model(self):
-        """Получить Demucs модель с кэшированием"""
-        model_key = "demucs_htdemucs"
+    def get_demucs_model(self, precision=None):
+        """
+        Получить Demucs модель с кэшированием
+        precision: 'fp32', 'int8' или 'bf16'; по умолчанию - режим cpu_fast для CPU (см. enable_demucs_cpu_fast)
+        """
+        if precision is None:
+            precision = demucs_precision(self.device)
+        model_key = "demucs_htdemucs" if precision == "fp32" else f"demucs_htdemucs_{precision}"
         
         if model_key not in self.models:
             self.gpu_manager.cleanup()
-            self.models[model_key] = get_model("htdemucs")
-            if self.device.type == "cuda":
-                self.models[model_key] = self.models[model_key].to(self.device)
+            if precision == "fp32":
+                model = get_model("htdemucs")
+                if self.device.type == "cuda":
+                    model = model.to(self.device)
+            elif precision == "int8":
+                # Квантованные веса Linear (трансформер htdemucs); работает только на CPU
+                model = torch.ao.quantization.quantize_dynamic(
+                    get_model("htdemucs").cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8
+                )
+            else:
+                # bf16: веса остаются fp32, вызовы идут под autocast (demucs_autocast)
+                model = get_model("htdemucs").cpu().eval()
+            model.precision = precision
+            self.models[model_key] = model
         
         return self.models[model_key]
     
+    def get_demucs_batcher(self):
+        """Получить общий для всех потоков сервис батчевого Demucs"""
+        with self._batcher_lock:
+            if self.demucs_batcher is None:
+                self.demucs_batcher = DemucsBatcher(self.get_demucs_model(), self.device)
+        return self.demucs_batcher
+    
     def get_diarization_pipeline(self, token):
         """Получить PyAnnote диаризационный пайплайн с кэшированием"""
         model_key = "pyannote_diarization"
@@ -116,8 +552,21 @@ class ModelManager:
         
         return self.models[model_key]
     
+    def get_diarization_service(self, token):
+        """Получить общий для всех потоков сервис диаризации (очередь чанков с батчевым выводом)"""
+        with self._batcher_lock:
+            if self.diarization_service is None:
+                self.diarization_service = DiarizationService(self.get_diarization_pipeline(token))
+        return self.diarization_service
+    
     def cleanup_models(self):
         """Очистить все модели"""
+        if self.demucs_batcher is not None:
+            self.demucs_batcher.stop()
+            self.demucs_batcher = None
+        if self.diarization_service is not None:
+            self.diarization_service.stop()
+            self.diarization_service = None
         for model in self.models.values():
             if hasattr(model, 'cpu'):
                 model.cpu()
@@ -0,0 +1,108 @@
+"""
+Планирование разбивки: длительность и количество чанков под ресурсы машины
+"""
+
+import math
+import threading
+import psutil
+import torch
+
+from .config import get_optimal_workers
+
+# Ограничения длительности чанка
+MIN_CHUNK_SEC = 60  # Короче - диаризации не хватает контекста
+MAX_CHUNK_SEC = 900  # Длиннее - слишком долго ждать последний чанк
+
+# Сколько секунд обработки на одном воркере допустимо для одного чанка
+TARGET_CHUNK_PROCESSING_SEC = 300
+
+# Пиковая память Demucs на секунду аудио: 44.1 кГц стерео float32,
+# вход + 4 источника + промежуточные тензоры модели
+DEMUCS_BYTES_PER_AUDIO_SEC = 3.5 * 1024**2
+
+# Доля доступной памяти, которую можно отдать под чанки
+MEMORY_BUDGET_FRACTION = 0.5
+
+# Оценки real-time factor (секунд обработки на секунду аудио) до первых измерений
+DEFAULT_STAGE_RTF = {
+    'cpu': {'denoise': 0.6, 'diar': 0.15},
+    'cuda': {'denoise': 0.05, 'diar': 0.03},
+}
+
+# Измеренные RTF по этапам (скользящее среднее), общие для всех файлов запуска
+_MEASURED_RTF = {}
+_RTF_LOCK = threading.Lock()
+
+def record_stage_time(stage, audio_seconds, elapsed_seconds, smoothing=0.3):
+    """
+    Запоминает измеренный real-time factor этапа для следующих планов
+    """
+    if audio_seconds <= 0:
+        return
+    rtf = elapsed_seconds / audio_seconds
+    with _RTF_LOCK:
+        previous = _MEASURED_RTF.get(stage)
+        _MEASURED_RTF[stage] = rtf if previous is None else previous + smoothing * (rtf - previous)
+
+def get_stage_rtf(stage, device_type=None):
+    """
+    Текущий RTF этапа: измеренный, иначе оценка по умолчанию для устройства
+    """
+    with _RTF_LOCK:
+        if stage in _MEASURED_RTF:
+            return _MEASURED_RTF[stage]
+    if device_type is None:
+        device_type = "cuda" if torch.cuda.is_available() else "cpu"
+    return DEFAULT_STAGE_RTF.get(device_type, DEFAULT_STAGE_RTF['cpu']).get(stage, 0.0)
+
+def plan_chunks(total_seconds, steps, workers=None, available_memory_gb=None, device_type=None):
+    """
+    Выбирает длительность и количество чанков для файла
+
+    Чанки делаются равными, а их количество - кратным числу воркеров, чтобы все
+    воркеры закончили одновременно. Верхняя граница длины чанка берется из
+    бюджета памяти (Demucs), измеренного RTF этапов и MAX_CHUNK_SEC.
+    Возвращает dict: chunk_duration, num_chunks, workers, max_chunk_sec
+    """
+    if workers is None:
+        workers = get_optimal_workers()
+    workers = max(1, workers)
+
+    if available_memory_gb is None:
+        available_memory_gb = psutil.virtual_memory().available / 1024**3
+
+    max_chunk = MAX_CHUNK_SEC
+
+    # Память: одновременно в работе до workers чанков
+    if 'denoise' in steps:
+        budget_bytes = available_memory_gb * 1024**3 * MEMORY_BUDGET_FRACTION / workers
+        max_chunk = min(max_chunk, budget_bytes / DEMUCS_BYTES_PER_AUDIO_SEC)
+
+    # Время: один чанк не должен занимать воркер дольше целевого времени
+    rtf_total = sum(get_stage_rtf(stage, device_type) for stage in ('denoise', 'diar') if stage in steps)
+    if rtf_total > 0:
+        max_chunk = min(max_chunk, TARGET_CHUNK_PROCESSING_SEC / rtf_total)
+
+    max_chunk = max(MIN_CHUNK_SEC, max_chunk)
+
+    if total_seconds <= MIN_CHUNK_SEC:
+        num_chunks = 1
+    elif total_seconds < MIN_CHUNK_SEC * workers:
+        # Короткий файл: столько чанков, сколько помещается без нарушения минимума
+        num_chunks = max(1, int(total_seconds // MIN_CHUNK_SEC))
+    else:
+        # Наименьшее кратное числу воркеров количество, при котором чанк не длиннее лимита
+        waves = max(1, math.ceil(total_seconds / (max_chunk * workers)))
+        num_chunks = waves * workers
+        # Не делаем чанки короче минимума из-за округления до кратного
+        while num_chunks > 1 and total_seconds / num_chunks < MIN_CHUNK_SEC:
+            num_chunks -= 1
+
+    chunk_duration = math.ceil(total_seconds / num_chunks)
+
+    return {
+        'chunk_duration': chunk_duration,
+        'num_chunks': num_chunks,
+        'workers': min(workers, num_chunks),
+        'max_chunk_sec': max_chunk
+    }
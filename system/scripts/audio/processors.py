@@ -6,20 +6,19 @@ import tempfile
 from pathlib import Path
 from tqdm import tqdm
 import multiprocessing
-import threading
 import time
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from functools import partial
 import shutil
 
-from .managers import GPUMemoryManager, ModelManager
-from .stages import clean_audio_with_demucs_optimized, diarize_with_pyannote_optimized
+from .managers import GPUMemoryManager, ModelManager, get_thread_budget
+from .stages import clean_audio_with_demucs_optimized, diarize_with_pyannote_optimized, diarize_chunk_turns
+from .stitching import stitch_chunk_turns, write_stitched_speakers
 from .splitters import split_audio_by_duration_optimized, split_audio_at_word_boundary_optimized, split_audio_smart_multithreaded_optimized
-from .utils import copy_results_to_output_optimized
-from .config import GPU_MEMORY_LIMIT
-
-# Глобальная блокировка для диаризации
-DIARIZATION_LOCK = threading.Lock()
+from .utils import copy_results_to_output_optimized, get_audio_duration, probe_audio_files, compact_audio, ensure_audio_file
+from .config import GPU_MEMORY_LIMIT, DEMUCS_BATCHING, get_optimal_workers
+from .planner import plan_chunks, record_stage_time
+from .quality import assess_denoise_need
 
 def process_audio_file_optimized(audio_file, output_dir, steps, chunk_duration, 
                                 min_segment_duration, split_method, use_gpu, logger, denoise_mode='enhanced'):
@@ -44,37 +43,15 @@ def process_audio_file_optimized(audio_file, output_dir, steps, chunk_duration,
             # 1. Разбивка по времени
             if 'split' in steps:
                 logger.info(f"Splitting file: {current.name}")
-                try:
-                    if split_method == 'smart_multithreaded':
-                        whisper_model = model_manager.get_whisper_model("base")
-                        parts = split_audio_smart_multithreaded_optimized(
-                            str(current), file_temp_dir / 'parts', 
-                            max_duration_sec=chunk_duration, 
-                            whisper_model=whisper_model, 
-                            max_workers=4,  # Оптимальное количество потоков
-                            logger=logger
-                        )
-                    elif split_method == 'word_boundary':
-                        whisper_model = model_manager.get_whisper_model("base")
-                        parts = split_audio_at_word_boundary_optimized(
-                            str(current), file_temp_dir / 'parts', 
-                            max_duration_sec=chunk_duration, 
-                            whisper_model=whisper_model, 
-                            logger=logger
-                        )
-                    else:
-                        parts = split_audio_by_duration_optimized(
-                            str(current), file_temp_dir / 'parts', 
-                            max_duration_sec=chunk_duration, 
-                            logger=logger
-                        )
-                except Exception as e:
-                    logger.error(f"Splitting error: {e}")
-                    parts = split_audio_by_duration_optimized(
-                        str(current), file_temp_dir / 'parts', 
-                        max_duration_sec=chunk_duration, 
-                        logger=logger
-                    )
+                if chunk_duration is None:
+                    # Части обрабатываются последовательно - один воркер
+                    plan = plan_chunks(get_audio_duration(str(current)), steps, workers=1)
+                    chunk_duration = plan['chunk_duration']
+                    logger.info(f"Chunk plan: {plan['num_chunks']} x {chunk_duration}s")
+                parts = split_audio_file(
+                    str(current), file_temp_dir / 'parts', split_method, chunk_duration,
+                    model_manager, logger
+                )
             else:
                 parts = [str(current)]
             
@@ -104,6 +81,75 @@ def process_audio_file_optimized(audio_file, output_dir, steps, chunk_duration,
         logger.error(f"Error processing file {audio_file.name}: {e}")
         return None
 
+def configure_worker_process(processes, steps):
+    """
+    Инициализатор процесса пула (parallel_audio_processing_optimized): части файла идут
+    последовательно, ядра машины делятся поровну между процессами
+    """
+    get_thread_budget().configure(1, steps, batched=False, processes=processes)
+
+def finish_stage(stage, audio_seconds, stage_start):
+    """
+    Учитывает время этапа в RTF планировщика и в загрузке бюджета потоков
+    """
+    elapsed = time.time() - stage_start
+    record_stage_time(stage, audio_seconds, elapsed)
+    get_thread_budget().record(stage, elapsed)
+
+def split_audio_file(input_audio, parts_dir, split_method, chunk_duration, model_manager, logger,
+                     overlap_sec=0.0):
+    """
+    Разбивка файла выбранным методом с откатом на разбивку по длительности
+    split_method: 'smart_multithreaded', 'smart_energy', 'word_boundary', иначе простая разбивка
+    overlap_sec: перекрытие соседних частей для сшивки спикеров
+    """
+    try:
+        if split_method == 'smart_multithreaded':
+            whisper_model = model_manager.get_whisper_model("base")
+            return split_audio_smart_multithreaded_optimized(
+                input_audio, parts_dir, 
+                max_duration_sec=chunk_duration, 
+                whisper_model=whisper_model, 
+                max_workers=4,  # Оптимальное количество потоков
+                logger=logger,
+                overlap_sec=overlap_sec
+            )
+        elif split_method == 'smart_energy':
+            return split_audio_smart_multithreaded_optimized(
+                input_audio, parts_dir, 
+                max_duration_sec=chunk_duration, 
+                max_workers=4,
+                logger=logger,
+                boundary_method='energy',
+                overlap_sec=overlap_sec
+            )
+        elif split_method == 'word_boundary':
+            whisper_model = model_manager.get_whisper_model("base")
+            return split_audio_at_word_boundary_optimized(
+                input_audio, parts_dir, 
+                max_duration_sec=chunk_duration, 
+                whisper_model=whisper_model, 
+                logger=logger,
+                overlap_sec=overlap_sec
+            )
+        else:
+            return split_audio_by_duration_optimized(
+                input_audio, parts_dir, 
+                max_duration_sec=chunk_duration, 
+                logger=logger,
+                overlap_sec=overlap_sec
+            )
+    except Exception as e:
+        logger.error(f"Splitting error: {e}")
+        # Откат на разбивку из памяти: не зависит от segment muxer, который мог и упасть
+        return split_audio_by_duration_optimized(
+            input_audio, parts_dir, 
+            max_duration_sec=chunk_duration, 
+            logger=logger,
+            backend="memory",
+            overlap_sec=overlap_sec
+        )
+
 def process_parts_optimized(parts, file_temp_dir, steps, use_gpu, logger, model_manager, gpu_manager, denoise_mode):
     """
     Оптимизированная обработка частей аудио с лучшим управлением ресурсами
@@ -149,13 +195,22 @@ def process_single_part_optimized(part, idx, file_temp_dir, steps, use_gpu, logg
             logger.error(f"File part not found: {current}")
             return [str(current)]
         
+        part_seconds = get_audio_duration(str(current))
+        
         # 2. Удаление шумов
-        if 'denoise' in steps:
+        if 'denoise' in steps and assess_denoise_need(str(current), f"part {idx+1}", logger)['skip']:
+            logger.info(f"Part {idx+1} is clean speech, skipping Demucs")
+            cleaned = str(current)
+        elif 'denoise' in steps:
             try:
                 logger.info(f"Denoising part {idx+1}")
+                stage_start = time.time()
+                # Для диаризации результат передается в памяти, файл не пишется
                 cleaned = clean_audio_with_demucs_optimized(
-                    str(current), file_temp_dir / 'cleaned', model_manager, gpu_manager, logger, mode=denoise_mode
+                    str(current), file_temp_dir / 'cleaned', model_manager, gpu_manager, logger, mode=denoise_mode,
+                    in_memory='diar' in steps, keep_file='diar' not in steps
                 )
+                finish_stage('denoise', part_seconds, stage_start)
             except Exception as e:
                 logger.error(f"Error denoising part {idx+1}: {e}")
                 cleaned = str(current)
@@ -166,13 +221,15 @@ def process_single_part_optimized(part, idx, file_temp_dir, steps, use_gpu, logg
         if 'diar' in steps:
             try:
                 logger.info(f"Diarization part {idx+1}")
+                stage_start = time.time()
                 diarized = diarize_with_pyannote_optimized(
                     cleaned, file_temp_dir / 'diarized', model_manager=model_manager, 
                     gpu_manager=gpu_manager, logger=logger
                 )
+                finish_stage('diar', part_seconds, stage_start)
             except Exception as e:
                 logger.error(f"Error diarization part {idx+1}: {e}")
-                diarized = cleaned
+                diarized = ensure_audio_file(cleaned, file_temp_dir / 'cleaned')
         else:
             diarized = cleaned
         
@@ -183,32 +240,61 @@ def process_single_part_optimized(part, idx, file_temp_dir, steps, use_gpu, logg
         return [str(part_path)]
 
 def process_chunk_with_metadata(chunk_path, chunk_info, steps, use_gpu, logger, 
-                               model_manager, gpu_manager, temp_dir, denoise_mode='enhanced'):
+                               model_manager, gpu_manager, temp_dir, denoise_mode='enhanced',
+                               stitch=False):
     """
     Обработка одного чанка с метаданными и многопоточностью
+    stitch=True: файлы спикеров не пишутся, возвращается dict {'audio', 'turns', 'embeddings'}
+    для последующей сшивки чанков (turns=None, если диаризация не удалась)
     """
     chunk_path = Path(chunk_path)
     logger.info(f"Processing chunk: {chunk_path.name} with info: {chunk_info}")
     
     try:
         current = chunk_path
+        chunk_seconds = chunk_info.get('duration') or get_audio_duration(str(current))
         
         # 1. Деноизинг (многопоточный)
         if 'denoise' in steps:
+            chunk_info['denoise_decision'] = assess_denoise_need(
+                str(current), f"chunk {chunk_info.get('chunk_number', 'unknown')}", logger
+            )
+        
+        if 'denoise' in steps and chunk_info['denoise_decision']['skip']:
+            logger.info(f"Chunk {chunk_info.get('chunk_number', 'unknown')} is clean speech, skipping Demucs")
+            cleaned = str(current)
+        elif 'denoise' in steps:
             logger.info(f"Denoising chunk {chunk_info.get('chunk_number', 'unknown')}")
+            stage_start = time.time()
+            # С диаризацией результат идет в нее из памяти, файл не пишется
             cleaned = clean_audio_with_demucs_optimized(
-                str(current), temp_dir / 'cleaned', model_manager, gpu_manager, logger, mode=denoise_mode
+                str(current), temp_dir / 'cleaned', model_manager, gpu_manager, logger, mode=denoise_mode,
+                batched=DEMUCS_BATCHING, in_memory='diar' in steps, keep_file='diar' not in steps
             )
+            finish_stage('denoise', chunk_seconds, stage_start)
         else:
             cleaned = str(current)
         
         # 2. Диаризация (пропускаем VAD)
-        if 'diar' in steps:
+        if 'diar' in steps and stitch:
+            logger.info(f"Diarization chunk {chunk_info.get('chunk_number', 'unknown')} (for stitching)")
+            stage_start = time.time()
+            diarization = diarize_chunk_turns(cleaned, model_manager=model_manager,
+                                              gpu_manager=gpu_manager, logger=logger) or {}
+            finish_stage('diar', chunk_seconds, stage_start)
+            return {
+                'audio': compact_audio(cleaned),
+                'turns': diarization.get('turns'),
+                'embeddings': diarization.get('embeddings', {})
+            }
+        elif 'diar' in steps:
             logger.info(f"Diarization chunk {chunk_info.get('chunk_number', 'unknown')}")
+            stage_start = time.time()
             diarized = diarize_with_pyannote_optimized(
                 cleaned, temp_dir / 'diarized', chunk_info=chunk_info,
                 model_manager=model_manager, gpu_manager=gpu_manager, logger=logger
             )
+            finish_stage('diar', chunk_seconds, stage_start)
         else:
             diarized = cleaned
         
@@ -216,13 +302,55 @@ def process_chunk_with_metadata(chunk_path, chunk_info, steps, use_gpu, logger,
         
     except Exception as e:
         logger.error(f"Error processing chunk {chunk_info.get('chunk_number', 'unknown')}: {e}")
+        if stitch:
+            return {'audio': str(chunk_path), 'turns': None}
         return str(chunk_path)
 
+def stitch_file_speakers(audio_file, chunk_infos, chunk_results, diarized_dir, min_speaker_segment, logger):
+    """
+    Сшивает диаризацию чанков файла и пишет файлы глобальных спикеров в diarized_dir
+    Возвращает части, не разошедшиеся по спикерам: очищенные чанки, если диаризация
+    не удалась ни для одного чанка, иначе пустой список
+    """
+    results = [result or {'audio': None, 'turns': None} for result in chunk_results]
+
+    if all(result['turns'] is None for result in results):
+        logger.warning("Diarization failed for all chunks, skipping speaker stitching")
+        cleaned_dir = Path(diarized_dir).parent / 'cleaned'
+        return [ensure_audio_file(result['audio'], cleaned_dir) for result in results if result['audio']]
+
+    chunks = []
+    for chunk_info, result in zip(chunk_infos, results):
+        if result['turns'] is None:
+            logger.warning(f"Chunk {chunk_info['chunk_number']} has no diarization, its speech is dropped")
+        chunks.append({
+            'start_time': chunk_info['start_time'],
+            'duration': chunk_info['duration'],
+            'turns': result['turns'] or [],
+            'embeddings': result.get('embeddings') or {}
+        })
+
+    speakers = stitch_chunk_turns(chunks, logger=logger)
+    speaker_files = write_stitched_speakers(
+        speakers, chunks, [result['audio'] for result in results], diarized_dir,
+        Path(audio_file).stem, min_segment_duration=min_speaker_segment, logger=logger
+    )
+    logger.info(f"Stitched speakers for {Path(audio_file).name}: {len(speaker_files)} files")
+    return []
+
 def process_file_multithreaded_optimized(audio_file, output_dir, steps, chunk_duration,
                                         min_speaker_segment, split_method, use_gpu,
-                                        logger, model_manager, gpu_manager):
+                                        logger, model_manager, gpu_manager, workers=None,
+                                        overlap_sec=0.0, denoise_mode='enhanced'):
     """
     Оптимизированная многопоточная обработка одного файла
+    chunk_duration=None - длительность и число чанков выбирает планировщик
+    workers - сколько чанков этого файла обрабатывать одновременно
+    overlap_sec > 0 - чанки перекрываются, спикеры сшиваются между чанками
+    в глобальные метки (без дублей и разрезанных реплик на стыках)
+    denoise_mode - режим Demucs или dict весов стемов (см. clean_audio_with_demucs_optimized)
+    Потоки torch не настраиваются здесь: бюджет задает вызывающий код один раз на запуск
+    (get_thread_budget().configure), иначе одновременные файлы перезаписывали бы его друг другу
     """
     audio_file = Path(audio_file)
     output_dir = Path(output_dir)
@@ -232,47 +360,72 @@ def process_file_multithreaded_optimized(audio_file, output_dir, steps, chunk_du
     temp_dir.mkdir(parents=True, exist_ok=True)
     
     try:
+        chunk_workers = workers or 4
+        
         # 1. Разбиение на части
         if 'split' in steps:
             logger.info(f"Splitting file: {audio_file.name}")
-            parts = split_audio_by_duration_optimized(
-                str(audio_file), temp_dir, chunk_duration, split_method, logger
+            if chunk_duration is None:
+                plan = plan_chunks(get_audio_duration(str(audio_file)), steps, workers=workers)
+                chunk_duration = plan['chunk_duration']
+                chunk_workers = plan['workers']
+                logger.info(f"Chunk plan for {audio_file.name}: {plan['num_chunks']} x {chunk_duration}s, "
+                            f"{chunk_workers} workers")
+            parts = split_audio_file(
+                str(audio_file), temp_dir, split_method, chunk_duration, model_manager, logger,
+                overlap_sec=overlap_sec
             )
         else:
             parts = [str(audio_file)]
-        
+
         logger.info(f"File split into {len(parts)} parts")
         
+        # Реальные длительности и начала частей: умная разбивка, перекрытие и присоединенный
+        # хвост делают части неравными, поэтому начала берутся у сплиттера (SplitParts.starts)
+        part_durations = [info.duration for info in probe_audio_files(parts)]
+        part_starts = getattr(parts, 'starts', [0.0] * len(parts))
+        stitch = overlap_sec > 0 and 'diar' in steps and len(parts) > 1
+        
         # 2. Обработка частей
         processed_parts = []
+        chunk_infos = []
+        chunk_results = [None] * len(parts)
         
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            futures = []
+        with ThreadPoolExecutor(max_workers=chunk_workers) as executor:
+            futures = {}
             
-            for idx, part in enumerate(parts):
+            for idx, (part, part_duration, start_time) in enumerate(zip(parts, part_durations, part_starts)):
                 chunk_info = {
                     'chunk_number': idx + 1,
-                    'start_time': idx * chunk_duration,
-                    'end_time': (idx + 1) * chunk_duration,
-                    'duration': chunk_duration,
+                    'start_time': start_time,
+                    'end_time': start_time + part_duration,
+                    'duration': part_duration,
                     'file_name': f"part_{idx + 1}.wav"
                 }
+                chunk_infos.append(chunk_info)
                 
                 future = executor.submit(
                     process_chunk_with_metadata,
                     part, chunk_info, steps, use_gpu, logger,
-                    model_manager, gpu_manager, temp_dir
+                    model_manager, gpu_manager, temp_dir, denoise_mode=denoise_mode, stitch=stitch
                 )
-                futures.append(future)
+                futures[future] = idx
             
             # Собираем результаты
             for future in as_completed(futures):
                 try:
                     result = future.result()
+                    chunk_results[futures[future]] = result
                     processed_parts.append(result)
                 except Exception as e:
                     logger.error(f"Error in processing part: {e}")
         
+        # Сшивка спикеров перекрывающихся чанков в глобальные метки
+        if stitch:
+            processed_parts = stitch_file_speakers(
+                audio_file, chunk_infos, chunk_results, temp_dir / 'diarized', min_speaker_segment, logger
+            )
+        
         # 3. Организация результатов по спикерам
         organized_speakers = {}
         
@@ -375,9 +528,11 @@ def process_file_multithreaded_optimized(audio_file, output_dir, steps, chunk_du
             pass
 
 def process_multiple_files_parallel_optimized(files, output_dir, steps, chunk_duration,
-                                            min_speaker_segment, split_method, use_gpu, logger):
+                                            min_speaker_segment, split_method, use_gpu, logger,
+                                            overlap_sec=0.0, denoise_mode='enhanced'):
     """
     Параллельная обработка нескольких файлов с организацией по спикерам
+    overlap_sec > 0 - перекрывающиеся чанки со сшивкой спикеров (см. process_file_multithreaded_optimized)
     """
     all_organized_speakers = {}
     
@@ -385,14 +540,21 @@ def process_multiple_files_parallel_optimized(files, output_dir, steps, chunk_du
     gpu_manager = GPUMemoryManager()
     model_manager = ModelManager(gpu_manager)
     
-    with ThreadPoolExecutor(max_workers=2) as executor:
+    # Воркеры делятся между одновременно обрабатываемыми файлами
+    file_workers = max(1, min(2, len(files)))
+    chunk_workers = max(1, get_optimal_workers() // file_workers)
+    # Потоки torch - общая настройка процесса: задаем один раз по всем воркерам всех файлов
+    get_thread_budget().configure(chunk_workers * file_workers, steps)
+    
+    with ThreadPoolExecutor(max_workers=file_workers) as executor:
         futures = []
         
         for audio_file in files:
             future = executor.submit(
                 process_file_multithreaded_optimized,
                 audio_file, output_dir, steps, chunk_duration,
-                min_speaker_segment, split_method, use_gpu, logger, model_manager, gpu_manager
+                min_speaker_segment, split_method, use_gpu, logger, model_manager, gpu_manager,
+                workers=chunk_workers, overlap_sec=overlap_sec, denoise_mode=denoise_mode
             )
             futures.append(future)
         
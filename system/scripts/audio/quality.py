@@ -0,0 +1,128 @@
+"""
+Быстрая оценка качества записи: нужен ли чанку Demucs
+"""
+
+import logging
+import threading
+from pathlib import Path
+import numpy as np
+
+from .config import DEMUCS_SKIP_SCORE, PIPELINE_SAMPLE_RATE
+from .utils import decode_audio_pcm
+
+# Параметры анализа (16 кГц моно - формат частей после нарезки)
+ANALYSIS_SAMPLE_RATE = PIPELINE_SAMPLE_RATE
+FRAME_SIZE = 512  # 32 мс, кадры без перекрытия
+SPEECH_BAND_HZ = (100, 4000)  # Основная энергия речи; все вне полосы - музыка, гул, шипение
+
+# Пороги нормировки признаков в оценку шумности [0, 1]
+SNR_CLEAN_DB = 45.0  # Разница речь/пауза, при которой запись считается чистой
+SNR_NOISY_DB = 15.0
+FLATNESS_CLEAN = 0.15  # Спектральная плоскость речи; шум и музыка ее повышают
+FLATNESS_NOISY = 0.5
+MUSIC_BAND_CLEAN = 0.1  # Доля энергии вне речевой полосы
+MUSIC_BAND_NOISY = 0.4
+
+# Порог пропуска Demucs (enable_quality_gate) и журнал решений текущего запуска
+_SKIP_THRESHOLD = DEMUCS_SKIP_SCORE
+_DECISIONS = []
+_DECISIONS_LOCK = threading.Lock()
+
+def _scale(value, clean, noisy):
+    """Линейно переводит признак в [0, 1]: clean -> 0, noisy -> 1"""
+    return float(np.clip((value - clean) / (noisy - clean), 0.0, 1.0))
+
+def estimate_audio_quality(samples, sample_rate=ANALYSIS_SAMPLE_RATE, frame_size=FRAME_SIZE):
+    """
+    Векторизованная оценка шумности записи по кадрам одного rfft
+
+    snr_db - разница уровней громких (p95) и тихих (p10) кадров;
+    flatness - медианная спектральная плоскость громких кадров (речь - низкая, шум - высокая);
+    music_band - доля энергии громких кадров вне речевой полосы (бас, ударные, шипение).
+    score - худший из нормированных признаков: Demucs пропускается, только если чисто все.
+    """
+    samples = np.asarray(samples)
+    if np.issubdtype(samples.dtype, np.integer):
+        samples = samples.astype(np.float32) / 32768.0
+    else:
+        samples = samples.astype(np.float32, copy=False)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+
+    num_frames = len(samples) // frame_size
+    if num_frames < 10:
+        return None
+
+    frames = samples[:num_frames * frame_size].reshape(num_frames, frame_size)
+    energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    snr_db = float(np.percentile(energy_db, 95) - np.percentile(energy_db, 10))
+
+    # Спектр только громких кадров: паузы не должны влиять на характер сигнала
+    loud = frames[energy_db >= np.percentile(energy_db, 50)]
+    power = np.abs(np.fft.rfft(loud * np.hanning(frame_size), axis=1)) ** 2 + 1e-12
+    flatness = float(np.median(np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)))
+
+    freqs = np.fft.rfftfreq(frame_size, 1.0 / sample_rate)
+    in_band = (freqs >= SPEECH_BAND_HZ[0]) & (freqs <= SPEECH_BAND_HZ[1])
+    music_band = float(1.0 - power[:, in_band].sum() / power.sum())
+
+    score = max(
+        _scale(-snr_db, -SNR_CLEAN_DB, -SNR_NOISY_DB),
+        _scale(flatness, FLATNESS_CLEAN, FLATNESS_NOISY),
+        _scale(music_band, MUSIC_BAND_CLEAN, MUSIC_BAND_NOISY)
+    )
+    return {
+        'snr_db': round(snr_db, 2),
+        'flatness': round(flatness, 4),
+        'music_band': round(music_band, 4),
+        'score': round(score, 4)
+    }
+
+def enable_quality_gate(threshold):
+    """
+    Задает порог пропуска Demucs.
+    :param threshold: Чанки с оценкой шумности ниже порога не очищаются; 0 - отключить проверку.
+    """
+    global _SKIP_THRESHOLD
+    _SKIP_THRESHOLD = threshold or 0.0
+
+def assess_denoise_need(input_audio, label=None, logger=None):
+    """
+    Решает, нужен ли чанку Demucs, и записывает решение в журнал запуска
+    :return: dict с метриками, 'skip' (True - использовать чанк как есть) и 'threshold'
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    decision = {'file': Path(input_audio).name, 'label': label, 'threshold': _SKIP_THRESHOLD, 'skip': False}
+    if _SKIP_THRESHOLD <= 0:
+        return decision
+
+    try:
+        metrics = estimate_audio_quality(decode_audio_pcm(input_audio, sample_rate=ANALYSIS_SAMPLE_RATE))
+    except Exception as e:
+        logger.warning(f"Quality check failed for {decision['file']}: {e}")
+        metrics = None
+
+    if metrics is not None:
+        decision.update(metrics)
+        decision['skip'] = metrics['score'] < _SKIP_THRESHOLD
+        logger.info(
+            f"Quality {decision['file']}: SNR {metrics['snr_db']:.1f} dB, flatness {metrics['flatness']:.3f}, "
+            f"music band {metrics['music_band']:.3f} -> score {metrics['score']:.3f} "
+            f"({'skip Demucs' if decision['skip'] else 'denoise'})"
+        )
+
+    with _DECISIONS_LOCK:
+        _DECISIONS.append(decision)
+    return decision
+
+def get_quality_summary():
+    """Итог проверок запуска: {'checked', 'skipped', 'decisions'}"""
+    with _DECISIONS_LOCK:
+        decisions = list(_DECISIONS)
+    return {
+        'checked': len(decisions),
+        'skipped': sum(1 for decision in decisions if decision['skip']),
+        'decisions': decisions
+    }
@@ -0,0 +1,211 @@
+"""
+Классификация ролей: эмбеддинги реплик и их кластеризация по голосам
+"""
+
+import logging
+import numpy as np
+import torch
+
+from .config import EMBEDDING_BATCH_SIZE, EMBEDDING_MAX_TURN_SEC, PIPELINE_SAMPLE_RATE
+from .utils import waveform_input
+
+# Число ролей: минимум нарратор + персонаж, не больше ROLE_MAX и примерно TURNS_PER_ROLE реплик на роль
+ROLE_MIN = 2
+ROLE_MAX = 10
+TURNS_PER_ROLE = 5
+SILHOUETTE_SAMPLE = 2000  # Реплик в выборке для оценки числа ролей: матрица расстояний - квадрат выборки
+CLUSTER_BATCH_SIZE = 1024  # Батч MiniBatchKMeans
+PREDICT_BLOCK = 65536  # Реплик за раз при назначении ролей
+
+# Модель эмбеддингов pyannote/speaker-diarization-3.1 (если пайплайн не отдает свою)
+DEFAULT_EMBEDDING_MODEL = "pyannote/wespeaker-voxceleb-resnet34-LM"
+
+def speaker_embedding_model(pipeline, token=None, device=None):
+    """
+    Модель эмбеддингов пайплайна диаризации: уже загружена, повторно не грузится.
+    Для пайплайна без нее модель загружается один раз здесь.
+    """
+    embedding = getattr(pipeline, '_embedding', None)
+    if embedding is not None:
+        return embedding
+    from pyannote.audio.pipelines.speaker_verification import PretrainedSpeakerEmbedding
+    return PretrainedSpeakerEmbedding(
+        getattr(pipeline, 'embedding', DEFAULT_EMBEDDING_MODEL),
+        device=device, use_auth_token=token
+    )
+
+class TurnEmbeddingExtractor:
+    """
+    Эмбеддинги всех реплик одним проходом: реплики вырезаются из одного декодированного
+    waveform, сортируются по длине и идут батчами с нулевым дополнением и маской.
+    """
+    
+    def __init__(self, embedding, batch_size=EMBEDDING_BATCH_SIZE, max_turn_sec=EMBEDDING_MAX_TURN_SEC):
+        self.embedding = embedding
+        self.batch_size = batch_size
+        self.max_turn_sec = max_turn_sec
+        self.sample_rate = getattr(embedding, 'sample_rate', PIPELINE_SAMPLE_RATE)
+    
+    def crop_bounds(self, turns, num_samples):
+        """Границы реплик в отсчетах (длинные - центральное окно max_turn_sec)"""
+        bounds = np.round(np.asarray(turns, dtype=np.float64).reshape(-1, 2) * self.sample_rate).astype(np.int64)
+        bounds = np.clip(bounds, 0, num_samples)
+        max_len = int(self.max_turn_sec * self.sample_rate)
+        excess = np.maximum(bounds[:, 1] - bounds[:, 0] - max_len, 0)
+        bounds[:, 0] += excess // 2
+        bounds[:, 1] -= excess - excess // 2
+        return bounds
+    
+    def extract(self, audio, turns, logger=None):
+        """
+        Матрица эмбеддингов (N, D) для реплик turns [(start, end) в секундах]
+        audio: путь или dict в памяти; строки реплик, слишком коротких для модели, - NaN
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        
+        audio = waveform_input(audio, sample_rate=self.sample_rate)
+        if audio['sample_rate'] != self.sample_rate:
+            raise ValueError(f"Embedding model expects {self.sample_rate} Hz, got {audio['sample_rate']} Hz")
+        waveform = torch.as_tensor(audio['waveform'], dtype=torch.float32).mean(dim=0)
+        
+        bounds = self.crop_bounds(turns, len(waveform))
+        lengths = bounds[:, 1] - bounds[:, 0]
+        embeddings = None
+        
+        # Батчи из реплик близкой длины - минимум дополнения нулями
+        order = np.argsort(lengths, kind='stable')
+        for batch_start in range(0, len(order), self.batch_size):
+            batch = order[batch_start:batch_start + self.batch_size]
+            width = max(int(lengths[batch].max()), 1)
+            waveforms = torch.zeros(len(batch), 1, width)
+            masks = torch.zeros(len(batch), width)
+            for row, index in enumerate(batch):
+                start, end = bounds[index]
+                waveforms[row, 0, :end - start] = waveform[start:end]
+                masks[row, :end - start] = 1.0
+            
+            with torch.no_grad():
+                batch_embeddings = np.asarray(self.embedding(waveforms, masks=masks), dtype=np.float32)
+            if embeddings is None:
+                embeddings = np.full((len(order), batch_embeddings.shape[1]), np.nan, dtype=np.float32)
+            embeddings[batch] = batch_embeddings
+        
+        if embeddings is None:
+            return np.zeros((0, getattr(self.embedding, 'dimension', 0)), dtype=np.float32)
+        logger.info(f"Extracted {len(order)} turn embeddings in {-(-len(order) // self.batch_size)} batches")
+        return embeddings
+
+def normalize_embeddings(embeddings):
+    """L2-нормировка строк: евклидова кластеризация нормированных векторов = косинусная"""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-8)
+
+def cosine_silhouette(embeddings, labels):
+    """
+    Средний силуэт по косинусному расстоянию (векторизованно, embeddings уже нормированы)
+    Реплика из кластера в одну реплику получает 0, как в sklearn
+    """
+    labels = np.asarray(labels)
+    clusters, labels = np.unique(labels, return_inverse=True)
+    if len(clusters) < 2:
+        return 0.0
+    
+    distances = 1.0 - embeddings @ embeddings.T
+    np.fill_diagonal(distances, 0.0)
+    one_hot = np.eye(len(clusters), dtype=np.float32)[labels]
+    sums = distances @ one_hot  # (n, k): сумма расстояний до каждого кластера
+    counts = one_hot.sum(axis=0)
+    
+    rows = np.arange(len(labels))
+    own_counts = counts[labels] - 1
+    a = sums[rows, labels] / np.maximum(own_counts, 1)
+    means = sums / counts
+    means[rows, labels] = np.inf
+    b = means.min(axis=1)
+    silhouette = (b - a) / np.maximum(np.maximum(a, b), 1e-12)
+    silhouette[own_counts == 0] = 0.0
+    return float(silhouette.mean())
+
+class RoleClusterer:
+    """
+    Кластеризация реплик по ролям для длинных книг: косинусные (нормированные) эмбеддинги,
+    MiniBatchKMeans и выбор числа ролей по силуэту на выборке. Кандидаты обучаются только на
+    выборке, на всех репликах - один раз выбранное число ролей. Время и память линейны по числу реплик.
+    """
+    
+    def __init__(self, min_roles=ROLE_MIN, max_roles=ROLE_MAX, turns_per_role=TURNS_PER_ROLE,
+                 sample_size=SILHOUETTE_SAMPLE, batch_size=CLUSTER_BATCH_SIZE, random_state=42):
+        self.min_roles = min_roles
+        self.max_roles = max_roles
+        self.turns_per_role = turns_per_role
+        self.sample_size = sample_size
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.scores = {}
+    
+    def role_range(self, num_turns):
+        """Допустимые числа ролей для num_turns реплик"""
+        upper = min(self.max_roles, max(self.min_roles, num_turns // self.turns_per_role), num_turns)
+        return range(min(self.min_roles, upper), upper + 1)
+    
+    def _fit(self, embeddings, n_roles):
+        from sklearn.cluster import MiniBatchKMeans
+        kmeans = MiniBatchKMeans(
+            n_clusters=n_roles, batch_size=self.batch_size, n_init=10, random_state=self.random_state
+        )
+        kmeans.fit(embeddings)
+        return normalize_embeddings(kmeans.cluster_centers_)
+    
+    def _assign(self, embeddings, centers):
+        """Ближайший по косинусу центр, блоками (без матрицы N x N)"""
+        labels = np.empty(len(embeddings), dtype=np.int64)
+        for start in range(0, len(embeddings), PREDICT_BLOCK):
+            labels[start:start + PREDICT_BLOCK] = np.argmax(embeddings[start:start + PREDICT_BLOCK] @ centers.T, axis=1)
+        return labels
+    
+    def fit_predict(self, embeddings, logger=None):
+        """
+        Метки ролей (N,) с номерами по убыванию числа реплик и выбранное число ролей
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        
+        embeddings = normalize_embeddings(embeddings)
+        candidates = self.role_range(len(embeddings))
+        if len(candidates) == 0 or candidates[-1] < 2:
+            return np.zeros(len(embeddings), dtype=np.int64), 1
+        
+        # Силуэт считается на выборке: O(sample^2) независимо от длины книги
+        rng = np.random.default_rng(self.random_state)
+        sample = embeddings
+        if len(embeddings) > self.sample_size:
+            sample = embeddings[rng.choice(len(embeddings), self.sample_size, replace=False)]
+        
+        best = (0.0, candidates[0], None)
+        self.scores = {}
+        if len(candidates) > 1:
+            best = None
+            for n_roles in candidates:
+                centers = self._fit(sample, n_roles)
+                score = cosine_silhouette(sample, self._assign(sample, centers))
+                self.scores[n_roles] = round(score, 4)
+                if best is None or score > best[0]:
+                    best = (score, n_roles, centers)
+        
+        # Выбранное число ролей дообучается на всех репликах (на выборке уже обучено, если она - все)
+        _, n_roles, centers = best
+        if centers is None or sample is not embeddings:
+            centers = self._fit(embeddings, n_roles)
+        labels = self._assign(embeddings, centers)
+        
+        # Стабильная нумерация: role_00 - самая частая роль
+        counts = np.bincount(labels, minlength=n_roles)
+        ranks = np.empty(n_roles, dtype=np.int64)
+        ranks[np.argsort(-counts, kind='stable')] = np.arange(n_roles)
+        labels = ranks[labels]
+        n_roles = int(np.count_nonzero(counts))
+        
+        logger.info(f"Role count by silhouette: {self.scores} -> {n_roles} roles")
+        return labels, n_roles
@@ -4,26 +4,25 @@
 
 import os
 import sys
+import json
 import math
 import subprocess
 import threading
 import time
 from pathlib import Path
+import numpy as np
 import whisper
 import torch
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from .utils import get_mp3_duration
+from .utils import get_audio_duration, probe_audio_files, decode_audio_pcm, read_audio_window, write_wav_pcm16
+from .config import WHISPER_BATCH_SIZE
 
 # Add the scripts directory to path for imports
 scripts_dir = Path(__file__).parent
 sys.path.append(str(scripts_dir))
 
-# Global locks for thread safety
+# Global lock for thread safety (the Whisper model is shared between files)
 WHISPER_MODEL_LOCK = threading.Lock()
-SPLIT_COORDINATION_LOCK = threading.Lock()
-
-# Global storage for boundary analysis results
-BOUNDARY_RESULTS = {}
 
 def get_central_temp_dir():
     """Получить центральную временную папку в корне проекта"""
@@ -32,18 +31,81 @@ def get_central_temp_dir():
     central_temp.mkdir(exist_ok=True)
     return central_temp
 
+# Хвост короче этого присоединяется к последней части вместо отдельного файла
+MIN_TAIL_SEC = 1.0
+
+class SplitParts(list):
+    """
+    Пути частей (обычный список) и starts - реальное начало каждой части в исходном файле, сек
+    Умная разбивка, перекрытие и присоединенный хвост делают части неравными, поэтому
+    смещения берутся у сплиттера, а не вычисляются по длительностям
+    """
+    
+    def __init__(self, parts, starts):
+        super().__init__(parts)
+        self.starts = [float(start) for start in starts]
+
+def split_manifest(input_audio, boundaries, **params):
+    """
+    Описание разбивки: размер и mtime исходника, точки разреза и параметры сплиттера.
+    Готовые части используются повторно, только если описание совпадает с сохраненным
+    """
+    stat = os.stat(input_audio)
+    return {
+        'source': str(Path(input_audio).resolve()),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'boundaries': [round(float(b), 3) for b in boundaries],
+        **params
+    }
+
+def split_manifest_path(temp_dir, output_prefix):
+    return Path(temp_dir) / f"{output_prefix}manifest.json"
+
+def reusable_split(temp_dir, output_prefix, output_files, manifest):
+    """
+    True, если все части уже есть и нарезаны из того же исходника с теми же параметрами.
+    Иначе старое описание удаляется: оно пишется заново только после успешной разбивки
+    """
+    manifest_path = split_manifest_path(temp_dir, output_prefix)
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == manifest and all(output_file.exists() for output_file in output_files):
+                return True
+    except (OSError, ValueError):
+        pass
+    manifest_path.unlink(missing_ok=True)
+    return False
+
+def save_split_manifest(temp_dir, output_prefix, manifest):
+    with open(split_manifest_path(temp_dir, output_prefix), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+def single_part(output_file):
+    """Результат разбивки в одну часть"""
+    return SplitParts([str(output_file)], [0.0])
+
+def count_parts(total_seconds, max_duration_sec):
+    """
+    Количество частей для точной (float) длительности без крошечного хвоста
+    """
+    return max(1, math.ceil((total_seconds - MIN_TAIL_SEC) / max_duration_sec))
+
 def split_audio_by_duration_optimized(input_audio, temp_dir, max_duration_sec=600, 
-                                    output_prefix="part_", logger=None):
+                                    output_prefix="part_", logger=None, backend="segment",
+                                    max_workers=4, overlap_sec=0.0):
     """
     Оптимизированная разбивка аудио по длительности
+    backend: 'segment' - все части за один запуск ffmpeg (segment muxer),
+             'memory' - файл декодируется один раз, части нарезаются из буфера NumPy
+    overlap_sec: каждая часть, кроме последней, продлевается на overlap_sec
+                 в следующую (для сшивки спикеров между чанками, только 'memory')
     """
     os.makedirs(temp_dir, exist_ok=True)
     
-    duration_str = get_mp3_duration(input_audio)
-    time_parts = duration_str.split(":")
-    total_seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
+    total_seconds = get_audio_duration(input_audio)
     
-    if total_seconds <= max_duration_sec:
+    if count_parts(total_seconds, max_duration_sec) == 1:
         output_file = Path(temp_dir) / f"{output_prefix}1.wav"
         if not output_file.exists():
             command = [
@@ -52,58 +114,156 @@ def split_audio_by_duration_optimized(input_audio, temp_dir, max_duration_sec=60
                 str(output_file)
             ]
             subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return [str(output_file)]
+        return single_part(output_file)
     
-    num_parts = math.ceil(total_seconds / max_duration_sec)
-    parts = []
+    num_parts = count_parts(total_seconds, max_duration_sec)
+    boundaries = [i * max_duration_sec for i in range(1, num_parts)]
     
-    for i in range(num_parts):
-        start_time = i * max_duration_sec
-        end_time = min((i + 1) * max_duration_sec, total_seconds)
-        
-        output_file = Path(temp_dir) / f"{output_prefix}{i + 1}.wav"
-        if not output_file.exists():
-            command = [
-                "ffmpeg", "-i", input_audio,
-                "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-                "-ss", str(start_time), "-t", str(end_time - start_time),
-                str(output_file)
-            ]
-            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if backend == "memory" or overlap_sec > 0:
+        return split_audio_from_memory(input_audio, temp_dir, boundaries, output_prefix,
+                                       max_workers=max_workers, logger=logger, overlap_sec=overlap_sec)
+    
+    return split_audio_with_segment_muxer(input_audio, temp_dir, boundaries, output_prefix, logger=logger)
+
+def cut_audio_at_points(input_audio, temp_dir, split_points, output_prefix="part_",
+                        overlap_sec=0.0, max_workers=4, logger=None):
+    """
+    Нарезка по готовым точкам: без перекрытия - segment muxer,
+    с перекрытием - из буфера в памяти (muxer не умеет перекрывающиеся части)
+    """
+    if overlap_sec > 0:
+        return split_audio_from_memory(input_audio, temp_dir, split_points, output_prefix,
+                                       max_workers=max_workers, logger=logger, overlap_sec=overlap_sec)
+    return split_audio_with_segment_muxer(input_audio, temp_dir, split_points, output_prefix, logger=logger)
+
+def split_audio_with_segment_muxer(input_audio, temp_dir, boundaries, output_prefix="part_",
+                                   sample_rate=16000, logger=None):
+    """
+    Разбивка одним запуском ffmpeg через segment muxer:
+    файл декодируется последовательно один раз, части режутся по -segment_times.
+    boundaries: отсортированные точки разреза в секундах (без 0 и конца файла)
+    """
+    if logger is None:
+        import logging
+        logger = logging.getLogger(__name__)
+    
+    os.makedirs(temp_dir, exist_ok=True)
+    
+    output_files = [Path(temp_dir) / f"{output_prefix}{i + 1}.wav" for i in range(len(boundaries) + 1)]
+    manifest = split_manifest(input_audio, boundaries, backend="segment", sample_rate=sample_rate)
+    if reusable_split(temp_dir, output_prefix, output_files, manifest):
+        return muxer_parts([str(output_file) for output_file in output_files])
+    
+    # Шаблон имен для segment muxer: part_1.wav, part_2.wav, ...
+    output_pattern = Path(temp_dir) / f"{output_prefix.replace('%', '%%')}%d.wav"
+    
+    command = [
+        "ffmpeg", "-v", "error", "-i", str(input_audio),
+        "-vn", "-acodec", "pcm_s16le", "-ar", str(sample_rate), "-ac", "1",
+        "-f", "segment", "-segment_format", "wav",
+        "-segment_start_number", "1", "-reset_timestamps", "1"
+    ]
+    if boundaries:
+        command += ["-segment_times", ",".join(f"{b:.3f}" for b in boundaries)]
+    command += [str(output_pattern), "-y"]
+    
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        logger.error(f"Segment muxer failed for {Path(input_audio).name}: {result.stderr.strip()}")
+        # Неполный набор частей не считается результатом: удаляем его, вызывающий откатится на другой сплиттер
+        for output_file in output_files:
+            if output_file.exists():
+                output_file.unlink()
+        raise subprocess.CalledProcessError(result.returncode, command, stderr=result.stderr)
+    
+    parts = [str(output_file) for output_file in output_files if output_file.exists()]
+    save_split_manifest(temp_dir, output_prefix, manifest)
+    logger.info(f"Segment muxer splitting completed: {len(parts)} parts created")
+    return muxer_parts(parts)
+
+def muxer_parts(parts):
+    """
+    Части segment muxer идут встык, но режутся по границам аудиокадров, а не точно по boundaries:
+    начало части - сумма реальных длительностей предыдущих
+    """
+    durations = [info.duration for info in probe_audio_files(parts)]
+    return SplitParts(parts, np.concatenate(([0.0], np.cumsum(durations)[:-1])))
+
+def split_audio_from_memory(input_audio, temp_dir, boundaries, output_prefix="part_",
+                            sample_rate=16000, max_workers=4, logger=None, overlap_sec=0.0):
+    """
+    Разбивка с однократным декодированием: файл декодируется в 16 кГц моно PCM
+    один раз, части нарезаются срезами NumPy и записываются параллельно.
+    boundaries: отсортированные точки разреза в секундах (без 0 и конца файла)
+    overlap_sec: часть i заканчивается на boundaries[i] + overlap_sec,
+                 следующая по-прежнему начинается с boundaries[i]
+    
+    Память: весь файл держится в буфере (~115 МБ на час аудио).
+    """
+    if logger is None:
+        import logging
+        logger = logging.getLogger(__name__)
+    
+    os.makedirs(temp_dir, exist_ok=True)
+    
+    output_files = [Path(temp_dir) / f"{output_prefix}{i + 1}.wav" for i in range(len(boundaries) + 1)]
+    manifest = split_manifest(input_audio, boundaries, backend="memory", sample_rate=sample_rate,
+                              overlap_sec=overlap_sec)
+    if reusable_split(temp_dir, output_prefix, output_files, manifest):
+        starts = [0.0] + [round(b * sample_rate) / sample_rate for b in boundaries]
+        return SplitParts([str(output_file) for output_file in output_files], starts)
+    
+    logger.info(f"Decoding {Path(input_audio).name} once for in-memory splitting...")
+    samples = decode_audio_pcm(input_audio, sample_rate=sample_rate, channels=1)
+    
+    # Переводим секунды в индексы сэмплов (без копирования данных - только представления)
+    cut_points = [0] + [min(int(round(b * sample_rate)), len(samples)) for b in boundaries] + [len(samples)]
+    overlap_samples = int(round(overlap_sec * sample_rate))
+    
+    parts = []
+    starts = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for i, output_file in enumerate(output_files):
+            start, end = cut_points[i], cut_points[i + 1]
+            if end > start:
+                end = min(end + overlap_samples, len(samples))
+            if end <= start:
+                logger.warning(f"Part {i+1} has zero duration, skipping")
+                continue
+            futures.append(executor.submit(write_wav_pcm16, output_file, samples[start:end], sample_rate))
+            parts.append(str(output_file))
+            starts.append(start / sample_rate)
         
-        parts.append(str(output_file))
+        for future in futures:
+            future.result()
     
-    return parts
+    save_split_manifest(temp_dir, output_prefix, manifest)
+    logger.info(f"In-memory splitting completed: {len(parts)} parts created")
+    return SplitParts(parts, starts)
 
 def analyze_boundary_segment(input_audio, segment_start, segment_end, segment_id, whisper_model, temp_dir, logger=None):
     """
     Анализирует сегмент для поиска границ предложений (выполняется в отдельном потоке)
+    Окно читается из ffmpeg прямо в память - временные файлы не создаются
+    Возвращает список границ (пустой при ошибке)
     """
+    if logger is None:
+        import logging
+        logger = logging.getLogger(__name__)
+    
     try:
-        # Используем центральную временную папку вместо папки с исходными файлами
-        central_temp_dir = get_central_temp_dir()
-        segment_temp_dir = central_temp_dir / f"temp_analysis_{segment_id}"
-        segment_temp_dir.mkdir(exist_ok=True)
-        temp_file = segment_temp_dir / f"temp_analysis_{segment_id}.wav"
-        
-        # Извлекаем сегмент для анализа
-        command = [
-            "ffmpeg", "-i", input_audio,
-            "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-            "-ss", str(segment_start), "-t", str(segment_end - segment_start),
-            str(temp_file), "-y"
-        ]
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples = read_audio_window(input_audio, segment_start, segment_end - segment_start)
         
-        if not temp_file.exists():
-            logger.warning(f"Failed to create temp file for segment {segment_id}")
-            return None
+        if len(samples) == 0:
+            logger.warning(f"Failed to read audio for segment {segment_id}")
+            return []
         
         # Транскрибируем с помощью Whisper с блокировкой
         boundaries = []
         try:
             with WHISPER_MODEL_LOCK:  # Блокируем доступ к модели
-                result = whisper_model.transcribe(str(temp_file), language="ru")
+                result = whisper_model.transcribe(samples, language="ru")
                 
                 # Ищем лучшие границы предложений
                 for segment in result["segments"]:
@@ -120,40 +280,94 @@ def analyze_boundary_segment(input_audio, segment_start, segment_end, segment_id
             # Возвращаем пустой список границ в случае ошибки
             boundaries = []
         
-        # Удаляем временный файл
-        try:
-            temp_file.unlink()
-        except:
-            pass
-        
-        # Очищаем временную папку
-        try:
-            import shutil
-            shutil.rmtree(segment_temp_dir)
-        except:
-            pass
-        
-        # Сохраняем результат в глобальный словарь
-        with SPLIT_COORDINATION_LOCK:
-            BOUNDARY_RESULTS[segment_id] = {
-                'boundaries': boundaries,
-                'segment_start': segment_start,
-                'segment_end': segment_end
-            }
-        
         logger.info(f"✓ Analyzed segment {segment_id}: found {len(boundaries)} boundaries")
         return boundaries
         
     except Exception as e:
         logger.error(f"Error analyzing segment {segment_id}: {e}")
-        # Сохраняем пустой результат в случае ошибки
-        with SPLIT_COORDINATION_LOCK:
-            BOUNDARY_RESULTS[segment_id] = {
-                'boundaries': [],
-                'segment_start': segment_start,
-                'segment_end': segment_end
-            }
-        return None
+        return []
+
+def _parse_timestamped_tokens(tokens, tokenizer, offset):
+    """
+    Превращает токены Whisper с метками времени в список границ (абсолютное время)
+    """
+    boundaries = []
+    segment_start = None
+    text_tokens = []
+    
+    for token in tokens:
+        if token >= tokenizer.timestamp_begin:
+            timestamp = (token - tokenizer.timestamp_begin) * 0.02  # шаг меток Whisper - 20 мс
+            if segment_start is not None and text_tokens:
+                boundaries.append({
+                    'start': offset + segment_start,
+                    'end': offset + timestamp,
+                    'text': tokenizer.decode(text_tokens).strip()
+                })
+                text_tokens = []
+            segment_start = timestamp
+        else:
+            text_tokens.append(token)
+    
+    return boundaries
+
+def analyze_boundary_windows_batched(windows, whisper_model, language="ru",
+                                     batch_size=WHISPER_BATCH_SIZE, logger=None):
+    """
+    Пакетный анализ окон границ одного файла одним проходом энкодера/декодера Whisper
+    
+    windows: список dict (см. extract_boundary_window) с ключами 'segment_id' (номер точки разреза),
+             'samples' (float32 16 кГц моно, до 30 сек) и 'offset' (начало окна в файле, сек).
+             Файлы не объединяются в один батч: параллельные разбивки разных файлов
+             проходят через WHISPER_MODEL_LOCK по очереди, каждая своим батчем.
+    Возвращает dict segment_id -> список границ в формате find_best_split_point.
+    """
+    if logger is None:
+        import logging
+        logger = logging.getLogger(__name__)
+    
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        whisper_model.is_multilingual, num_languages=whisper_model.num_languages,
+        language=language, task="transcribe"
+    )
+    options = whisper.DecodingOptions(
+        language=language, without_timestamps=False,
+        fp16=whisper_model.device.type == "cuda"
+    )
+    
+    results = {}
+    for batch_start in range(0, len(windows), batch_size):
+        batch = windows[batch_start:batch_start + batch_size]
+        
+        # Собираем лог-мел спектрограммы всех окон в один тензор (B, n_mels, 3000)
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(
+                whisper.pad_or_trim(torch.from_numpy(window['samples'])),
+                n_mels=whisper_model.dims.n_mels
+            )
+            for window in batch
+        ]).to(whisper_model.device)
+        
+        with WHISPER_MODEL_LOCK:
+            with torch.no_grad():
+                decoded = whisper.decode(whisper_model, mel, options)
+        
+        for window, result in zip(batch, decoded):
+            results[window['segment_id']] = _parse_timestamped_tokens(result.tokens, tokenizer, window['offset'])
+        
+        logger.info(f"✓ Batched Whisper pass: {len(batch)} windows")
+    
+    return results
+
+def extract_boundary_window(input_audio, segment_start, segment_end, segment_id):
+    """
+    Извлекает окно анализа в память (float32 16 кГц моно)
+    """
+    return {
+        'segment_id': segment_id,
+        'samples': read_audio_window(input_audio, segment_start, segment_end - segment_start),
+        'offset': segment_start
+    }
 
 def find_best_split_point(boundaries, target_time, search_window=30):
     """
@@ -181,11 +395,97 @@ def find_best_split_point(boundaries, target_time, search_window=30):
     
     return best_boundary
 
+def find_energy_boundaries(samples, sample_rate, segment_start, target_time,
+                           frame_ms=25, hop_ms=10, min_pause=0.2):
+    """
+    Векторизованный поиск пауз по энергии кадров (RMS) и частоте пересечений нуля (ZCR)
+    
+    Кадр считается паузой, если его энергия ниже адаптивного порога и он не похож
+    на глухой согласный (высокий ZCR при заметной энергии). Из найденных пауз
+    выбираются самые длинные (не короче половины максимальной), среди них - ближайшая
+    к target_time. Возвращает список границ в формате find_best_split_point,
+    где 'end' - точка разреза в середине паузы (абсолютное время).
+    """
+    samples = np.asarray(samples)
+    if np.issubdtype(samples.dtype, np.integer):
+        samples = samples.astype(np.float32) / 32768.0
+    else:
+        samples = samples.astype(np.float32, copy=False)
+    
+    frame_len = int(sample_rate * frame_ms / 1000)
+    hop = int(sample_rate * hop_ms / 1000)
+    if len(samples) < frame_len:
+        return []
+    
+    frames = np.lib.stride_tricks.sliding_window_view(samples, frame_len)[::hop]
+    
+    rms_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+    
+    # Адаптивный порог между уровнем шума и уровнем речи
+    floor_db = np.percentile(rms_db, 10)
+    speech_db = np.percentile(rms_db, 90)
+    if speech_db - floor_db < 6:
+        return []
+    threshold_db = floor_db + 0.3 * (speech_db - floor_db)
+    
+    silent = (rms_db < threshold_db) & ((zcr < 0.3) | (rms_db < floor_db + 3))
+    
+    # Находим непрерывные участки тишины
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    
+    gap_starts = run_starts * hop / sample_rate
+    gap_ends = (run_ends * hop + frame_len) / sample_rate
+    gap_lengths = gap_ends - gap_starts
+    
+    keep = gap_lengths >= min_pause
+    if not np.any(keep):
+        return []
+    gap_starts, gap_ends, gap_lengths = gap_starts[keep], gap_ends[keep], gap_lengths[keep]
+    
+    # Длинные паузы, затем ближайшая к цели
+    long_gaps = gap_lengths >= 0.5 * gap_lengths.max()
+    centers = segment_start + (gap_starts + gap_ends) / 2
+    distances = np.where(long_gaps, np.abs(centers - target_time), np.inf)
+    best = int(np.argmin(distances))
+    
+    return [{
+        'start': segment_start + float(gap_starts[best]),
+        'end': float(centers[best]),
+        'text': ''
+    }]
+
+def analyze_boundary_segment_energy(input_audio, segment_start, segment_end, segment_id,
+                                    target_time, logger=None):
+    """
+    Анализирует сегмент для поиска паузы без Whisper (энергия + ZCR)
+    """
+    if logger is None:
+        import logging
+        logger = logging.getLogger(__name__)
+    
+    try:
+        samples = read_audio_window(input_audio, segment_start, segment_end - segment_start)
+        boundaries = find_energy_boundaries(samples, 16000, segment_start, target_time)
+    except Exception as e:
+        logger.error(f"Energy analysis error for segment {segment_id}: {e}")
+        boundaries = []
+    
+    logger.info(f"✓ Analyzed segment {segment_id} (energy): found {len(boundaries)} boundaries")
+    return boundaries
+
 def split_audio_smart_multithreaded_optimized(input_audio, temp_dir, max_duration_sec=600, 
                                             output_prefix="part_", whisper_model=None, 
-                                            analysis_window=30, max_workers=4, logger=None):
+                                            analysis_window=30, max_workers=4, logger=None,
+                                            boundary_method="whisper", overlap_sec=0.0):
     """
     Умная многопоточная разбивка аудио с анализом границ предложений на GPU
+    boundary_method: 'whisper' - границы предложений по транскрипции,
+                     'energy' - паузы по энергии сигнала (без модели, быстро на CPU)
+    overlap_sec: перекрытие соседних частей (см. split_audio_from_memory)
     
     Алгоритм:
     1. Разбиваем на 10-минутные отрезки
@@ -201,13 +501,11 @@ def split_audio_smart_multithreaded_optimized(input_audio, temp_dir, max_duratio
     os.makedirs(temp_dir, exist_ok=True)
     
     # Получаем длительность файла
-    duration_str = get_mp3_duration(input_audio)
-    time_parts = duration_str.split(":")
-    total_seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
+    total_seconds = get_audio_duration(input_audio)
     
-    logger.info(f"Smart multithreaded splitting: {total_seconds}s total, {max_duration_sec}s chunks")
+    logger.info(f"Smart multithreaded splitting: {total_seconds:.1f}s total, {max_duration_sec}s chunks")
     
-    if total_seconds <= max_duration_sec:
+    if count_parts(total_seconds, max_duration_sec) == 1:
         output_file = Path(temp_dir) / f"{output_prefix}1.wav"
         if not output_file.exists():
             command = [
@@ -216,10 +514,10 @@ def split_audio_smart_multithreaded_optimized(input_audio, temp_dir, max_duratio
                 str(output_file)
             ]
             subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return [str(output_file)]
+        return single_part(output_file)
     
     # Загружаем Whisper модель если не передана
-    if whisper_model is None:
+    if boundary_method == "whisper" and whisper_model is None:
         logger.info("Loading Whisper model for smart splitting...")
         with WHISPER_MODEL_LOCK:
             whisper_model = whisper.load_model("base")
@@ -228,62 +526,79 @@ def split_audio_smart_multithreaded_optimized(input_audio, temp_dir, max_duratio
                 logger.info("✓ Whisper model moved to GPU")
     
     # Вычисляем количество частей
-    num_parts = math.ceil(total_seconds / max_duration_sec)
+    num_parts = count_parts(total_seconds, max_duration_sec)
     logger.info(f"Will create {num_parts} parts with smart boundaries")
     
-    # Очищаем глобальные результаты
-    global BOUNDARY_RESULTS
-    BOUNDARY_RESULTS.clear()
+    # Результаты анализа хранятся локально для вызова - параллельные разбивки
+    # разных файлов не пересекаются
+    boundary_results = {}
     
     # Этап 1: Многопоточный анализ границ
     logger.info("Stage 1: Analyzing sentence boundaries in parallel...")
     
-    # Уменьшаем количество потоков для стабильности
-    safe_max_workers = min(max_workers, 2)  # Максимум 2 потока для стабильности
-    
-    with ThreadPoolExecutor(max_workers=safe_max_workers) as executor:
-        futures = []
+    # Потоки только декодируют окна (и считают энергию) - модель в них не вызывается,
+    # поэтому ограничение в 2 потока больше не нужно
+    safe_max_workers = max_workers
+    
+    # Анализируем только точки разреза (конец последнего чанка - конец файла)
+    analysis_ranges = []
+    for i in range(num_parts - 1):
+        chunk_end = (i + 1) * max_duration_sec
+        analysis_start = max(0, chunk_end - analysis_window)
+        analysis_ranges.append((i, analysis_start, chunk_end))
+    
+    if boundary_method == "energy":
+        with ThreadPoolExecutor(max_workers=safe_max_workers) as executor:
+            futures = [
+                (executor.submit(analyze_boundary_segment_energy,
+                                 input_audio, analysis_start, analysis_end, i, analysis_end, logger), i)
+                for i, analysis_start, analysis_end in analysis_ranges
+            ]
+            for future, segment_id in futures:
+                try:
+                    boundary_results[segment_id] = future.result(timeout=300)
+                except Exception as e:
+                    logger.error(f"Failed to analyze segment {segment_id}: {e}")
+                    boundary_results[segment_id] = []
+    else:
+        # Потоки извлекают окна параллельно, модель обрабатывает их одним батчем
+        with ThreadPoolExecutor(max_workers=safe_max_workers) as executor:
+            window_futures = [
+                (executor.submit(extract_boundary_window, input_audio, analysis_start, analysis_end, i), i)
+                for i, analysis_start, analysis_end in analysis_ranges
+            ]
+            windows = []
+            for future, segment_id in window_futures:
+                try:
+                    windows.append(future.result(timeout=300))
+                except Exception as e:
+                    logger.error(f"Failed to extract window for segment {segment_id}: {e}")
         
-        for i in range(num_parts):
-            # Вычисляем границы для анализа
-            chunk_start = i * max_duration_sec
-            chunk_end = min((i + 1) * max_duration_sec, total_seconds)
-            
-            # Анализируем последние 30 секунд каждого чанка
-            analysis_start = max(0, chunk_end - analysis_window)
-            analysis_end = chunk_end
-            
-            # Запускаем анализ в отдельном потоке
-            future = executor.submit(
-                analyze_boundary_segment,
-                input_audio, analysis_start, analysis_end, i, whisper_model, temp_dir, logger
-            )
-            futures.append((future, i))
+        try:
+            batched_boundaries = analyze_boundary_windows_batched(windows, whisper_model, logger=logger)
+        except Exception as e:
+            logger.warning(f"Batched boundary analysis failed ({e}), falling back to per-segment transcription")
+            batched_boundaries = None
         
-        # Ждем завершения всех анализов
-        for future, segment_id in futures:
-            try:
-                future.result(timeout=300)  # 5 минут таймаут на сегмент
-            except Exception as e:
-                logger.error(f"Failed to analyze segment {segment_id}: {e}")
-                # Устанавливаем пустой результат для неудачного сегмента
-                with SPLIT_COORDINATION_LOCK:
-                    BOUNDARY_RESULTS[segment_id] = {
-                        'boundaries': [],
-                        'segment_start': segment_id * max_duration_sec,
-                        'segment_end': min((segment_id + 1) * max_duration_sec, total_seconds)
-                    }
+        for i, analysis_start, analysis_end in analysis_ranges:
+            if batched_boundaries is None:
+                boundary_results[i] = analyze_boundary_segment(
+                    input_audio, analysis_start, analysis_end, i,
+                    whisper_model, temp_dir, logger
+                )
+                continue
+            boundary_results[i] = batched_boundaries.get(i, [])
+            logger.info(f"✓ Analyzed segment {i}: found {len(boundary_results[i])} boundaries")
     
     # Этап 2: Координация и создание финальных частей
     logger.info("Stage 2: Coordinating boundaries and creating final parts...")
     
-    parts = []
+    split_points = []
     current_start = 0
     
-    for i in range(num_parts):
+    for i in range(num_parts - 1):
         # Получаем результаты анализа
-        segment_data = BOUNDARY_RESULTS.get(i, {})
-        boundaries = segment_data.get('boundaries', [])
+        boundaries = boundary_results.get(i, [])
         
         # Вычисляем целевую точку разбивки
         target_time = (i + 1) * max_duration_sec
@@ -297,63 +612,33 @@ def split_audio_smart_multithreaded_optimized(input_audio, temp_dir, max_duratio
         logger.info(f"Part {i+1}: {current_start:.1f}s -> {best_split_point:.1f}s "
                    f"(target: {target_time:.1f}s, found: {len(boundaries)} boundaries)")
         
-        # Создаем финальную часть
-        output_file = Path(temp_dir) / f"{output_prefix}{i + 1}.wav"
-        
-        if not output_file.exists():
-            part_duration = best_split_point - current_start
-            
-            if part_duration > 0:
-                command = [
-                    "ffmpeg", "-i", input_audio,
-                    "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-                    "-ss", str(current_start), "-t", str(part_duration),
-                    str(output_file), "-y"
-                ]
-                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                
-                if output_file.exists():
-                    parts.append(str(output_file))
-                    logger.info(f"✓ Created part {i+1}: {output_file.name} ({part_duration:.1f}s)")
-                else:
-                    logger.error(f"Failed to create part {i+1}")
-            else:
-                logger.warning(f"Part {i+1} has zero duration, skipping")
+        if best_split_point > current_start:
+            split_points.append(best_split_point)
+        else:
+            logger.warning(f"Part {i+1} has zero duration, skipping")
         
         # Обновляем начальную точку для следующей части
         current_start = best_split_point
     
-    # Очищаем временные файлы из центральной папки
-    central_temp_dir = get_central_temp_dir()
-    temp_analysis_patterns = ["temp_analysis_*"]
-    
-    for pattern in temp_analysis_patterns:
-        temp_files = list(central_temp_dir.glob(pattern))
-        for temp_file in temp_files:
-            try:
-                if temp_file.is_file():
-                    temp_file.unlink()
-                elif temp_file.is_dir():
-                    import shutil
-                    shutil.rmtree(temp_file)
-            except Exception as e:
-                logger.warning(f"Could not remove temp file {temp_file}: {e}")
+    # Создаем все финальные части одним запуском ffmpeg (или из памяти при перекрытии)
+    parts = cut_audio_at_points(input_audio, temp_dir, split_points, output_prefix,
+                                overlap_sec=overlap_sec, max_workers=max_workers, logger=logger)
     
     logger.info(f"Smart splitting completed: {len(parts)} parts created")
     return parts
 
 def split_audio_at_word_boundary_optimized(input_audio, temp_dir, max_duration_sec=600, 
-                                         output_prefix="part_", whisper_model=None, logger=None):
+                                         output_prefix="part_", whisper_model=None, logger=None,
+                                         overlap_sec=0.0):
     """
     Оптимизированная разбивка аудио по границам слов
+    overlap_sec: перекрытие соседних частей (см. split_audio_from_memory)
     """
     os.makedirs(temp_dir, exist_ok=True)
     
-    duration_str = get_mp3_duration(input_audio)
-    time_parts = duration_str.split(":")
-    total_seconds = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
+    total_seconds = get_audio_duration(input_audio)
     
-    if total_seconds <= max_duration_sec:
+    if count_parts(total_seconds, max_duration_sec) == 1:
         output_file = Path(temp_dir) / f"{output_prefix}1.wav"
         if not output_file.exists():
             command = [
@@ -362,38 +647,27 @@ def split_audio_at_word_boundary_optimized(input_audio, temp_dir, max_duration_s
                 str(output_file)
             ]
             subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return [str(output_file)]
+        return single_part(output_file)
     
     if whisper_model is None:
         whisper_model = whisper.load_model("base")
     
-    num_parts = math.ceil(total_seconds / max_duration_sec)
-    parts = []
+    num_parts = count_parts(total_seconds, max_duration_sec)
+    split_points = []
     
-    for i in range(num_parts):
-        start_time = i * max_duration_sec
-        end_time = min((i + 1) * max_duration_sec, total_seconds)
+    for i in range(1, num_parts):
+        target_split_time = i * max_duration_sec
         
         # Анализируем окрестности точки разбивки
-        analysis_start = max(0, start_time - 30)
-        analysis_end = min(total_seconds, end_time + 30)
-        
-        # Создаем временный файл для анализа в центральной временной папке
-        central_temp_dir = get_central_temp_dir()
-        temp_file = central_temp_dir / f"temp_analysis_{i}.wav"
-        command = [
-            "ffmpeg", "-i", input_audio,
-            "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-            "-ss", str(analysis_start), "-t", str(analysis_end - analysis_start),
-            str(temp_file), "-y"
-        ]
-        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        analysis_start = max(0, target_split_time - 30)
+        analysis_end = min(total_seconds, target_split_time + 30)
         
-        # Транскрибируем для поиска границ слов
-        result = whisper_model.transcribe(str(temp_file), language="ru")
+        # Читаем окно из ffmpeg прямо в память и транскрибируем для поиска границ слов
+        samples = read_audio_window(input_audio, analysis_start, analysis_end - analysis_start)
+        result = whisper_model.transcribe(samples, language="ru")
         
         # Ищем лучшую границу слова
-        target_time = start_time - analysis_start
+        target_time = target_split_time - analysis_start
         best_boundary = target_time
         min_distance = float('inf')
         
@@ -404,32 +678,11 @@ def split_audio_at_word_boundary_optimized(input_audio, temp_dir, max_duration_s
                 min_distance = distance
                 best_boundary = segment_end
         
-        # Удаляем временный файл
-        try:
-            temp_file.unlink()
-        except:
-            pass
-        
         # Вычисляем реальное время разбивки
         actual_split_time = analysis_start + best_boundary
-        
-        # Создаем финальную часть
-        output_file = Path(temp_dir) / f"{output_prefix}{i + 1}.wav"
-        if not output_file.exists():
-            if i == num_parts - 1:
-                # Последняя часть - до конца файла
-                part_duration = total_seconds - actual_split_time
-            else:
-                part_duration = max_duration_sec
-            
-            command = [
-                "ffmpeg", "-i", input_audio,
-                "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-                "-ss", str(actual_split_time), "-t", str(part_duration),
-                str(output_file), "-y"
-            ]
-            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        parts.append(str(output_file))
+        if not split_points or actual_split_time > split_points[-1]:
+            split_points.append(actual_split_time)
     
-    return parts
\ No newline at end of file
+    # Создаем все части одним запуском ffmpeg (или из памяти при перекрытии)
+    return cut_audio_at_points(input_audio, temp_dir, split_points, output_prefix,
+                               overlap_sec=overlap_sec, logger=logger)
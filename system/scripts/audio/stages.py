@@ -4,51 +4,489 @@
 
 import os
 import sys
-import subprocess
 import logging
-import threading
 import time
 import shutil
+import json
+import hashlib
+import contextlib
+import math
 from pathlib import Path
+import numpy as np
+import soundfile as sf
 import torch
 import torchaudio
 from demucs.apply import apply_model
 from demucs.audio import AudioFile
 from tqdm import tqdm
 
+from .utils import (
+    get_audio_duration, stream_audio_pcm, decode_audio_pcm, intermediate_format, BackgroundAudioWriter,
+    waveform_input, audio_file_path, audio_name, ensure_audio_file, audio_samples_int16, audio_sample_rate,
+    write_wav_pcm16
+)
+from .config import DEMUCS_MEMORY_BUDGET_GB, DEMUCS_STREAM_OVERLAP_SEC, PIPELINE_SAMPLE_RATE
+from .planner import DEMUCS_BYTES_PER_AUDIO_SEC
+from .cache import get_denoise_cache
+from .roles import TurnEmbeddingExtractor, RoleClusterer, speaker_embedding_model
+from .stitching import segment_sample_bounds, gather_segments
+from .managers import demucs_autocast, demucs_precision, DEMUCS_CPU_FAST_MODES
+
 # Импорт конфигурации токена
 sys.path.append(str(Path(__file__).parent.parent))
 from config import get_token, token_exists
 
-# Глобальная блокировка для диаризации (предотвращает конфликты прогресс-баров)
-DIARIZATION_LOCK = threading.Lock()
+# Источники htdemucs в порядке выхода модели
+DEMUCS_SOURCES = ['drums', 'bass', 'other', 'vocals']
+
+# Режимы шумоподавления как веса источников: любой режим - линейная комбинация стемов
+DENOISE_MODE_GAINS = {
+    'vocals': {'vocals': 1.0},
+    'no_vocals': {'drums': 1.0, 'bass': 1.0, 'other': 1.0},
+    'all': {'drums': 1.0, 'bass': 1.0, 'other': 1.0, 'vocals': 1.0},
+    'enhanced': {'drums': 0.3, 'bass': 0.3, 'other': 0.3, 'vocals': 1.0},  # Вокалы + ослабленный фон
+}
+
+# Легкий режим без нейросети: спектральный гейт с профилем шума из тихих кадров
+SPECTRAL_GATE_MODE = 'spectral_gate'
+
+# Стемы хранятся в int16 с запасом по амплитуде: код 32767 соответствует STEM_PEAK
+STEM_PEAK = 2.0
+
+def stem_gains(mode, source_names=None):
+    """
+    Веса источников для режима: имя из DENOISE_MODE_GAINS или dict {источник: вес}
+    Неизвестный режим - только вокалы (как раньше)
+    """
+    if source_names is None:
+        source_names = DEMUCS_SOURCES
+    gains = mode if isinstance(mode, dict) else DENOISE_MODE_GAINS.get(mode, DENOISE_MODE_GAINS['vocals'])
+    unknown = set(gains) - set(source_names)
+    if unknown:
+        raise ValueError(f"Unknown stems in gains: {', '.join(sorted(unknown))}")
+    return np.array([float(gains.get(name, 0.0)) for name in source_names], dtype=np.float32)
+
+def denoise_mode_label(mode):
+    """
+    Суффикс имени файла для режима (для пользовательских весов - по их значениям)
+    """
+    if isinstance(mode, dict):
+        description = ",".join(f"{name}={gain:g}" for name, gain in sorted(mode.items()))
+        return "mix_" + hashlib.sha1(description.encode('utf-8')).hexdigest()[:8]
+    # 'all' и 'enhanced' исторически пишут в *_enhanced.wav
+    return {'vocals': 'vocals', 'no_vocals': 'no_vocals', 'all': 'enhanced', 'enhanced': 'enhanced',
+            SPECTRAL_GATE_MODE: SPECTRAL_GATE_MODE}.get(mode, 'cleaned')
+
+def mix_demucs_sources(sources, mode, source_names=None):
+    """
+    Собирает результат из источников Demucs (1, 4, channels, samples) по режиму
+    source_names: model.sources - порядок источников модели (у htdemucs вокалы последние)
+    """
+    gains = torch.from_numpy(stem_gains(mode, source_names)).to(sources.device, sources.dtype)
+    return torch.tensordot(gains, sources[0], dims=1)
+
+def stems_to_int16(stems):
+    """
+    float стемы -> int16 для кэша (масштаб STEM_PEAK)
+    """
+    return np.clip(np.round(stems * (32767.0 / STEM_PEAK)), -32768, 32767).astype(np.int16)
+
+def load_stems(stems_file, meta):
+    """
+    Стемы из кэша как memmap формы (frames, sources, channels) без чтения в память
+    """
+    shape = (meta['frames'], len(meta['sources']), meta['channels'])
+    return np.memmap(str(stems_file), dtype=np.int16, mode='r', shape=shape)
+
+def render_stems_mix(stems, source_names, samplerate, output_file, mode, block_frames=1024 * 1024, collect=False):
+    """
+    Векторный микс стемов в файл режима, блоками
+    output_file=None или collect=True: результат также возвращается в stats['samples']
+    Возвращает dict: original_rms (сумма всех стемов ~ исходный сигнал), result_rms, samplerate
+    """
+    gains = stem_gains(mode, source_names) * (STEM_PEAK / 32767.0)
+    unity = np.full(len(source_names), STEM_PEAK / 32767.0, dtype=np.float32)
+    energy = {'original': 0.0, 'result': 0.0}
+
+    with BackgroundAudioWriter(output_file, samplerate, stems.shape[2], collect=collect) as out:
+        for start in range(0, len(stems), block_frames):
+            block = np.asarray(stems[start:start + block_frames], dtype=np.float32)
+            result = np.einsum('nsc,s->nc', block, gains)
+            original = np.einsum('nsc,s->nc', block, unity)
+            out.write(result)
+            energy['result'] += float(np.sum(result ** 2))
+            energy['original'] += float(np.sum(original ** 2))
+
+    values = max(1, stems.shape[0] * stems.shape[2])
+    stats = {
+        'original_rms': (energy['original'] / values) ** 0.5,
+        'result_rms': (energy['result'] / values) ** 0.5,
+        'windows': 0,
+        'samplerate': samplerate
+    }
+    if collect or output_file is None:
+        stats['samples'] = out.collected()
+    return stats
+
+def demucs_window_seconds(memory_budget_gb=None):
+    """
+    Длина окна потокового Demucs (сек), при которой пик памяти укладывается в бюджет
+    """
+    if memory_budget_gb is None:
+        memory_budget_gb = DEMUCS_MEMORY_BUDGET_GB
+    window = memory_budget_gb * 1024**3 / DEMUCS_BYTES_PER_AUDIO_SEC
+    return max(10.0, min(600.0, window))
+
+def to_output_rate(audio, samplerate, output_rate):
+    """
+    Сводит тензор (..., channels, samples) в моно на частоте output_rate (None - без изменений)
+    """
+    if output_rate is None:
+        return audio
+    audio = audio.mean(dim=-2, keepdim=True)
+    if output_rate != samplerate:
+        audio = torchaudio.functional.resample(audio, samplerate, output_rate)
+    return audio
+
+def clean_audio_with_demucs_streaming(input_audio, output_file, model, device, mode='vocals',
+                                      window_sec=None, overlap_sec=DEMUCS_STREAM_OVERLAP_SEC, logger=None,
+                                      batcher=None, stems_out=None, output_rate=None, collect=False):
+    """
+    Потоковый Demucs: модель применяется к окнам фиксированной длины, соседние окна
+    сшиваются линейным кроссфейдом (overlap-add), результат дописывается в файл по мере готовности.
+    Пик памяти зависит только от длины окна, а не от длины части.
+    batcher: DemucsBatcher - окна идут в общий батч с окнами других чанков
+    stems_out: открытый бинарный файл - туда дописываются все 4 стема (int16, frames x sources x channels)
+    output_rate: стемы каждого окна сразу сводятся в моно на этой частоте (None - частота модели)
+    output_file=None или collect=True: результат также возвращается в stats['samples']
+    Возвращает dict: original_rms, result_rms, windows, frames (кадров результата), samplerate, channels
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if window_sec is None:
+        window_sec = demucs_window_seconds()
+
+    samplerate, channels = model.samplerate, model.audio_channels
+    out_rate = output_rate or samplerate
+    out_channels = 1 if output_rate else channels
+    # Окно и перекрытие кратны шагу, при котором они переводятся в целое число кадров результата
+    step = samplerate // math.gcd(samplerate, out_rate)
+    window = int(window_sec * samplerate) // step * step
+    overlap = int(overlap_sec * samplerate) // step * step
+    hop = window - overlap
+    out_overlap = overlap * out_rate // samplerate
+    fade_in = np.linspace(0.0, 1.0, out_overlap, dtype=np.float32)[:, None, None]
+    fade_out = 1.0 - fade_in
+    gains = stem_gains(mode, model.sources)
+
+    stats = {'input_energy': 0.0, 'output_energy': 0.0, 'frames': 0, 'out_frames': 0, 'windows': 0}
+    tail = None
+
+    def separate(block):
+        """Стемы окна формы (frames, sources, channels) на выходной частоте"""
+        wav = torch.from_numpy(np.ascontiguousarray(block.T))
+        if batcher is not None:
+            sources = batcher.separate(wav)
+        else:
+            with torch.no_grad(), demucs_autocast(model, device):
+                sources = apply_model(model, wav.unsqueeze(0).to(device), device=device).float()
+        stats['windows'] += 1
+        # Края окна после передискретизации попадают в кроссфейд с почти нулевым весом
+        sources = to_output_rate(sources[0], samplerate, output_rate)
+        return sources.permute(2, 0, 1).cpu().numpy()
+
+    logger.info(f"Streaming Demucs: {window_sec:.0f}s windows, {overlap_sec:.1f}s crossfade, "
+                f"output {out_rate} Hz x{out_channels}")
+
+    with BackgroundAudioWriter(output_file, out_rate, out_channels, collect=collect) as out:
+        def write(stems):
+            result = np.tensordot(stems, gains, axes=([1], [0]))
+            out.write(result)
+            stats['output_energy'] += float(np.sum(result ** 2))
+            stats['out_frames'] += len(result)
+            if stems_out is not None:
+                stems_out.write(stems_to_int16(stems).tobytes())
+
+        def emit(stems, final):
+            nonlocal tail
+            # Кроссфейд линеен, поэтому делается по стемам - микс любого режима сшивается так же
+            if tail is not None:
+                stems[:out_overlap] = tail * fade_out + stems[:out_overlap] * fade_in
+            # Без перекрытия (overlap_sec меньше шага) окна просто стыкуются, хвост не нужен
+            if final or not out_overlap:
+                write(stems)
+                tail = None
+            else:
+                write(stems[:-out_overlap])
+                tail = stems[-out_overlap:].copy()
+
+        buffer = np.empty((0, channels), dtype=np.float32)
+        for block in stream_audio_pcm(input_audio, hop, samplerate, channels):
+            stats['input_energy'] += float(np.sum(block ** 2))
+            stats['frames'] += len(block)
+            buffer = np.concatenate([buffer, block])
+            if len(buffer) >= window:
+                emit(separate(buffer[:window]), final=False)
+                # Последние overlap кадров окна - начало следующего окна
+                buffer = buffer[hop:]
+
+        if tail is None:
+            if len(buffer):
+                emit(separate(buffer), final=True)
+        elif len(buffer) > overlap:
+            emit(separate(buffer), final=True)
+        else:
+            write(tail)
+
+    result = {
+        'original_rms': (stats['input_energy'] / max(1, stats['frames'] * channels)) ** 0.5,
+        'result_rms': (stats['output_energy'] / max(1, stats['out_frames'] * out_channels)) ** 0.5,
+        'windows': stats['windows'],
+        'frames': stats['out_frames'],
+        'samplerate': out_rate,
+        'channels': out_channels
+    }
+    if collect or output_file is None:
+        result['samples'] = out.collected()
+    return result
+
+def apply_gain_to_file(audio_file, gain, block_frames=1024 * 1024, limit=0.95):
+    """
+    Умножает файл на gain с ограничением амплитуды, читая и записывая блоками
+    """
+    audio_file = Path(audio_file)
+    temp_file = audio_file.with_name(f"{audio_file.stem}.gain{audio_file.suffix}")
+    with sf.SoundFile(str(audio_file)) as source:
+        with sf.SoundFile(str(temp_file), 'w', samplerate=source.samplerate, channels=source.channels,
+                          format=source.format, subtype=source.subtype) as target:
+            for block in source.blocks(blocksize=block_frames, dtype='float32', always_2d=True):
+                target.write(np.clip(block * gain, -limit, limit))
+    os.replace(temp_file, audio_file)
+
+def estimate_noise_profile(samples, n_fft=1024, noise_fraction=0.1):
+    """
+    Профиль шума по тихим кадрам: среднее и СКО уровня (дБ) каждой частотной полосы
+    Кадры без перекрытия с окном Ханна - та же шкала мощности, что у STFT с тем же n_fft
+    """
+    num_frames = len(samples) // n_fft
+    if num_frames == 0:
+        return None
+    frames = samples[:num_frames * n_fft].view(num_frames, n_fft)
+    energy = frames.pow(2).mean(dim=1)
+    quiet_count = max(1, int(num_frames * noise_fraction))
+    quiet = frames[torch.argsort(energy)[:quiet_count]]
+    power_db = 10 * torch.log10(torch.fft.rfft(quiet * torch.hann_window(n_fft), dim=1).abs().pow(2) + 1e-10)
+    return power_db.mean(dim=0), power_db.std(dim=0, unbiased=False)
+
+def spectral_gate(samples, noise_profile, n_fft=1024, hop=256, n_std=1.5, reduction_db=18.0,
+                  smooth_bins=3, smooth_frames=5):
+    """
+    Спектральный гейт фрагмента: полосы ниже порога шума (среднее + n_std СКО)
+    ослабляются на reduction_db; маска сглаживается по частоте и времени, чтобы
+    не было «музыкального шума». samples - 1-D тензор float32
+    """
+    window = torch.hann_window(n_fft)
+    spectrum = torch.stft(samples, n_fft, hop_length=hop, window=window, return_complex=True)
+    noise_mean, noise_std = noise_profile
+    threshold_db = (noise_mean + n_std * noise_std)[:, None]
+    power_db = 10 * torch.log10(spectrum.abs().pow(2) + 1e-10)
+
+    mask = (power_db > threshold_db).float()[None, None]
+    mask = torch.nn.functional.avg_pool2d(
+        mask, (smooth_bins, smooth_frames), stride=1,
+        padding=(smooth_bins // 2, smooth_frames // 2), count_include_pad=False
+    )[0, 0]
+    floor = 10 ** (-reduction_db / 20)
+    gain = floor + (1.0 - floor) * mask
+
+    return torch.istft(spectrum * gain, n_fft, hop_length=hop, window=window, length=len(samples))
+
+def clean_audio_with_spectral_gate(input_audio, output_file, sample_rate=PIPELINE_SAMPLE_RATE,
+                                   block_sec=60.0, n_fft=1024, hop=256, logger=None, collect=False):
+    """
+    Шумоподавление спектральным гейтом (без нейросети, только CPU): профиль шума
+    по самым тихим 10% кадров всего файла, затем гейт блоками по block_sec
+    Блоки начинаются на сетке hop и берут запас контекста с обеих сторон,
+    поэтому результат совпадает с обработкой файла целиком
+    Возвращает dict в формате потокового Demucs: original_rms, result_rms, windows, frames
+    (и samples при output_file=None или collect=True)
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    samples = torch.from_numpy(decode_audio_pcm(input_audio, sample_rate=sample_rate).astype(np.float32) / 32768.0)
+    stats = {'original_rms': 0.0, 'result_rms': 0.0, 'windows': 0, 'frames': len(samples), 'samplerate': sample_rate}
+    if len(samples) < n_fft:
+        return stats
+
+    noise_profile = estimate_noise_profile(samples, n_fft)
+    block = max(hop, int(block_sec * sample_rate) // hop * hop)
+    context = (n_fft // hop + 8) * hop  # Запас под окно STFT и сглаживание маски
+    result_energy = 0.0
+
+    with BackgroundAudioWriter(output_file, sample_rate, 1, collect=collect) as out:
+        for start in range(0, len(samples), block):
+            left = max(0, start - context)
+            end = min(len(samples), start + block)
+            right = min(len(samples), end + context)
+            segment = samples[left:right]
+            if len(segment) < n_fft:
+                cleaned = segment
+            else:
+                cleaned = spectral_gate(segment, noise_profile, n_fft, hop)
+            cleaned = cleaned[start - left:end - left]
+            result_energy += float(cleaned.pow(2).sum())
+            out.write(cleaned.numpy())
+            stats['windows'] += 1
+
+    if collect or output_file is None:
+        stats['samples'] = out.collected()
+    stats['original_rms'] = float(samples.pow(2).mean().sqrt())
+    stats['result_rms'] = (result_energy / len(samples)) ** 0.5
+    logger.info(f"Spectral gate: noise floor {float(noise_profile[0].mean()):.1f} dB, "
+                f"{stats['windows']} blocks")
+    return stats
+
+def save_intermediate(output_file, audio, samplerate):
+    """
+    Сохраняет тензор (channels, samples) в формате промежуточных файлов
+    """
+    with BackgroundAudioWriter(output_file, samplerate, audio.shape[0]) as out:
+        out.write(audio.T.numpy())
+
+def store_stems(cache, cache_key, stems_temp, model, stats, logger):
+    """
+    Переносит записанные стемы в постоянный кэш вместе с описанием (ошибки кэша не прерывают обработку)
+    """
+    try:
+        meta_temp = stems_temp.with_suffix('.json.tmp')
+        with open(meta_temp, 'w', encoding='utf-8') as f:
+            json.dump({
+                'sources': list(model.sources),
+                'samplerate': stats['samplerate'],
+                'channels': stats['channels'],
+                'frames': stats['frames'],
+                'peak': STEM_PEAK
+            }, f)
+        cache.put(cache_key, stems_temp, suffix=".i16", move=True)
+        cache.put(cache_key, meta_temp, suffix=".json", move=True)
+    except OSError as e:
+        logger.warning(f"Failed to store Demucs stems in cache: {e}")
 
-def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_manager, logger=None, mode='vocals'):
+def denoised_waveform(samples, samplerate, output_file, kept):
+    """
+    Результат шумоподавления в памяти в формате входа диаризации (см. utils.waveform_input)
+    samples: (frames, channels); kept - записан ли output_file на диск
+    """
+    return {
+        'waveform': torch.from_numpy(np.ascontiguousarray(np.asarray(samples, dtype=np.float32).T)),
+        'sample_rate': samplerate,
+        'uri': Path(output_file).stem,
+        'file': str(output_file) if kept else None
+    }
+
+def finalize_denoised(input_audio, output_file, stats, logger, in_memory=False, keep_file=True):
+    """
+    Проверки громкости результата потокового/кэшированного пути
+    Возвращает путь к результату (in_memory - dict с waveform) или исходный файл, если звук слишком тихий
+    """
+    logger.info(f"Original audio RMS: {stats['original_rms']:.6f}, "
+                f"result RMS: {stats['result_rms']:.6f} ({stats['windows']} windows)")
+    
+    # Те же проверки громкости, что и при обработке целиком
+    if stats['original_rms'] < 0.001 or stats['result_rms'] < 0.0001:
+        logger.warning("Audio is too quiet, returning original audio")
+        output_file.unlink(missing_ok=True)
+        return input_audio
+    
+    samples = stats.get('samples')
+    if stats['result_rms'] < 0.01:
+        logger.info("Normalizing audio volume")
+        gain = 0.1 / stats['result_rms']
+        if keep_file:
+            apply_gain_to_file(output_file, gain)
+        if samples is not None:
+            samples = np.clip(samples * gain, -0.95, 0.95)
+    
+    if keep_file:
+        logger.info(f"Saved: {output_file}")
+    if in_memory:
+        return denoised_waveform(samples, stats['samplerate'], output_file, keep_file)
+    return str(output_file)
+
+def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_manager, logger=None, mode='vocals',
+                                      streaming=None, memory_budget_gb=None, batched=False,
+                                      output_rate=PIPELINE_SAMPLE_RATE, in_memory=False, keep_file=True):
     """
     Оптимизированная очистка аудио с помощью Demucs с лучшим управлением памятью
-    mode: 'vocals' - только вокалы, 'no_vocals' - без вокалов, 'all' - все источники, 'enhanced' - улучшенное аудио
+    mode: 'vocals' - только вокалы, 'no_vocals' - без вокалов, 'all' - все источники, 'enhanced' - улучшенное аудио,
+          или dict {источник: вес} - пользовательский микс стемов (drums, bass, other, vocals),
+          'spectral_gate' - спектральный гейт без нейросети (быстро на CPU, для массовых материалов)
+    streaming: True - окнами с кроссфейдом (память ограничена бюджетом), False - вся часть целиком,
+               None - потоково, если часть длиннее окна для memory_budget_gb (или всегда при включенном кэше)
+    
+    При включенном кэше (enable_denoise_cache) сохраняются все 4 стема, и любой другой режим
+    для того же входа собирается из них векторным миксом без запуска модели
+    batched: окна идут через общий DemucsBatcher менеджера моделей вместе с окнами
+             других чанков (всегда потоково; бюджет памяти делится на размер батча)
+    output_rate: результат сразу сводится в моно на этой частоте (по умолчанию фиксированная частота
+                 пайплайна PIPELINE_SAMPLE_RATE), None - стерео на частоте модели.
+                 Вход читается из части как есть (16 кГц) и поднимается до частоты модели
+    in_memory: вернуть dict {'waveform', 'sample_rate', 'uri', 'file'} для передачи в диаризацию
+               без повторного чтения; keep_file=False - файл результата не пишется вовсе
+               (при ошибке или слишком тихом звуке возвращается путь к исходному файлу)
+               Повторный запуск тогда находит чанк в кэше стемов, а не по файлу результата;
+               при выключенном кэше файл пишется все равно, иначе возобновление невозможно
     """
     if logger is None:
         logger = logging.getLogger(__name__)
+    keep_file = keep_file or not in_memory or (get_denoise_cache() is None and mode != SPECTRAL_GATE_MODE)
 
     temp_dir = Path(temp_dir)
     temp_dir.mkdir(parents=True, exist_ok=True)
     
     # Создаем разные имена файлов в зависимости от режима
-    if mode == 'vocals':
-        output_file = temp_dir / f"{Path(input_audio).stem}_vocals.wav"
-    elif mode == 'no_vocals':
-        output_file = temp_dir / f"{Path(input_audio).stem}_no_vocals.wav"
-    elif mode == 'all':
-        output_file = temp_dir / f"{Path(input_audio).stem}_enhanced.wav"
-    elif mode == 'enhanced':
-        output_file = temp_dir / f"{Path(input_audio).stem}_enhanced.wav"
-    else:
-        output_file = temp_dir / f"{Path(input_audio).stem}_cleaned.wav"
+    output_file = temp_dir / f"{Path(input_audio).stem}_{denoise_mode_label(mode)}{intermediate_format()[2]}"
 
     if output_file.exists():
         logger.info(f"File already exists: {output_file}")
-        return str(output_file)
+        return waveform_input(output_file, output_rate or PIPELINE_SAMPLE_RATE) if in_memory else str(output_file)
+    target_file = output_file if keep_file else None
+
+    # Легкий режим без Demucs: спектральный гейт на CPU, результат в том же месте
+    if mode == SPECTRAL_GATE_MODE:
+        try:
+            stats = clean_audio_with_spectral_gate(input_audio, target_file, output_rate or PIPELINE_SAMPLE_RATE,
+                                                   logger=logger, collect=in_memory)
+        except Exception as e:
+            logger.error(f"Error during spectral gating: {e}")
+            output_file.unlink(missing_ok=True)
+            return input_audio
+        return finalize_denoised(input_audio, output_file, stats, logger, in_memory, keep_file)
+
+    # Постоянный кэш стемов: ключ не зависит от режима - любой режим собирается из тех же стемов
+    cache = get_denoise_cache() if streaming is not False else None
+    cache_key = None
+    if cache is not None:
+        try:
+            cache_key = cache.make_key(
+                input_audio, model="htdemucs", kind="stems", batched=batched,
+                memory_budget_gb=memory_budget_gb if memory_budget_gb is not None else DEMUCS_MEMORY_BUDGET_GB,
+                overlap_sec=DEMUCS_STREAM_OVERLAP_SEC, output_rate=output_rate,
+                precision=demucs_precision(gpu_manager.device)
+            )
+            stems_file = cache.get(cache_key, suffix=".i16")
+            meta_file = cache.get(cache_key, suffix=".json")
+            if stems_file is not None and meta_file is not None:
+                with open(meta_file, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                logger.info(f"Demucs stem cache hit: {Path(input_audio).name}, mixing mode {mode}")
+                stats = render_stems_mix(load_stems(stems_file, meta), meta['sources'],
+                                         meta['samplerate'], target_file, mode, collect=in_memory)
+                return finalize_denoised(input_audio, output_file, stats, logger, in_memory, keep_file)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Denoise cache unavailable: {e}")
+            cache_key = None
 
     try:
         # Проверяем память перед обработкой
@@ -64,6 +502,38 @@ def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_
         # Получаем кэшированную модель
         model = model_manager.get_demucs_model()
         
+        batcher = model_manager.get_demucs_batcher() if batched else None
+        if batcher is not None:
+            # В батче одновременно batch_size окон - каждое получает свою долю бюджета
+            budget = memory_budget_gb if memory_budget_gb is not None else DEMUCS_MEMORY_BUDGET_GB
+            window_sec = demucs_window_seconds(budget / batcher.batch_size)
+            streaming = True
+        else:
+            window_sec = demucs_window_seconds(memory_budget_gb)
+        if streaming is None:
+            streaming = cache_key is not None or get_audio_duration(input_audio) > window_sec
+        
+        if streaming:
+            stems_temp = cache.temp_path(cache_key, suffix=".i16") if cache_key is not None else None
+            try:
+                with open(stems_temp, 'wb') if stems_temp else contextlib.nullcontext() as stems_out:
+                    stats = clean_audio_with_demucs_streaming(
+                        input_audio, target_file, model, device, mode=mode, window_sec=window_sec, logger=logger,
+                        batcher=batcher, stems_out=stems_out, output_rate=output_rate, collect=in_memory
+                    )
+            except Exception as e:
+                logger.error(f"Error during streaming Demucs processing: {e}")
+                output_file.unlink(missing_ok=True)
+                if stems_temp:
+                    stems_temp.unlink(missing_ok=True)
+                return input_audio
+            
+            if stems_temp:
+                store_stems(cache, cache_key, stems_temp, model, stats, logger)
+            
+            gpu_manager.cleanup()
+            return finalize_denoised(input_audio, output_file, stats, logger, in_memory, keep_file)
+        
         # Читаем аудио файл с валидацией
         logger.info(f"Reading audio file: {input_audio}")
         try:
@@ -102,8 +572,8 @@ def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_
         logger.info("Applying Demucs model...")
         
         try:
-            with torch.no_grad():
-                sources = apply_model(model, wav, device=device)
+            with torch.no_grad(), demucs_autocast(model, device):
+                sources = apply_model(model, wav, device=device).float()
             
             # Проверяем результат
             if sources is None or sources.numel() == 0:
@@ -113,28 +583,8 @@ def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_
             logger.info(f"Demucs sources shape: {sources.shape}")
             
             # Обрабатываем результат в зависимости от режима
-            if mode == 'vocals':
-                # Только вокалы (индекс 0)
-                result = sources[0, 0]
-                logger.info("Extracting vocals only")
-            elif mode == 'no_vocals':
-                # Все кроме вокалов (индексы 1, 2, 3)
-                result = sources[0, 1] + sources[0, 2] + sources[0, 3]
-                logger.info("Extracting non-vocal components")
-            elif mode == 'all':
-                # Все источники вместе
-                result = sources[0, 0] + sources[0, 1] + sources[0, 2] + sources[0, 3]
-                logger.info("Combining all sources")
-            elif mode == 'enhanced':
-                # Улучшенное аудио: вокалы + немного остального
-                vocals = sources[0, 0]
-                other = (sources[0, 1] + sources[0, 2] + sources[0, 3]) * 0.3  # Уменьшаем фоновые звуки
-                result = vocals + other
-                logger.info("Creating enhanced audio (vocals + reduced background)")
-            else:
-                # По умолчанию - вокалы
-                result = sources[0, 0]
-                logger.info("Default mode: extracting vocals")
+            result = mix_demucs_sources(sources, mode, model.sources)
+            logger.info(f"Mixed sources for mode: {mode}")
             
             # Проверяем уровень громкости результата
             result_rms = torch.sqrt(torch.mean(result**2))
@@ -154,10 +604,14 @@ def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_
                 # Ограничиваем максимальную громкость
                 result = torch.clamp(result, -0.95, 0.95)
             
-            # Перемещаем на CPU и сохраняем
-            result = result.cpu()
-            torchaudio.save(str(output_file), result, model.samplerate)
-            logger.info(f"Saved: {output_file}")
+            # Перемещаем на CPU и сохраняем на частоте следующих этапов
+            result = to_output_rate(result.cpu(), model.samplerate, output_rate)
+            if keep_file:
+                save_intermediate(output_file, result, output_rate or model.samplerate)
+                logger.info(f"Saved: {output_file}")
+            if in_memory:
+                memory_result = denoised_waveform(result.numpy().T, output_rate or model.samplerate,
+                                                  output_file, keep_file)
 
         except Exception as e:
             logger.error(f"Error during Demucs processing: {e}")
@@ -171,21 +625,15 @@ def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_
                         sources = apply_model(model_cpu, wav_cpu, device=torch.device("cpu"))
                     
                     # Обрабатываем результат
-                    if mode == 'vocals':
-                        result = sources[0, 0]
-                    elif mode == 'no_vocals':
-                        result = sources[0, 1] + sources[0, 2] + sources[0, 3]
-                    elif mode == 'all':
-                        result = sources[0, 0] + sources[0, 1] + sources[0, 2] + sources[0, 3]
-                    elif mode == 'enhanced':
-                        vocals = sources[0, 0]
-                        other = (sources[0, 1] + sources[0, 2] + sources[0, 3]) * 0.3
-                        result = vocals + other
-                    else:
-                        result = sources[0, 0]
+                    result = mix_demucs_sources(sources, mode, model.sources)
+                    result = to_output_rate(result, model.samplerate, output_rate)
                     
-                    torchaudio.save(str(output_file), result, model.samplerate)
-                    logger.info(f"Saved with CPU: {output_file}")
+                    if keep_file:
+                        save_intermediate(output_file, result, output_rate or model.samplerate)
+                        logger.info(f"Saved with CPU: {output_file}")
+                    if in_memory:
+                        memory_result = denoised_waveform(result.numpy().T, output_rate or model.samplerate,
+                                                          output_file, keep_file)
                 except Exception as e2:
                     logger.error(f"CPU processing also failed: {e2}")
                     return input_audio
@@ -200,61 +648,166 @@ def clean_audio_with_demucs_optimized(input_audio, temp_dir, model_manager, gpu_
             del result
         gpu_manager.cleanup()
         
-        return str(output_file)
+        return memory_result if in_memory else str(output_file)
         
     except Exception as e:
         logger.error(f"Error during audio cleaning: {e}")
         return input_audio
 
-def diarize_with_pyannote_optimized(input_audio, output_dir, min_segment_duration=0.1, 
-                                   chunk_info=None, model_manager=None, gpu_manager=None, logger=None):
+def benchmark_demucs_precision(input_audio, model_manager, seconds=30.0, modes=DEMUCS_CPU_FAST_MODES, logger=None):
     """
-    Оптимизированная диаризация спикеров с организацией по папкам и метками времени
-    chunk_info: dict с информацией о чанке (start_time, end_time, chunk_number)
+    Сравнивает ускоренные режимы CPU-вывода Demucs с fp32 на фрагменте файла
+    Возвращает список dict по режимам: precision, seconds, rtf, speedup,
+    snr_db (стемы режима относительно fp32), max_abs_diff, vocals_snr_db
     """
     if logger is None:
         logger = logging.getLogger(__name__)
-    
-    # Проверяем доступность токена
+
+    device = torch.device("cpu")
+    reference_model = model_manager.get_demucs_model("fp32").cpu()
+    samples = decode_audio_pcm(input_audio, sample_rate=reference_model.samplerate,
+                               channels=reference_model.audio_channels, duration=seconds)
+    mix = torch.from_numpy(samples.astype(np.float32).T / 32768.0).unsqueeze(0)
+    audio_seconds = mix.shape[-1] / reference_model.samplerate
+    vocals = list(reference_model.sources).index('vocals')
+
+    def run(model):
+        stage_start = time.time()
+        # shifts=0: без случайного сдвига входа, иначе разница режимов смешивается с джиттером
+        with torch.no_grad(), demucs_autocast(model, device):
+            sources = apply_model(model, mix, shifts=0, device=device).float()
+        return sources, time.time() - stage_start
+
+    def snr_db(reference, estimate):
+        noise = torch.sum((reference - estimate) ** 2).item()
+        return 10 * math.log10(torch.sum(reference ** 2).item() / max(noise, 1e-12))
+
+    reference, reference_time = run(reference_model)
+    results = [{'precision': 'fp32', 'seconds': reference_time, 'rtf': reference_time / audio_seconds,
+                'speedup': 1.0, 'snr_db': float('inf'), 'max_abs_diff': 0.0, 'vocals_snr_db': float('inf')}]
+
+    for precision in modes:
+        sources, elapsed = run(model_manager.get_demucs_model(precision))
+        results.append({
+            'precision': precision,
+            'seconds': elapsed,
+            'rtf': elapsed / audio_seconds,
+            'speedup': reference_time / elapsed,
+            'snr_db': snr_db(reference, sources),
+            'max_abs_diff': torch.max(torch.abs(reference - sources)).item(),
+            'vocals_snr_db': snr_db(reference[:, vocals], sources[:, vocals])
+        })
+        logger.info(f"Demucs {precision}: {elapsed:.1f}s for {audio_seconds:.0f}s of audio, "
+                    f"speedup x{results[-1]['speedup']:.2f}, SNR vs fp32 {results[-1]['snr_db']:.1f} dB")
+
+    return results
+
+def get_diarization_token(logger):
+    """
+    Токен HuggingFace для диаризации или None (с подсказкой в лог)
+    """
     if not token_exists():
         logger.warning("HuggingFace token file not found. Skipping diarization.")
         logger.info("To enable diarization, run: setup_diarization.bat")
-        return input_audio
+        return None
     
     token = get_token()
     if not token:
         logger.warning("HuggingFace token is empty. Skipping diarization.")
         logger.info("To enable diarization, run: setup_diarization.bat")
-        return input_audio
+        return None
+    return token
+
+def run_diarization_pipeline(input_audio, token, model_manager=None, gpu_manager=None, logger=None, pipeline=None,
+                             **options):
+    """
+    Запускает пайплайн pyannote и возвращает аннотацию
+    pipeline: уже загруженный пайплайн для вызова без менеджера моделей
+    options: параметры пайплайна (return_embeddings=True - кортеж (аннотация, центроиды спикеров))
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    
+    # Аудио передается в памяти: pyannote не перечитывает и не передискретизирует файл
+    audio = waveform_input(input_audio)
+    logger.info("Executing diarization...")
+    
+    # Общий сервис менеджера: чанки из разных потоков делят батчи моделей и один индикатор прогресса
+    if model_manager:
+        return model_manager.get_diarization_service(token).diarize(audio, **options)
+    
+    from pyannote.audio.pipelines.utils.hook import ProgressHook
+    if pipeline is None:
+        from pyannote.audio import Pipeline
+        pipeline = Pipeline.from_pretrained(
+            "pyannote/speaker-diarization-3.1",
+            use_auth_token=token
+        )
+        if gpu_manager and gpu_manager.device.type == "cuda":
+            pipeline = pipeline.to(gpu_manager.device)
+    with ProgressHook() as hook:
+        return pipeline(audio, hook=hook, **options)
 
+def diarize_chunk_turns(input_audio, model_manager=None, gpu_manager=None, logger=None):
+    """
+    Диаризация чанка без записи файлов спикеров (для последующей сшивки чанков)
+    Возвращает dict {'turns': список (start, end, speaker) в секундах от начала чанка,
+    'embeddings': {speaker: центроид эмбеддингов}} или None, если диаризация недоступна
+    или завершилась ошибкой. Центроиды нужны сшивке для спикеров, молчащих в перекрытии
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    
+    token = get_diarization_token(logger)
+    if not token:
+        return None
+    
+    try:
+        diarization, centroids = run_diarization_pipeline(
+            input_audio, token, model_manager, gpu_manager, logger, return_embeddings=True
+        )
+        turns = [(turn.start, turn.end, speaker)
+                 for turn, _, speaker in diarization.itertracks(yield_label=True)]
+        # Центроиды идут в порядке diarization.labels(); у спикеров без эмбеддинга - NaN
+        embeddings = {}
+        if centroids is not None:
+            for speaker, centroid in zip(diarization.labels(), np.asarray(centroids, dtype=np.float32)):
+                if np.all(np.isfinite(centroid)) and np.any(centroid):
+                    embeddings[speaker] = centroid
+        logger.info(f"Diarization completed: {len(turns)} turns, "
+                    f"{len(set(t[2] for t in turns))} speakers in {audio_name(input_audio)}")
+        if gpu_manager:
+            gpu_manager.cleanup()
+        return {'turns': turns, 'embeddings': embeddings}
+    except Exception as e:
+        logger.error(f"Error during diarization: {e}")
+        return None
+
+def diarize_with_pyannote_optimized(input_audio, output_dir, min_segment_duration=0.1, 
+                                   chunk_info=None, model_manager=None, gpu_manager=None, logger=None):
+    """
+    Оптимизированная диаризация спикеров с организацией по папкам и метками времени
+    chunk_info: dict с информацией о чанке (start_time, end_time, chunk_number)
+    input_audio: путь или dict в памяти (результат clean_audio_with_demucs_optimized(in_memory=True))
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    
     # Создаем выходную папку
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
     
-    logger.info(f"Starting diarization of file: {input_audio}")
+    token = get_diarization_token(logger)
+    if not token:
+        return ensure_audio_file(input_audio, output_dir)
+
+    input_audio = waveform_input(input_audio)
+    logger.info(f"Starting diarization of file: {audio_name(input_audio)}")
     if chunk_info:
         logger.info(f"Chunk info: {chunk_info}")
     
     try:
-        # Получаем кэшированный пайплайн
-        if model_manager:
-            pipeline = model_manager.get_diarization_pipeline(token)
-        else:
-            from pyannote.audio import Pipeline
-            pipeline = Pipeline.from_pretrained(
-                "pyannote/speaker-diarization-3.1",
-                use_auth_token=token
-            )
-            if gpu_manager and gpu_manager.device.type == "cuda":
-                pipeline = pipeline.to(gpu_manager.device)
-        
-        # Выполняем диаризацию с блокировкой для предотвращения конфликтов прогресс-баров
-        logger.info("Executing diarization...")
-        from pyannote.audio.pipelines.utils.hook import ProgressHook
-        
-        with DIARIZATION_LOCK:
-            with ProgressHook() as hook:
-                diarization = pipeline(input_audio, hook=hook)
+        diarization = run_diarization_pipeline(input_audio, token, model_manager, gpu_manager, logger)
         
         # Анализируем результаты
         speakers = set()
@@ -267,11 +820,11 @@ def diarize_with_pyannote_optimized(input_audio, output_dir, min_segment_duratio
         logger.info(f"Diarization completed! Speakers: {len(speakers)}, Duration: {total_duration:.2f}s")
         
         # Сохраняем результаты RTTM
-        rttm_file = output_dir / f"{Path(input_audio).stem}_diarization.rttm"
+        rttm_file = output_dir / f"{audio_name(input_audio)}_diarization.rttm"
         with open(rttm_file, 'w') as f:
             diarization.write_rttm(f)
         
-        # Создаем файлы спикеров с метками времени
+        # Создаем файлы спикеров с метками времени (прямо из аудио в памяти)
         speaker_files = create_speaker_segments_with_metadata(
             input_audio, diarization, output_dir, min_segment_duration, 
             chunk_info, logger
@@ -281,7 +834,7 @@ def diarize_with_pyannote_optimized(input_audio, output_dir, min_segment_duratio
         if gpu_manager:
             gpu_manager.cleanup()
         
-        return speaker_files if speaker_files else [input_audio]
+        return speaker_files if speaker_files else [ensure_audio_file(input_audio, output_dir)]
         
     except Exception as e:
         logger.error(f"Error during diarization: {e}")
@@ -289,12 +842,16 @@ def diarize_with_pyannote_optimized(input_audio, output_dir, min_segment_duratio
         logger.info("To fix diarization issues:")
         logger.info("1. Run: setup_diarization.bat")
         logger.info("2. Or run: test_diarization_token.bat")
-        return input_audio
+        return ensure_audio_file(input_audio, output_dir)
 
 def create_speaker_segments_with_metadata(input_audio, diarization_result, output_dir, 
-                                        min_segment_duration=0.3, chunk_info=None, logger=None):
+                                        min_segment_duration=0.3, chunk_info=None, logger=None,
+                                        sample_rate=None):
     """
     Создание сегментов спикеров с метками времени и организацией по папкам
+    input_audio: путь или dict в памяти; источник декодируется один раз, сегменты спикера
+    собираются индексированием отсчетов и пишутся одним WAV (длительность - по числу отсчетов)
+    sample_rate: частота файлов спикеров (моно PCM16); None - частота входа, иначе вход передискретизируется
     """
     if logger is None:
         logger = logging.getLogger(__name__)
@@ -304,8 +861,10 @@ def create_speaker_segments_with_metadata(input_audio, diarization_result, outpu
     
     speaker_files = []
     speaker_segments = {}
+    source_name = audio_name(input_audio)
+    source_file = audio_file_path(input_audio)
     
-    logger.info(f"Creating speaker segments from file: {input_audio}")
+    logger.info(f"Creating speaker segments from file: {source_file or source_name}")
     
     # Группируем сегменты по спикерам
     for turn, _, speaker in diarization_result.itertracks(yield_label=True):
@@ -331,6 +890,11 @@ def create_speaker_segments_with_metadata(input_audio, diarization_result, outpu
         speaker_segments[speaker].append(segment_info)
     
     logger.info(f"Found {len(speaker_segments)} speakers with segments")
+    if not speaker_segments:
+        return speaker_files
+    
+    sample_rate = sample_rate or audio_sample_rate(input_audio)
+    samples = audio_samples_int16(input_audio, sample_rate)
     
     # Создаем файлы для каждого спикера
     for speaker, segments in speaker_segments.items():
@@ -344,10 +908,10 @@ def create_speaker_segments_with_metadata(input_audio, diarization_result, outpu
         speaker_dir.mkdir(exist_ok=True)
         
         # Создаем файл с метками времени
-        metadata_file = speaker_dir / f"metadata_{Path(input_audio).stem}.txt"
+        metadata_file = speaker_dir / f"metadata_{source_name}.txt"
         with open(metadata_file, 'w', encoding='utf-8') as f:
             f.write(f"Speaker: {speaker}\n")
-            f.write(f"Source file: {Path(input_audio).name}\n")
+            f.write(f"Source file: {Path(source_file).name if source_file else source_name}\n")
             if chunk_info:
                 f.write(f"Chunk: {chunk_info.get('chunk_number', 'unknown')}\n")
                 f.write(f"Chunk start time: {chunk_info.get('start_time', 0):.2f}s\n")
@@ -361,152 +925,18 @@ def create_speaker_segments_with_metadata(input_audio, diarization_result, outpu
                 f.write(f"{i:3d}. {segment['start']:8.2f}s - {segment['end']:8.2f}s "
                        f"(duration: {segment['duration']:6.2f}s)\n")
         
-        # Создаем аудиофайл для спикера
-        speaker_file = speaker_dir / f"speaker_{speaker}_{Path(input_audio).stem}.wav"
-        segments_list_file = speaker_dir / f"segments_{speaker}_{Path(input_audio).stem}.txt"
-        
-        # Метод 1: Создаем файл списка сегментов для FFmpeg concat
-        with open(segments_list_file, 'w', encoding='utf-8') as f:
-            for segment in segments:
-                # Используем абсолютный путь для надежности
-                abs_input_path = str(Path(input_audio).absolute())
-                f.write(f"file '{abs_input_path}'\n")
-                f.write(f"inpoint {segment['start']:.3f}\n")
-                f.write(f"outpoint {segment['end']:.3f}\n")
-        
-        # Метод 1: Пробуем FFmpeg concat с copy
-        success = False
-        try:
-            command = [
-                "ffmpeg", "-f", "concat", "-safe", "0",
-                "-i", str(segments_list_file),
-                "-c", "copy", str(speaker_file),
-                "-y"
-            ]
-            
-            result = subprocess.run(command, capture_output=True, text=True, timeout=300)
-            
-            if result.returncode == 0 and speaker_file.exists():
-                from .utils import get_mp3_duration
-                duration_str = get_mp3_duration(str(speaker_file))
-                time_parts = duration_str.split(":")
-                total_duration = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
-                
-                logger.info(f"Created speaker file {speaker}: {speaker_file.name} "
-                           f"({total_duration}s, {len(segments)} segments)")
-                speaker_files.append(str(speaker_file))
-                success = True
-                
-        except subprocess.CalledProcessError as e:
-            logger.warning(f"FFmpeg concat with copy failed for {speaker}: {e}")
-            if e.stderr:
-                logger.debug(f"FFmpeg stderr: {e.stderr}")
-        except subprocess.TimeoutExpired:
-            logger.warning(f"FFmpeg concat timeout for {speaker}")
-        except Exception as e:
-            logger.warning(f"FFmpeg concat error for {speaker}: {e}")
-        
-        # Метод 2: Если concat не сработал, пробуем с перекодированием
-        if not success:
-            try:
-                command = [
-                    "ffmpeg", "-f", "concat", "-safe", "0",
-                    "-i", str(segments_list_file),
-                    "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-                    str(speaker_file), "-y"
-                ]
-                
-                result = subprocess.run(command, capture_output=True, text=True, timeout=300)
-                
-                if result.returncode == 0 and speaker_file.exists():
-                    from .utils import get_mp3_duration
-                    duration_str = get_mp3_duration(str(speaker_file))
-                    time_parts = duration_str.split(":")
-                    total_duration = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
-                    
-                    logger.info(f"Created speaker file {speaker} (recode): {speaker_file.name} "
-                               f"({total_duration}s, {len(segments)} segments)")
-                    speaker_files.append(str(speaker_file))
-                    success = True
-                    
-            except subprocess.CalledProcessError as e:
-                logger.warning(f"FFmpeg concat with recode failed for {speaker}: {e}")
-                if e.stderr:
-                    logger.debug(f"FFmpeg stderr: {e.stderr}")
-            except subprocess.TimeoutExpired:
-                logger.warning(f"FFmpeg concat recode timeout for {speaker}")
-            except Exception as e:
-                logger.warning(f"FFmpeg concat recode error for {speaker}: {e}")
-        
-        # Метод 3: Если concat не работает, создаем отдельные файлы и объединяем
-        if not success and len(segments) > 0:
-            try:
-                logger.info(f"Trying alternative method for {speaker}: creating individual segments")
-                
-                # Создаем временную папку для сегментов
-                temp_segments_dir = speaker_dir / "temp_segments"
-                temp_segments_dir.mkdir(exist_ok=True)
-                
-                segment_files = []
-                
-                # Создаем отдельные файлы для каждого сегмента
-                for i, segment in enumerate(segments):
-                    segment_file = temp_segments_dir / f"segment_{i:04d}.wav"
-                    
-                    command = [
-                        "ffmpeg", "-i", str(input_audio),
-                        "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-                        "-ss", str(segment['start']), "-t", str(segment['duration']),
-                        str(segment_file), "-y"
-                    ]
-                    
-                    result = subprocess.run(command, capture_output=True, text=True, timeout=60)
-                    
-                    if result.returncode == 0 and segment_file.exists():
-                        segment_files.append(str(segment_file))
-                
-                # Объединяем сегменты
-                if segment_files:
-                    concat_list_file = temp_segments_dir / "concat_list.txt"
-                    with open(concat_list_file, 'w', encoding='utf-8') as f:
-                        for segment_file in segment_files:
-                            f.write(f"file '{segment_file}'\n")
-                    
-                    command = [
-                        "ffmpeg", "-f", "concat", "-safe", "0",
-                        "-i", str(concat_list_file),
-                        "-c", "copy", str(speaker_file),
-                        "-y"
-                    ]
-                    
-                    result = subprocess.run(command, capture_output=True, text=True, timeout=300)
-                    
-                    if result.returncode == 0 and speaker_file.exists():
-                        from .utils import get_mp3_duration
-                        duration_str = get_mp3_duration(str(speaker_file))
-                        time_parts = duration_str.split(":")
-                        total_duration = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
-                        
-                        logger.info(f"Created speaker file {speaker} (alternative): {speaker_file.name} "
-                                   f"({total_duration}s, {len(segments)} segments)")
-                        speaker_files.append(str(speaker_file))
-                        success = True
-                
-                # Очищаем временные файлы
-                import shutil
-                if temp_segments_dir.exists():
-                    shutil.rmtree(temp_segments_dir)
-                    
-            except Exception as e:
-                logger.error(f"Alternative method failed for {speaker}: {e}")
-        
-        # Если все методы не сработали
-        if not success:
-            logger.error(f"Failed to create speaker file {speaker} after trying all methods")
+        # Создаем аудиофайл для спикера: точные по отсчетам срезы одного буфера
+        speaker_file = speaker_dir / f"speaker_{speaker}_{source_name}.wav"
+        bounds = segment_sample_bounds([(s['start'], s['end']) for s in segments], sample_rate, len(samples))
+        audio = gather_segments(samples, bounds)
+        if len(audio) == 0:
+            logger.error(f"Failed to create speaker file {speaker}: segments are outside the audio")
+            continue
         
-        # Очищаем временный файл списка
-        if segments_list_file.exists():
-            segments_list_file.unlink()
+        write_wav_pcm16(speaker_file, audio, sample_rate)
+        logger.info(f"Created speaker file {speaker}: {speaker_file.name} "
+                   f"({len(audio) / sample_rate:.1f}s, {len(segments)} segments)")
+        speaker_files.append(str(speaker_file))
     
     logger.info(f"Created {len(speaker_files)} speaker files in {len(speaker_segments)} folders")
     return speaker_files
@@ -601,27 +1031,32 @@ def diarize_with_role_classification(input_audio, output_dir, min_segment_durati
     """
     Диаризация с автоматическим разделением на роли (нарратор + персонажи)
     Автоматически определяет количество ролей и объединяет сегменты каждой роли
+    input_audio: путь или dict в памяти (результат clean_audio_with_demucs_optimized(in_memory=True))
     """
     if logger is None:
         logger = logging.getLogger(__name__)
     
+    # Создаем выходную папку (туда же пишется аудио в памяти, если диаризация пропущена)
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
     # Проверяем доступность токена
     if not token_exists():
         logger.warning("HuggingFace token file not found. Skipping diarization.")
         logger.info("To enable diarization, run: setup_diarization.bat")
-        return input_audio
+        return ensure_audio_file(input_audio, output_dir)
     
     token = get_token()
     if not token:
         logger.warning("HuggingFace token is empty. Skipping diarization.")
         logger.info("To enable diarization, run: setup_diarization.bat")
-        return input_audio
-
-    # Создаем выходную папку
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
+        return ensure_audio_file(input_audio, output_dir)
     
-    logger.info(f"Starting role-based diarization of file: {input_audio}")
+    # Файл декодируется один раз: пайплайн, эмбеддинги и файлы ролей работают с waveform в памяти
+    input_audio = waveform_input(input_audio)
+    source_file = audio_file_path(input_audio)
+    source_name = Path(source_file).name if source_file else audio_name(input_audio)
+    logger.info(f"Starting role-based diarization of file: {audio_name(input_audio)}")
     if chunk_info:
         logger.info(f"Chunk info: {chunk_info}")
     
@@ -639,94 +1074,49 @@ def diarize_with_role_classification(input_audio, output_dir, min_segment_durati
                 pipeline = pipeline.to(gpu_manager.device)
         
         # Выполняем диаризацию
-        logger.info("Executing diarization...")
-        from pyannote.audio.pipelines.utils.hook import ProgressHook
-        
-        with DIARIZATION_LOCK:
-            with ProgressHook() as hook:
-                diarization = pipeline(input_audio, hook=hook)
+        diarization = run_diarization_pipeline(input_audio, token, model_manager, gpu_manager, logger, pipeline)
         
-        # Собираем сегменты и получаем эмбеддинги
-        segments = []
-        embeddings = []
+        # Реплики нужной длительности; эмбеддинги - одним батчевым проходом модели пайплайна
+        segments = [
+            {
+                'start': turn.start,
+                'end': turn.end,
+                'duration': turn.end - turn.start,
+                'speaker': speaker,
+                'original_speaker': speaker
+            }
+            for turn, _, speaker in diarization.itertracks(yield_label=True)
+            if not (min_segment_duration > 0 and turn.end - turn.start < min_segment_duration)
+        ]
         
         logger.info("Extracting embeddings for role classification...")
+        extractor = TurnEmbeddingExtractor(
+            speaker_embedding_model(pipeline, token, gpu_manager.device if gpu_manager else None)
+        )
+        embeddings = extractor.extract(input_audio, [(s['start'], s['end']) for s in segments], logger)
         
-        for turn, _, speaker in diarization.itertracks(yield_label=True):
-            start_time = turn.start
-            end_time = turn.end
-            duration = end_time - start_time
-            
-            # Проверяем минимальную длительность
-            if min_segment_duration > 0 and duration < min_segment_duration:
-                continue
-            
-            # Получаем эмбеддинг для сегмента
-            try:
-                # Используем метод get_embedding если доступен
-                if hasattr(pipeline, 'get_embedding'):
-                    emb = pipeline.get_embedding(input_audio, segment=turn)
-                else:
-                    # Альтернативный способ получения эмбеддинга
-                    from pyannote.audio import Audio
-                    audio = Audio(sample_rate=16000, mono=True)
-                    waveform, sample_rate = audio.crop(input_audio, segment=turn)
-                    
-                    # Используем модель эмбеддингов
-                    from pyannote.audio.models import SegmentationModel
-                    model = SegmentationModel.from_pretrained("pyannote/speaker-diarization-3.1", use_auth_token=token)
-                    if gpu_manager and gpu_manager.device.type == "cuda":
-                        model = model.to(gpu_manager.device)
-                    
-                    with torch.no_grad():
-                        emb = model(waveform.unsqueeze(0)).mean(dim=1).squeeze().cpu().numpy()
-                
-                segments.append({
-                    'start': start_time,
-                    'end': end_time,
-                    'duration': duration,
-                    'speaker': speaker,
-                    'original_speaker': speaker
-                })
-                embeddings.append(emb)
-                
-            except Exception as e:
-                logger.warning(f"Failed to get embedding for segment {start_time:.2f}-{end_time:.2f}: {e}")
-                continue
+        # Реплики короче минимума модели дают NaN
+        valid = ~np.isnan(embeddings).any(axis=1)
+        if not valid.all():
+            logger.warning(f"Skipped {int((~valid).sum())} segments too short for embeddings")
+        segments = [segment for segment, ok in zip(segments, valid) if ok]
+        embeddings = embeddings[valid]
         
         if not segments:
             logger.warning("No valid segments found for role classification")
-            return input_audio
+            return ensure_audio_file(input_audio, output_dir)
         
         logger.info(f"Extracted {len(segments)} segments with embeddings")
         
-        # Автоматически определяем количество ролей
-        # Минимум 2 (нарратор + персонаж), максимум 10
-        n_segments = len(segments)
-        n_roles = min(max(2, n_segments // 5), 10)  # Примерно 5 сегментов на роль
-        
-        logger.info(f"Clustering {len(segments)} segments into {n_roles} roles...")
+        # Число ролей (2-10) выбирается по силуэту; кластеризация косинусная и батчевая
+        logger.info(f"Clustering {len(segments)} segments into roles...")
         
-        # Кластеризация эмбеддингов
         try:
-            import numpy as np
-            from sklearn.cluster import KMeans
-            from sklearn.preprocessing import StandardScaler
-            
-            # Подготавливаем эмбеддинги
-            embeddings_array = np.vstack(embeddings)
-            
-            # Нормализуем эмбеддинги
-            scaler = StandardScaler()
-            embeddings_scaled = scaler.fit_transform(embeddings_array)
-            
-            # Кластеризация
-            kmeans = KMeans(n_clusters=n_roles, random_state=42, n_init='auto')
-            role_labels = kmeans.fit_predict(embeddings_scaled)
+            role_labels, n_roles = RoleClusterer().fit_predict(embeddings, logger=logger)
             
             # Назначаем роли сегментам
-            for i, segment in enumerate(segments):
-                segment['role'] = f"role_{role_labels[i]:02d}"
+            for segment, label in zip(segments, role_labels):
+                segment['role'] = f"role_{label:02d}"
             
             logger.info(f"Successfully classified segments into {n_roles} roles")
             
@@ -757,6 +1147,7 @@ def diarize_with_role_classification(input_audio, output_dir, min_segment_durati
         
         # Создаем файлы для каждой роли
         role_files = []
+        samples = audio_samples_int16(input_audio, PIPELINE_SAMPLE_RATE)
         
         for role, segs in role_segments.items():
             if not segs:
@@ -778,82 +1169,25 @@ def diarize_with_role_classification(input_audio, output_dir, min_segment_durati
             
             output_file = output_dir / output_filename
             
-            # Создаем файл списка сегментов для FFmpeg
-            segments_list_file = output_dir / f"segments_{role}.txt"
-            
-            with open(segments_list_file, 'w', encoding='utf-8') as f:
-                for segment in segs:
-                    abs_input_path = str(Path(input_audio).absolute())
-                    f.write(f"file '{abs_input_path}'\n")
-                    f.write(f"inpoint {segment['start']:.3f}\n")
-                    f.write(f"outpoint {segment['end']:.3f}\n")
-            
-            # Создаем аудиофайл с помощью FFmpeg
-            success = False
-            try:
-                command = [
-                    "ffmpeg", "-f", "concat", "-safe", "0",
-                    "-i", str(segments_list_file),
-                    "-c", "copy", str(output_file),
-                    "-y"
-                ]
-                
-                result = subprocess.run(command, capture_output=True, text=True, timeout=300)
-                
-                if result.returncode == 0 and output_file.exists():
-                    from .utils import get_mp3_duration
-                    duration_str = get_mp3_duration(str(output_file))
-                    time_parts = duration_str.split(":")
-                    total_duration = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
-                    
-                    logger.info(f"Created {role_name} file: {output_filename} "
-                               f"({total_duration}s, {len(segs)} segments)")
-                    role_files.append(str(output_file))
-                    success = True
-                    
-            except subprocess.CalledProcessError as e:
-                logger.warning(f"FFmpeg concat failed for {role_name}: {e}")
-            except subprocess.TimeoutExpired:
-                logger.warning(f"FFmpeg timeout for {role_name}")
-            except Exception as e:
-                logger.warning(f"FFmpeg error for {role_name}: {e}")
-            
-            # Если concat не сработал, пробуем с перекодированием
-            if not success:
-                try:
-                    command = [
-                        "ffmpeg", "-f", "concat", "-safe", "0",
-                        "-i", str(segments_list_file),
-                        "-vn", "-acodec", "pcm_s16le", "-ar", "16000", "-ac", "1",
-                        str(output_file), "-y"
-                    ]
-                    
-                    result = subprocess.run(command, capture_output=True, text=True, timeout=300)
-                    
-                    if result.returncode == 0 and output_file.exists():
-                        from .utils import get_mp3_duration
-                        duration_str = get_mp3_duration(str(output_file))
-                        time_parts = duration_str.split(":")
-                        total_duration = int(time_parts[0]) * 3600 + int(time_parts[1]) * 60 + int(time_parts[2])
-                        
-                        logger.info(f"Created {role_name} file (recode): {output_filename} "
-                                   f"({total_duration}s, {len(segs)} segments)")
-                        role_files.append(str(output_file))
-                        success = True
-                        
-                except Exception as e:
-                    logger.error(f"Failed to create {role_name} file: {e}")
-            
-            # Очищаем временный файл
-            if segments_list_file.exists():
-                segments_list_file.unlink()
+            # Аудио роли: срезы уже декодированного waveform, длительность - по числу отсчетов
+            bounds = segment_sample_bounds(
+                [(s['start'], s['end']) for s in segs], PIPELINE_SAMPLE_RATE, len(samples)
+            )
+            audio = gather_segments(samples, bounds)
+            if len(audio):
+                write_wav_pcm16(output_file, audio, PIPELINE_SAMPLE_RATE)
+                logger.info(f"Created {role_name} file: {output_filename} "
+                           f"({len(audio) / PIPELINE_SAMPLE_RATE:.1f}s, {len(segs)} segments)")
+                role_files.append(str(output_file))
+            else:
+                logger.error(f"Failed to create {role_name} file: segments are outside the audio")
             
             # Создаем метаданные для роли
             metadata_file = output_dir / f"metadata_{role}.txt"
             with open(metadata_file, 'w', encoding='utf-8') as f:
                 f.write(f"Role: {role_name}\n")
                 f.write(f"Role ID: {role}\n")
-                f.write(f"Source file: {Path(input_audio).name}\n")
+                f.write(f"Source file: {source_name}\n")
                 if chunk_info:
                     f.write(f"Chunk: {chunk_info.get('chunk_number', 'unknown')}\n")
                     f.write(f"Chunk start time: {chunk_info.get('start_time', 0):.2f}s\n")
@@ -873,7 +1207,7 @@ def diarize_with_role_classification(input_audio, output_dir, min_segment_durati
         with open(info_file, 'w', encoding='utf-8') as f:
             f.write("ROLE CLASSIFICATION RESULTS\n")
             f.write("=" * 50 + "\n\n")
-            f.write(f"Source file: {Path(input_audio).name}\n")
+            f.write(f"Source file: {source_name}\n")
             f.write(f"Total segments: {len(segments)}\n")
             f.write(f"Total roles detected: {len(role_segments)}\n")
             f.write(f"Narrator role: {narrator_role}\n\n")
@@ -886,9 +1220,9 @@ def diarize_with_role_classification(input_audio, output_dir, min_segment_durati
                 f.write(f"Role {role}: {len(segs)} segments, {total_duration:.2f}s, Narrator: {is_narrator}\n")
         
         logger.info(f"Created {len(role_files)} role files in {output_dir}")
-        return role_files if role_files else [input_audio]
+        return role_files if role_files else [ensure_audio_file(input_audio, output_dir)]
         
     except Exception as e:
         logger.error(f"Error during role-based diarization: {e}")
         logger.warning("Role-based diarization failed, returning original file")
-        return input_audio
\ No newline at end of file
+        return ensure_audio_file(input_audio, output_dir)
\ No newline at end of file
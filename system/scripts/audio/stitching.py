@@ -0,0 +1,265 @@
+"""
+Сшивка диаризации перекрывающихся чанков: согласование меток спикеров
+между чанками и удаление дублей реплик в зонах перекрытия
+"""
+
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .utils import audio_samples_int16, write_wav_pcm16
+
+# Минимальное совместное звучание в перекрытии, чтобы считать метки одним спикером
+MIN_MATCH_SEC = 0.5
+# Минимальное косинусное сходство центроидов, чтобы узнать спикера, молчавшего в перекрытии
+MIN_EMBEDDING_SIMILARITY = 0.5
+
+def overlap_matrix(turns_a, turns_b, region_start, region_end):
+    """
+    Сколько секунд каждая метка A звучит одновременно с каждой меткой B внутри зоны
+    turns_*: списки (start, end, speaker) в абсолютном времени
+    Возвращает (labels_a, labels_b, матрица секунд)
+    """
+    labels_a = sorted({t[2] for t in turns_a})
+    labels_b = sorted({t[2] for t in turns_b})
+    matrix = np.zeros((len(labels_a), len(labels_b)))
+    index_a = {label: i for i, label in enumerate(labels_a)}
+    index_b = {label: i for i, label in enumerate(labels_b)}
+
+    for start_a, end_a, speaker_a in turns_a:
+        start_a, end_a = max(start_a, region_start), min(end_a, region_end)
+        if end_a <= start_a:
+            continue
+        for start_b, end_b, speaker_b in turns_b:
+            shared = min(end_a, end_b) - max(start_a, start_b)
+            if shared > 0:
+                matrix[index_a[speaker_a], index_b[speaker_b]] += shared
+
+    return labels_a, labels_b, matrix
+
+def match_labels(turns_a, turns_b, region_start, region_end, min_match_sec=MIN_MATCH_SEC):
+    """
+    Сопоставляет метки соседних чанков по совместному звучанию в зоне перекрытия
+    Жадно: пары с наибольшим совместным временем первыми, каждая метка - не более одного раза
+    Возвращает dict метка_B -> метка_A
+    """
+    labels_a, labels_b, matrix = overlap_matrix(turns_a, turns_b, region_start, region_end)
+
+    mapping = {}
+    used_a = set()
+    for flat in np.argsort(matrix, axis=None)[::-1]:
+        i, j = np.unravel_index(flat, matrix.shape)
+        if matrix[i, j] < min_match_sec:
+            break
+        if labels_a[i] in used_a or labels_b[j] in mapping:
+            continue
+        mapping[labels_b[j]] = labels_a[i]
+        used_a.add(labels_a[i])
+    return mapping
+
+def match_embeddings(local_embeddings, centroids, used=(), min_similarity=MIN_EMBEDDING_SIMILARITY):
+    """
+    Сопоставляет метки чанка с ранее встреченными глобальными спикерами по косинусному
+    сходству центроидов эмбеддингов. Жадно, каждая метка и каждый спикер - не более одного раза
+    local_embeddings: dict метка -> вектор; centroids: dict глобальная_метка -> вектор
+    used: глобальные метки, уже занятые в этом чанке
+    Возвращает dict метка -> глобальная_метка
+    """
+    labels = sorted(local_embeddings)
+    candidates = sorted(label for label in centroids if label not in used)
+    if not labels or not candidates:
+        return {}
+
+    def normalized(vectors):
+        vectors = np.asarray(vectors, dtype=np.float64)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    similarity = normalized([local_embeddings[label] for label in labels]) @ \
+        normalized([centroids[label] for label in candidates]).T
+
+    mapping = {}
+    taken = set()
+    for flat in np.argsort(similarity, axis=None)[::-1]:
+        i, j = np.unravel_index(flat, similarity.shape)
+        if similarity[i, j] < min_similarity:
+            break
+        if labels[i] in mapping or candidates[j] in taken:
+            continue
+        mapping[labels[i]] = candidates[j]
+        taken.add(candidates[j])
+    return mapping
+
+def chunk_embeddings(chunk):
+    """Нормированные центроиды спикеров чанка (пустой dict, если их нет)"""
+    embeddings = {}
+    for speaker, vector in (chunk.get('embeddings') or {}).items():
+        vector = np.asarray(vector, dtype=np.float64)
+        norm = np.linalg.norm(vector)
+        if np.isfinite(norm) and norm > 0:
+            embeddings[speaker] = vector / norm
+    return embeddings
+
+def stitch_chunk_turns(chunks, min_match_sec=MIN_MATCH_SEC, logger=None):
+    """
+    Сшивает диаризацию перекрывающихся чанков одного файла
+    chunks: список dict в порядке файла:
+        'start_time' - начало чанка в файле (сек), 'duration' - длительность чанка,
+        'turns' - список (start, end, speaker) в секундах от начала чанка,
+        'embeddings' (необязательно) - dict speaker -> центроид эмбеддингов спикера в чанке
+
+    Метки соседних чанков сопоставляются по зоне перекрытия и переводятся в
+    глобальные SPEAKER_NN. Метка, не найденная в перекрытии (спикер там молчал),
+    сравнивается по эмбеддингу со всеми ранее встреченными глобальными спикерами
+    и получает новый номер, только если похожего нет. Реплики обрезаются по середине перекрытия: до нее
+    берется предыдущий чанк, после - следующий, поэтому дублей нет.
+    Возвращает dict глобальная_метка -> список {'start', 'end', 'chunk'} (абсолютное время),
+    'chunk' - индекс чанка, из аудио которого берется кусок
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    absolute = [
+        [(chunk['start_time'] + start, chunk['start_time'] + end, speaker)
+         for start, end, speaker in chunk['turns']]
+        for chunk in chunks
+    ]
+
+    # Глобальные метки: первый чанк задает нумерацию, дальше - по перекрытию, затем по эмбеддингам
+    global_labels = []
+    centroids = {}  # глобальная метка -> сумма нормированных эмбеддингов ее меток в чанках
+    next_label = 0
+    reidentified = 0
+    for idx, turns in enumerate(absolute):
+        labels = {}
+        if idx > 0:
+            region_start = chunks[idx]['start_time']
+            region_end = chunks[idx - 1]['start_time'] + chunks[idx - 1]['duration']
+            if region_end > region_start:
+                matched = match_labels(absolute[idx - 1], turns, region_start, region_end, min_match_sec)
+                labels = {local: global_labels[idx - 1][previous] for local, previous in matched.items()}
+
+        local_labels = sorted({t[2] for t in turns})
+        embeddings = chunk_embeddings(chunks[idx])
+        by_voice = match_embeddings(
+            {speaker: embeddings[speaker] for speaker in local_labels
+             if speaker not in labels and speaker in embeddings},
+            centroids, used=set(labels.values())
+        )
+        labels.update(by_voice)
+        reidentified += len(by_voice)
+
+        for speaker in local_labels:
+            if speaker not in labels:
+                labels[speaker] = f"SPEAKER_{next_label:02d}"
+                next_label += 1
+            if speaker in embeddings:
+                centroids[labels[speaker]] = centroids.get(labels[speaker], 0.0) + embeddings[speaker]
+        global_labels.append(labels)
+
+    # Точки отсечения: середина перекрытия (или стык, если перекрытия нет)
+    cuts = [0.0]
+    for idx in range(1, len(chunks)):
+        region_start = chunks[idx]['start_time']
+        region_end = chunks[idx - 1]['start_time'] + chunks[idx - 1]['duration']
+        cuts.append((region_start + max(region_start, region_end)) / 2)
+    cuts.append(float('inf'))
+
+    speakers = {}
+    for idx, turns in enumerate(absolute):
+        for start, end, speaker in turns:
+            start, end = max(start, cuts[idx]), min(end, cuts[idx + 1])
+            if end <= start:
+                continue
+            speakers.setdefault(global_labels[idx][speaker], []).append(
+                {'start': start, 'end': end, 'chunk': idx}
+            )
+
+    for pieces in speakers.values():
+        pieces.sort(key=lambda piece: piece['start'])
+
+    local_total = sum(len({t[2] for t in turns}) for turns in absolute)
+    logger.info(f"Stitched {len(chunks)} chunks: {local_total} chunk-local labels -> "
+                f"{len(speakers)} global speakers ({reidentified} matched by voice)")
+    return speakers
+
+def segment_sample_bounds(segments, sample_rate, num_samples, offset=0.0):
+    """
+    Границы сегментов [(start, end) в секундах] в отсчетах массива длиной num_samples
+    offset - время начала массива; пустые после обрезки сегменты отбрасываются
+    """
+    times = np.asarray(segments, dtype=np.float64).reshape(-1, 2) - offset
+    bounds = np.clip(np.round(times * sample_rate).astype(np.int64), 0, num_samples)
+    return bounds[bounds[:, 1] > bounds[:, 0]]
+
+def gather_segments(samples, bounds):
+    """
+    Склеивает сегменты samples[start:end] одним индексированием (без цикла по сегментам)
+    Длина результата - точная сумма длин сегментов в отсчетах
+    """
+    lengths = bounds[:, 1] - bounds[:, 0]
+    if len(lengths) == 0:
+        return samples[:0]
+    starts = np.repeat(bounds[:, 0] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return samples[starts + np.arange(lengths.sum())]
+
+def write_stitched_speakers(speakers, chunks, chunk_audio, output_dir, source_name,
+                            min_segment_duration=0.1, sample_rate=16000, logger=None):
+    """
+    Записывает сшитых спикеров: speaker_<метка>/speaker_<метка>_<source>.wav и metadata_<source>.txt
+    chunk_audio: пути к аудио чанков (после шумоподавления) или dict в памяти, в порядке chunks
+    Каждый чанк декодируется один раз, куски берутся срезами буфера
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    pieces_by_speaker = {
+        speaker: [p for p in pieces if p['end'] - p['start'] >= min_segment_duration]
+        for speaker, pieces in speakers.items()
+    }
+    audio_by_speaker = {speaker: [] for speaker in pieces_by_speaker}
+
+    for idx, audio_path in enumerate(chunk_audio):
+        if not audio_path:
+            continue
+        samples = audio_samples_int16(audio_path, sample_rate)
+        for speaker, pieces in pieces_by_speaker.items():
+            bounds = segment_sample_bounds(
+                [(p['start'], p['end']) for p in pieces if p['chunk'] == idx],
+                sample_rate, len(samples), offset=chunks[idx]['start_time']
+            )
+            if len(bounds):
+                audio_by_speaker[speaker].append(gather_segments(samples, bounds))
+
+    speaker_files = []
+    for speaker, pieces in pieces_by_speaker.items():
+        if not audio_by_speaker[speaker]:
+            continue
+
+        speaker_dir = output_dir / f"speaker_{speaker}"
+        speaker_dir.mkdir(exist_ok=True)
+
+        metadata_file = speaker_dir / f"metadata_{source_name}.txt"
+        with open(metadata_file, 'w', encoding='utf-8') as f:
+            f.write(f"Speaker: {speaker}\n")
+            f.write(f"Source file: {source_name}\n")
+            f.write(f"Stitched from chunks: {len(chunks)}\n")
+            f.write(f"Total segments: {len(pieces)}\n")
+            f.write(f"Total duration: {sum(p['end'] - p['start'] for p in pieces):.2f}s\n\n")
+            f.write("Segments:\n")
+            f.write("-" * 50 + "\n")
+            for i, piece in enumerate(pieces, 1):
+                f.write(f"{i:3d}. {piece['start']:8.2f}s - {piece['end']:8.2f}s "
+                        f"(duration: {piece['end'] - piece['start']:6.2f}s, chunk {piece['chunk'] + 1})\n")
+
+        speaker_file = speaker_dir / f"speaker_{speaker}_{source_name}.wav"
+        audio = np.concatenate(audio_by_speaker[speaker])
+        write_wav_pcm16(speaker_file, audio, sample_rate)
+        speaker_files.append(str(speaker_file))
+        logger.info(f"Created speaker file {speaker}: {speaker_file.name} "
+                    f"({len(audio) / sample_rate:.1f}s, {len(pieces)} segments)")
+
+    return speaker_files
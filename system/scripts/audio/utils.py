@@ -3,35 +3,441 @@
 """
 
 import os
+import json
+import atexit
 import subprocess
 import logging
+import threading
 import time
 import shutil
+import wave
+import queue
+from collections import namedtuple
 from pathlib import Path
+import numpy as np
+import soundfile as sf
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-def get_mp3_duration(file_path):
+# Результат пробы медиафайла
+AudioInfo = namedtuple('AudioInfo', ['duration', 'sample_rate', 'channels', 'codec', 'bit_rate'])
+
+# Кэш проб: (абсолютный путь, размер, mtime) -> AudioInfo
+_PROBE_CACHE = {}
+_PROBE_CACHE_LOCK = threading.Lock()
+_PROBE_DISK_CACHE_FILE = None
+_PROBE_CACHE_DIRTY = False  # Есть пробы, не сохраненные на диск (сохраняются в flush_probe_disk_cache)
+_PROBE_SAVE_LOCK = threading.Lock()
+
+def enable_probe_disk_cache(cache_file):
     """
-    Получает длительность MP3 файла используя ffprobe.
-    :param file_path: Путь к MP3 файлу.
-    :return: Строка с длительностью в формате HH:MM:SS.
+    Включает дисковый кэш проб (JSON), чтобы повторные запуски не вызывали ffprobe.
+    Новые пробы сохраняются пачкой: в конце probe_audio_files и при выходе из процесса.
+    :param cache_file: Путь к JSON файлу кэша или None для отключения.
+    """
+    global _PROBE_DISK_CACHE_FILE
+    
+    with _PROBE_CACHE_LOCK:
+        if cache_file and _PROBE_DISK_CACHE_FILE is None:
+            atexit.register(flush_probe_disk_cache)
+        _PROBE_DISK_CACHE_FILE = Path(cache_file) if cache_file else None
+        if _PROBE_DISK_CACHE_FILE and _PROBE_DISK_CACHE_FILE.exists():
+            try:
+                with open(_PROBE_DISK_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    for key, info in json.load(f).items():
+                        _PROBE_CACHE.setdefault(key, AudioInfo(*info))
+            except (OSError, ValueError, TypeError):
+                pass
+
+def _probe_key_is_current(key):
+    """Запись кэша актуальна: файл существует и не изменился (размер и mtime совпадают)"""
+    path, size, mtime_ns = key.rsplit('|', 2)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return str(stat.st_size) == size and str(stat.st_mtime_ns) == mtime_ns
+
+def flush_probe_disk_cache():
+    """
+    Сохраняет кэш проб на диск, если есть новые пробы; записи удаленных и измененных файлов выбрасываются.
+    Запись идет вне _PROBE_CACHE_LOCK, поэтому пробы в других потоках не ждут диска.
     """
+    global _PROBE_CACHE_DIRTY
+    
+    with _PROBE_SAVE_LOCK:
+        with _PROBE_CACHE_LOCK:
+            if _PROBE_DISK_CACHE_FILE is None or not _PROBE_CACHE_DIRTY:
+                return
+            cache_file = _PROBE_DISK_CACHE_FILE
+            entries = dict(_PROBE_CACHE)
+            _PROBE_CACHE_DIRTY = False
+        
+        stale = [key for key in entries if not _probe_key_is_current(key)]
+        for key in stale:
+            del entries[key]
+        with _PROBE_CACHE_LOCK:
+            for key in stale:
+                _PROBE_CACHE.pop(key, None)
+        
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = cache_file.with_suffix('.tmp')
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({key: list(info) for key, info in entries.items()}, f)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            pass
+
+def _probe_cache_key(file_path):
+    stat = os.stat(file_path)
+    return f"{Path(file_path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+
+def probe_audio(file_path):
+    """
+    Получает параметры медиафайла через ffprobe с кэшированием.
+    Кэш привязан к пути, размеру и времени изменения файла, поэтому
+    повторная проба того же файла не запускает ffprobe.
+    :param file_path: Путь к аудиофайлу.
+    :return: AudioInfo(duration, sample_rate, channels, codec, bit_rate), duration - float секунды.
+    """
+    try:
+        key = _probe_cache_key(file_path)
+    except OSError:
+        print(f"Error getting file info: {file_path}")
+        return AudioInfo(0.0, 0, 0, None, 0)
+    
+    with _PROBE_CACHE_LOCK:
+        if key in _PROBE_CACHE:
+            return _PROBE_CACHE[key]
+    
     try:
         result = subprocess.run([
-            "ffprobe", "-v", "quiet", "-show_entries", "format=duration",
-            "-of", "default=noprint_wrappers=1:nokey=1", file_path
+            "ffprobe", "-v", "quiet", "-print_format", "json",
+            "-show_entries", "format=duration,bit_rate:stream=codec_name,sample_rate,channels",
+            "-select_streams", "a:0", str(file_path)
         ], capture_output=True, text=True, check=True)
         
-        duration_seconds = float(result.stdout.strip())
-        hours = int(duration_seconds // 3600)
-        minutes = int((duration_seconds % 3600) // 60)
-        seconds = int(duration_seconds % 60)
+        data = json.loads(result.stdout)
+        format_info = data.get('format', {})
+        stream_info = (data.get('streams') or [{}])[0]
         
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-    except subprocess.CalledProcessError:
-        print(f"Error getting file duration: {file_path}")
-        return "00:00:00"
+        def to_number(value, cast):
+            try:
+                return cast(value)
+            except (TypeError, ValueError):
+                return cast(0)
+        
+        info = AudioInfo(
+            duration=to_number(format_info.get('duration'), float),
+            sample_rate=to_number(stream_info.get('sample_rate'), int),
+            channels=to_number(stream_info.get('channels'), int),
+            codec=stream_info.get('codec_name'),
+            bit_rate=to_number(format_info.get('bit_rate'), int)
+        )
+    except (subprocess.CalledProcessError, ValueError):
+        print(f"Error getting file info: {file_path}")
+        return AudioInfo(0.0, 0, 0, None, 0)
+    
+    global _PROBE_CACHE_DIRTY
+    with _PROBE_CACHE_LOCK:
+        _PROBE_CACHE[key] = info
+        _PROBE_CACHE_DIRTY = True
+    
+    return info
+
+def probe_audio_files(file_paths, max_workers=8):
+    """
+    Параллельная проба многих файлов ограниченным пулом потоков.
+    ffprobe - внешний процесс, поэтому потоки не упираются в GIL.
+    :param file_paths: Список путей.
+    :param max_workers: Максимальное число одновременных ffprobe.
+    :return: Список AudioInfo в порядке входных путей.
+    """
+    file_paths = [str(file_path) for file_path in file_paths]
+    if len(file_paths) <= 1:
+        infos = [probe_audio(file_path) for file_path in file_paths]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+            infos = list(executor.map(probe_audio, file_paths))
+    
+    # Одна запись кэша на всю пачку проб
+    flush_probe_disk_cache()
+    return infos
+
+def get_audio_duration(file_path):
+    """
+    Длительность файла в секундах (float) из кэшированной пробы.
+    """
+    return probe_audio(file_path).duration
+
+def format_duration(duration_seconds):
+    """
+    Форматирует длительность в строку HH:MM:SS.
+    """
+    hours = int(duration_seconds // 3600)
+    minutes = int((duration_seconds % 3600) // 60)
+    seconds = int(duration_seconds % 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def get_mp3_duration(file_path):
+    """
+    Получает длительность MP3 файла (через кэшированный probe_audio).
+    :param file_path: Путь к MP3 файлу.
+    :return: Строка с длительностью в формате HH:MM:SS.
+    """
+    return format_duration(get_audio_duration(file_path))
+
+def decode_audio_pcm(input_audio, sample_rate=16000, channels=1, start=None, duration=None):
+    """
+    Декодирует файл (или его фрагмент) в 16-битный PCM одним вызовом ffmpeg.
+    :param input_audio: Путь к аудиофайлу.
+    :param sample_rate: Частота дискретизации результата.
+    :param channels: Количество каналов результата.
+    :param start: Начало фрагмента в секундах (быстрый поиск до -i).
+    :param duration: Длительность фрагмента в секундах.
+    :return: np.int16 массив формы (samples,) для моно или (samples, channels).
+    """
+    command = ["ffmpeg", "-v", "error"]
+    if start is not None:
+        command += ["-ss", f"{start:.3f}"]
+    if duration is not None:
+        command += ["-t", f"{duration:.3f}"]
+    command += [
+        "-i", str(input_audio),
+        "-vn", "-f", "s16le", "-acodec", "pcm_s16le",
+        "-ar", str(sample_rate), "-ac", str(channels), "-"
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    
+    samples = np.frombuffer(result.stdout, dtype=np.int16)
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    return samples
+
+def stream_audio_pcm(input_audio, block_frames, sample_rate=16000, channels=1):
+    """
+    Потоково декодирует файл через stdout ffmpeg блоками фиксированной длины.
+    :param block_frames: Кадров в блоке (последний блок может быть короче).
+    :return: Генератор np.float32 массивов формы (frames, channels) в диапазоне [-1, 1].
+    """
+    command = [
+        "ffmpeg", "-v", "error", "-i", str(input_audio),
+        "-vn", "-f", "f32le", "-acodec", "pcm_f32le",
+        "-ar", str(sample_rate), "-ac", str(channels), "-"
+    ]
+    frame_bytes = 4 * channels
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            data = process.stdout.read(block_frames * frame_bytes)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % frame_bytes]
+            yield np.frombuffer(data, dtype=np.float32).reshape(-1, channels)
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+def read_audio_window(input_audio, start, duration, sample_rate=16000):
+    """
+    Читает фрагмент файла из stdout ffmpeg прямо в память, без временных файлов.
+    :return: np.float32 моно массив в диапазоне [-1, 1] (формат входа Whisper).
+    """
+    samples = decode_audio_pcm(input_audio, sample_rate=sample_rate, channels=1,
+                               start=start, duration=duration)
+    return samples.astype(np.float32) / 32768.0
+
+def write_wav_pcm16(output_file, samples, sample_rate=16000):
+    """
+    Записывает np.int16 массив в WAV файл без вызова ffmpeg.
+    :param output_file: Путь к выходному файлу.
+    :param samples: Массив (samples,) или (samples, channels).
+    :param sample_rate: Частота дискретизации.
+    """
+    samples = np.ascontiguousarray(samples, dtype=np.int16)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    
+    with wave.open(str(output_file), 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(samples.tobytes())
+    return str(output_file)
+
+# Форматы промежуточных файлов между этапами: (контейнер, кодирование, расширение)
+INTERMEDIATE_FORMATS = {
+    'wav': ('WAV', 'PCM_16', '.wav'),  # Как части после нарезки; в 2 раза меньше float
+    'flac': ('FLAC', 'PCM_16', '.flac'),  # Без потерь, еще ~1.5-2 раза меньше; кодирует фоновый поток
+    'float': ('WAV', 'FLOAT', '.wav'),  # 32-бит float без квантования
+}
+_INTERMEDIATE_FORMAT = None
+
+def set_intermediate_format(name):
+    """
+    Задает формат промежуточных файлов (выход шумоподавления и т.п.).
+    :param name: Ключ INTERMEDIATE_FORMATS или None (по умолчанию из config).
+    """
+    global _INTERMEDIATE_FORMAT
+    if name is not None and name not in INTERMEDIATE_FORMATS:
+        raise ValueError(f"Unknown intermediate format: {name} (expected one of {', '.join(INTERMEDIATE_FORMATS)})")
+    _INTERMEDIATE_FORMAT = name
+
+def intermediate_format(name=None):
+    """(контейнер, кодирование, расширение) для name или текущего формата"""
+    if name is None:
+        from .config import INTERMEDIATE_FORMAT
+        name = _INTERMEDIATE_FORMAT or INTERMEDIATE_FORMAT
+    return INTERMEDIATE_FORMATS[name]
+
+class BackgroundAudioWriter:
+    """Пишет блоки аудио в файл из фонового потока: кодирование не задерживает вычисления"""
+    
+    def __init__(self, output_file, samplerate, channels, audio_format=None, max_pending=8, collect=False):
+        """
+        output_file: путь или None (только в память)
+        collect: блоки также накапливаются в памяти (collected() после закрытия)
+        """
+        container, subtype, _ = intermediate_format(audio_format)
+        self._clip = subtype != 'FLOAT'
+        self._file = None
+        if output_file is not None:
+            self._file = sf.SoundFile(str(output_file), 'w', samplerate=samplerate, channels=channels,
+                                      format=container, subtype=subtype)
+        self._blocks = [] if collect or output_file is None else None
+        self._channels = channels
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._worker = threading.Thread(target=self._run, name="audio-writer", daemon=True)
+        self._worker.start()
+    
+    def collected(self):
+        """Все записанные блоки одним массивом (frames, channels) float32"""
+        if not self._blocks:
+            return np.zeros((0, self._channels), dtype=np.float32)
+        return np.concatenate([np.asarray(b, dtype=np.float32).reshape(len(b), -1) for b in self._blocks])
+    
+    def _run(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+            if self._error is not None:
+                continue
+            if self._file is None:
+                continue
+            try:
+                # Целочисленные форматы: ограничиваем амплитуду, иначе пики заворачиваются
+                self._file.write(np.clip(block, -1.0, 1.0) if self._clip else block)
+            except Exception as e:
+                self._error = e
+    
+    def write(self, block):
+        """Ставит блок (frames,) или (frames, channels) в очередь записи"""
+        if self._error is not None:
+            raise self._error
+        if self._blocks is not None:
+            self._blocks.append(block)
+        self._queue.put(block)
+    
+    def close(self):
+        """Дожидается записи всех блоков и закрывает файл"""
+        self._queue.put(None)
+        self._worker.join()
+        if self._file is not None:
+            self._file.close()
+        if self._error is not None:
+            raise self._error
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+def waveform_input(audio, sample_rate=16000):
+    """
+    Аудио для диаризации в памяти: dict {'waveform' (1, samples) float32, 'sample_rate', 'uri', 'file'}
+    Путь декодируется один раз; dict (например, результат шумоподавления) возвращается как есть
+    """
+    if isinstance(audio, dict):
+        return audio
+    import torch
+    samples = decode_audio_pcm(audio, sample_rate=sample_rate, channels=1)
+    return {
+        'waveform': torch.from_numpy(samples.astype(np.float32) / 32768.0).unsqueeze(0),
+        'sample_rate': sample_rate,
+        'uri': Path(audio).stem,
+        'file': str(audio)
+    }
+
+def audio_file_path(audio):
+    """Путь к файлу аудио (для dict в памяти - записанный файл или None)"""
+    if isinstance(audio, dict):
+        return audio.get('file')
+    return str(audio) if audio else None
+
+def audio_name(audio):
+    """Имя аудио для логов и имен файлов"""
+    if isinstance(audio, dict):
+        return audio.get('uri') or 'waveform'
+    return Path(audio).stem
+
+def audio_sample_rate(audio, default=16000):
+    """Частота дискретизации аудио: у dict в памяти - своя, у файла - по пробе (default, если неизвестна)"""
+    if isinstance(audio, dict):
+        return audio['sample_rate']
+    return probe_audio(audio).sample_rate or default
+
+def audio_samples_int16(audio, sample_rate=16000):
+    """
+    Моно np.int16 отсчеты на частоте sample_rate (None - на частоте самого аудио)
+    dict в памяти не декодируется (при другой частоте передискретизируется), файл - через ffmpeg
+    """
+    if sample_rate is None:
+        sample_rate = audio_sample_rate(audio)
+    if not isinstance(audio, dict):
+        return decode_audio_pcm(audio, sample_rate=sample_rate, channels=1)
+    if 'samples' in audio and audio['sample_rate'] == sample_rate:
+        return audio['samples']
+    
+    if 'samples' in audio:
+        waveform = audio['samples'].astype(np.float32) / 32768.0
+    else:
+        waveform = np.asarray(audio['waveform'], dtype=np.float32).mean(axis=0)
+    if audio['sample_rate'] != sample_rate:
+        import torch
+        import torchaudio
+        waveform = torchaudio.functional.resample(
+            torch.from_numpy(np.ascontiguousarray(waveform)), audio['sample_rate'], sample_rate
+        ).numpy()
+    return (np.clip(waveform, -1.0, 32767 / 32768) * 32768).astype(np.int16)
+
+def compact_audio(audio):
+    """
+    Аудио в памяти, которое еще понадобится после диаризации, хранится в int16 (вдвое меньше float32)
+    """
+    if not isinstance(audio, dict) or 'samples' in audio:
+        return audio
+    compact = {key: value for key, value in audio.items() if key != 'waveform'}
+    compact['samples'] = audio_samples_int16(audio, audio['sample_rate'])
+    return compact
+
+def ensure_audio_file(audio, target_dir):
+    """
+    Путь к файлу аудио; аудио только в памяти записывается в target_dir (16-бит WAV)
+    """
+    path = audio_file_path(audio)
+    if path:
+        return path
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    target = target_dir / f"{audio_name(audio)}.wav"
+    write_wav_pcm16(target, audio_samples_int16(audio, audio['sample_rate']), audio['sample_rate'])
+    audio['file'] = str(target)
+    return str(target)
 
 def setup_logging(log_level=logging.INFO):
     """
@@ -70,7 +476,7 @@ def copy_results_to_output_optimized(processed_parts, output_dir, file_stem, log
                         all_files.append(str(new_path))
                         speaker_counter += 1
                     else:
-                        new_name = f"{file_stem}_{Path(result_file).stem}.wav"
+                        new_name = f"{file_stem}_{Path(result_file).stem}{Path(result_file).suffix}"
                         new_path = output_dir / new_name
                         shutil.copy2(result_file, new_path)
                         all_files.append(str(new_path))
@@ -84,15 +490,16 @@ def parallel_audio_processing_optimized(audio_files, output_dir, steps, chunk_du
     Оптимизированная параллельная обработка с лучшим управлением ресурсами
     """
     from .config import get_optimal_workers
-    from .processors import process_audio_file_optimized
+    from .processors import process_audio_file_optimized, configure_worker_process
     
     optimal_workers = get_optimal_workers()
     logger.info(f"Using {optimal_workers} parallel processes")
     
     all_results = []
     
-    # Обрабатываем файлы с улучшенной параллелизацией
-    with ProcessPoolExecutor(max_workers=optimal_workers) as executor:
+    # Обрабатываем файлы с улучшенной параллелизацией (потоки torch делятся между процессами)
+    with ProcessPoolExecutor(max_workers=optimal_workers, initializer=configure_worker_process,
+                             initargs=(optimal_workers, steps)) as executor:
         futures = []
         
         for audio_file in audio_files:
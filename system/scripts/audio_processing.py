@@ -16,6 +16,7 @@ IMPROVEMENTS:
 import os
 import sys
 import argparse
+import json
 import logging
 import time
 from pathlib import Path
@@ -29,24 +30,38 @@ try:
     
     # Импортируем все необходимые функции из модуля audio
     from audio import (
-        GPUMemoryManager, ModelManager,
+        GPUMemoryManager, ModelManager, get_thread_budget, enable_demucs_cpu_fast, benchmark_demucs_precision,
         process_audio_file_optimized, parallel_audio_processing_optimized,
         process_multiple_files_parallel_optimized, process_file_multithreaded_optimized,
         clean_audio_with_demucs_optimized, 
         diarize_with_pyannote_optimized,
         split_audio_by_duration_optimized, split_audio_at_word_boundary_optimized,
-        get_mp3_duration, setup_logging, copy_results_to_output_optimized,
+        DEMUCS_SOURCES,
+        get_mp3_duration, probe_audio_files, format_duration, enable_probe_disk_cache, enable_denoise_cache, enable_quality_gate, get_quality_summary, set_intermediate_format, setup_logging, copy_results_to_output_optimized,
         get_optimal_workers, setup_gpu_optimization, 
         MAX_WORKERS, GPU_MEMORY_LIMIT, BATCH_SIZE
     )
     # Импорт функций конфигурации
-    from config import get_token, token_exists, ensure_directories
+    from config import get_token, token_exists, ensure_directories, TEMP_DIR
 except ImportError as e:
     print(f"Import error: {e}")
     print("Make sure all dependencies are installed")
     print(f"Audio module path: {audio_module_path}")
     sys.exit(1)
 
+def parse_stem_gains(text):
+    """
+    "vocals=1,other=0.5" -> {'vocals': 1.0, 'other': 0.5}
+    """
+    gains = {}
+    for item in text.split(','):
+        name, sep, value = item.partition('=')
+        name = name.strip()
+        if not sep or name not in DEMUCS_SOURCES:
+            raise ValueError(f"expected <stem>=<gain> with stem in {', '.join(DEMUCS_SOURCES)}, got '{item}'")
+        gains[name] = float(value)
+    return gains
+
 def main():
     parser = argparse.ArgumentParser(description="Optimized Audio Processing Pipeline: splitting, denoising, silence removal, diarization with speaker separation.")
     parser.add_argument('--input', '-i', help='Path to audio file (mp3/wav) or folder with files')
@@ -54,35 +69,83 @@ def main():
     parser.add_argument('--mode', type=str, default='multithreaded', choices=['single', 'multithreaded'],
                         help='Processing mode: single (sequential) or multithreaded (parallel, recommended)')
     parser.add_argument('--denoise_mode', type=str, default='enhanced', 
-                        choices=['vocals', 'no_vocals', 'all', 'enhanced'],
-                        help='Demucs denoising mode: vocals (voice only), no_vocals (background only), all (all sources), enhanced (voice + reduced background)')
+                        choices=['vocals', 'no_vocals', 'all', 'enhanced', 'spectral_gate'],
+                        help='Demucs denoising mode: vocals (voice only), no_vocals (background only), all (all sources), enhanced (voice + reduced background), spectral_gate (no neural network: fast CPU spectral gating for bulk material)')
+    parser.add_argument('--stem_gains', type=str, default=None,
+                        help='Custom Demucs stem mix instead of --denoise_mode, e.g. "vocals=1,other=0.5" (stems: drums, bass, other, vocals)')
+    parser.add_argument('--split_method', type=str, default=None,
+                        choices=['simple', 'word_boundary', 'smart_multithreaded', 'smart_energy'],
+                        help='Splitting method (default depends on --mode): smart_energy finds pauses by signal energy without Whisper (fast on CPU)')
+    parser.add_argument('--chunk_duration', type=int, default=None,
+                        help='Chunk duration in seconds (default: auto - planned per file from duration, CPU cores, RAM and measured stage speed)')
+    parser.add_argument('--chunk_overlap', type=float, default=0.0,
+                        help='Overlap between neighbouring chunks in seconds (e.g. 10). Speakers are stitched across chunks into file-global labels, so much shorter chunks can be used')
+    parser.add_argument('--denoise_cache_gb', type=float, default=20.0,
+                        help='Size limit of the persistent Demucs result cache in GB (least recently used entries are evicted, 0 disables)')
+    parser.add_argument('--skip_clean_below', type=float, default=None,
+                        help='Skip Demucs for chunks whose noise score (0-1, from SNR, spectral flatness and music-band energy) is below this value (default: 0 - check disabled, every chunk is denoised; 0.2 is a good start for studio narration)')
+    parser.add_argument('--cpu_fast', '--cpu-fast', type=str, default=None, choices=['int8', 'bf16'],
+                        help='Faster CPU-only Demucs inference: int8 (dynamic quantization) or bf16 (bfloat16 autocast)')
+    parser.add_argument('--benchmark_cpu_fast', action='store_true',
+                        help='Compare --cpu_fast modes with fp32 Demucs on the first 30 s of the first input file (speed and output difference) and exit')
+    parser.add_argument('--intermediate_format', type=str, default=None, choices=['wav', 'flac', 'float'],
+                        help='Format of intermediate files between stages: wav (16-bit, default), flac (lossless, smallest) or float (32-bit)')
     parser.add_argument('--verbose', '-v', action='store_true', help='Verbose logging')
     parser.add_argument('--interactive', action='store_true', help='Interactive mode with parameter prompts')
     args = parser.parse_args()
 
     # Создаем необходимые директории
     ensure_directories()
+    
+    # Кэш проб ffprobe переживает перезапуски (ключ - путь, размер и время изменения файла)
+    enable_probe_disk_cache(TEMP_DIR / "probe_cache.json")
+    
+    # Кэш Demucs по содержимому: повторные запуски не шумоподавляют те же куски заново
+    enable_denoise_cache(TEMP_DIR / "denoise_cache", args.denoise_cache_gb)
+    
+    # Формат промежуточных файлов (кодирование идет в фоновом потоке)
+    set_intermediate_format(args.intermediate_format)
+    
+    # Ускоренный вывод Demucs на CPU (на GPU не применяется)
+    enable_demucs_cpu_fast(args.cpu_fast)
+    
+    # Чистая запись (студийная начитка) идет мимо Demucs
+    if args.skip_clean_below is not None:
+        enable_quality_gate(args.skip_clean_below)
 
     # Pre-configured optimal parameters
     if args.mode == 'multithreaded':
         # Multi-threaded mode - optimized for speed
-        chunk_duration = 600  # 10 minutes
+        chunk_duration = None  # Auto: planned per file
         min_speaker_segment = 0.1  # 0.1 seconds (no limit)
         steps = ['split', 'denoise', 'diar']  # Clean processing pipeline
-        split_method = 'smart_multithreaded'  # New smart splitter
+        split_method = 'simple'  # Duration split; smart methods via --split_method
         use_gpu = True
         parallel = True
         workers = None  # Auto-determined
     else:
         # Single-threaded mode - optimized for stability
-        chunk_duration = 600  # 10 minutes
+        chunk_duration = None  # Auto: planned per file
         min_speaker_segment = 0.1  # 0.1 seconds (no limit)
         steps = ['split', 'denoise', 'diar']  # Clean processing pipeline
-        split_method = 'word_boundary'  # More stable for single-threaded
+        split_method = 'simple'  # Duration split; smart methods via --split_method
         use_gpu = True
         parallel = False
         workers = 1
 
+    if args.split_method:
+        split_method = args.split_method
+    if args.chunk_duration:
+        chunk_duration = args.chunk_duration
+    
+    # Режим шумоподавления: имя режима или пользовательские веса стемов
+    denoise_mode = args.denoise_mode
+    if args.stem_gains:
+        try:
+            denoise_mode = parse_stem_gains(args.stem_gains)
+        except ValueError as e:
+            parser.error(f"--stem_gains: {e}")
+
     # Setup logging
     log_level = logging.DEBUG if args.verbose else logging.INFO
     logger = setup_logging(log_level)
@@ -149,7 +212,7 @@ def main():
         
         # Show current settings
         print(f"\nCurrent settings ({args.mode} mode):")
-        print(f"  - Chunk duration: {chunk_duration} sec (10 minutes)")
+        print(f"  - Chunk duration: {f'{chunk_duration} sec' if chunk_duration else 'auto (planned per file)'}")
         print(f"  - Minimum speaker segment: {min_speaker_segment} sec (no limit)")
         print(f"  - Splitting method: {split_method}")
         print(f"  - Processing stages: {', '.join(steps)}")
@@ -168,12 +231,12 @@ def main():
                 args.mode = new_mode
                 # Update parameters based on new mode
                 if args.mode == 'multithreaded':
-                    split_method = 'smart_multithreaded'
+                    split_method = args.split_method or 'simple'
                     use_gpu = True
                     parallel = True
                     workers = get_optimal_workers()
                 else:
-                    split_method = 'word_boundary'
+                    split_method = args.split_method or 'simple'
                     use_gpu = True
                     parallel = False
                     workers = 1
@@ -293,12 +356,23 @@ def main():
         logger.error(f"File or folder not found: {input_path}")
         return
 
+    if args.benchmark_cpu_fast:
+        print(f"\nBenchmarking CPU Demucs precision on {files[0].name}...")
+        results = benchmark_demucs_precision(files[0], ModelManager(GPUMemoryManager(GPU_MEMORY_LIMIT)), logger=logger)
+        print(f"{'Mode':<6} {'Time, s':>8} {'RTF':>6} {'Speedup':>8} {'SNR vs fp32':>12} {'Vocals SNR':>11} {'Max diff':>9}")
+        for r in results:
+            print(f"{r['precision']:<6} {r['seconds']:>8.1f} {r['rtf']:>6.2f} {r['speedup']:>7.2f}x "
+                  f"{r['snr_db']:>9.1f} dB {r['vocals_snr_db']:>8.1f} dB {r['max_abs_diff']:>9.4f}")
+        return
+
     # Create output folder
     output_dir.mkdir(parents=True, exist_ok=True)
     print(f"\nResults will be saved in: {output_dir}")
 
     # Start timing
     start_time = time.time()
+    thread_budget = get_thread_budget()
+    thread_budget.start()
     
     if parallel and len(files) > 1:
         # Многопоточная обработка
@@ -307,7 +381,8 @@ def main():
         
         organized_speakers = process_multiple_files_parallel_optimized(
             files, output_dir, steps, chunk_duration,
-            min_speaker_segment, split_method, use_gpu, logger
+            min_speaker_segment, split_method, use_gpu, logger,
+            overlap_sec=args.chunk_overlap, denoise_mode=denoise_mode
         )
         
         # Показываем результаты
@@ -326,6 +401,8 @@ def main():
         # Инициализируем менеджеры
         gpu_manager = GPUMemoryManager(GPU_MEMORY_LIMIT)
         model_manager = ModelManager(gpu_manager)
+        # Файлы идут по очереди: потоки torch настраиваются один раз на весь запуск
+        thread_budget.configure(workers or get_optimal_workers(), steps)
         
         try:
             # Обрабатываем файлы
@@ -343,7 +420,8 @@ def main():
                     organized_speakers = process_file_multithreaded_optimized(
                         audio, output_dir, steps, chunk_duration,
                         min_speaker_segment, split_method, use_gpu,
-                        logger, model_manager, gpu_manager
+                        logger, model_manager, gpu_manager, workers=workers,
+                        overlap_sec=args.chunk_overlap, denoise_mode=denoise_mode
                     )
                     
                     # Объединяем результаты
@@ -380,6 +458,25 @@ def main():
     print(f"{'='*60}")
     print(f"Total execution time: {total_time/60:.1f} minutes")
     print(f"Results saved in: {output_dir}")
+    
+    # Загрузка CPU: насколько ядра были заняты при выбранном делении потоков
+    usage = thread_budget.report()
+    if 'torch_threads' in usage:
+        print(f"CPU utilization: {usage['cpu_utilization']*100:.0f}% of {os.cpu_count()} logical cores "
+              f"({usage['workers']} workers, {usage['torch_streams']} torch streams x {usage['torch_threads']} threads, "
+              f"workers busy {usage['worker_utilization']*100:.0f}%)")
+        logger.info(f"Thread budget report: {usage}")
+    
+    # Решения предварительной проверки качества (какие чанки прошли мимо Demucs)
+    quality = get_quality_summary()
+    if quality['checked']:
+        print(f"Demucs skipped for {quality['skipped']}/{quality['checked']} chunks (clean speech)")
+        try:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            with open(output_dir / 'denoise_decisions.json', 'w', encoding='utf-8') as f:
+                json.dump(quality['decisions'], f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            logger.warning(f"Could not save denoise decisions: {e}")
     print("\nResults structure:")
     
     # Show what was created
@@ -389,8 +486,14 @@ def main():
             speaker_folders = [d for d in output_dir.iterdir() if d.is_dir() and d.name.startswith('speaker_')]
             if speaker_folders:
                 print(f"  speaker_* folders ({len(speaker_folders)} folders)")
+                
+                # Пробуем все показываемые файлы одним параллельным запросом
+                speaker_audio_files = {d: list(d.glob('*.wav')) for d in speaker_folders}
+                shown_files = [f for files in speaker_audio_files.values() for f in files[:3]]
+                shown_durations = dict(zip(shown_files, probe_audio_files(shown_files)))
+                
                 for speaker_folder in speaker_folders:
-                    audio_files = list(speaker_folder.glob('*.wav'))
+                    audio_files = speaker_audio_files[speaker_folder]
                     metadata_files = list(speaker_folder.glob('metadata_*.txt'))
                     info_files = list(speaker_folder.glob('*_info.txt'))
                     
@@ -401,10 +504,10 @@ def main():
                     
                     # Показываем первые несколько аудиофайлов
                     for audio_file in audio_files[:3]:
-                        try:
-                            duration_str = get_mp3_duration(str(audio_file))
-                            print(f"        {audio_file.name}: {duration_str}")
-                        except:
+                        info = shown_durations.get(audio_file)
+                        if info and info.duration > 0:
+                            print(f"        {audio_file.name}: {format_duration(info.duration)}")
+                        else:
                             print(f"        {audio_file.name}")
                     
                     if len(audio_files) > 3:
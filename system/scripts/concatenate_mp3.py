@@ -10,6 +10,7 @@ import subprocess
 import argparse
 import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 def setup_logging(log_level=logging.INFO):
@@ -28,11 +29,11 @@ def setup_logging(log_level=logging.INFO):
     )
     return logging.getLogger(__name__)
 
-def get_mp3_duration(file_path):
+def get_duration_seconds(file_path):
     """
-    Gets the duration of an MP3 file using ffprobe.
-    :param file_path: Path to the MP3 file.
-    :return: String with duration in HH:MM:SS format.
+    Gets the duration of an audio file in seconds using ffprobe.
+    :param file_path: Path to the audio file.
+    :return: Duration in seconds (float), 0.0 on error.
     """
     try:
         result = subprocess.run([
@@ -40,15 +41,42 @@ def get_mp3_duration(file_path):
             "-of", "default=noprint_wrappers=1:nokey=1", file_path
         ], capture_output=True, text=True, check=True)
         
-        duration_seconds = float(result.stdout.strip())
-        hours = int(duration_seconds // 3600)
-        minutes = int((duration_seconds % 3600) // 60)
-        seconds = int(duration_seconds % 60)
-        
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-    except subprocess.CalledProcessError:
+        return float(result.stdout.strip())
+    except (subprocess.CalledProcessError, ValueError):
         print(f"Error getting duration for file: {file_path}")
-        return "00:00:00"
+        return 0.0
+
+def format_duration(duration_seconds):
+    """
+    Formats a duration in seconds as HH:MM:SS.
+    """
+    hours = int(duration_seconds // 3600)
+    minutes = int((duration_seconds % 3600) // 60)
+    seconds = int(duration_seconds % 60)
+    
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def get_mp3_duration(file_path):
+    """
+    Gets the duration of an MP3 file using ffprobe.
+    :param file_path: Path to the MP3 file.
+    :return: String with duration in HH:MM:SS format.
+    """
+    return format_duration(get_duration_seconds(file_path))
+
+def get_durations_parallel(file_paths, max_workers=8):
+    """
+    Probes many files at once with a bounded pool of ffprobe processes.
+    :param file_paths: List of file paths.
+    :param max_workers: Maximum number of concurrent ffprobe processes.
+    :return: List of durations in seconds, in the same order as file_paths.
+    """
+    file_paths = [str(file_path) for file_path in file_paths]
+    if not file_paths:
+        return []
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(file_paths))) as executor:
+        return list(executor.map(get_duration_seconds, file_paths))
 
 def concatenate_mp3_files(input_dir, output_file, file_pattern="*.mp3", sort_by_name=True, logger=None):
     """
@@ -90,24 +118,12 @@ def concatenate_mp3_files(input_dir, output_file, file_pattern="*.mp3", sort_by_
     logger.info(f"Found {len(mp3_files)} MP3 files")
     print(f"Found {len(mp3_files)} MP3 files:")
     
-    # Show list of files with their durations
-    total_duration_seconds = 0
-    for i, file_path in enumerate(mp3_files, 1):
-        duration_str = get_mp3_duration(str(file_path))
-        print(f"  {i:2d}. {file_path.name} ({duration_str})")
-        
-        # Calculate total duration
-        time_parts = duration_str.split(":")
-        hours = int(time_parts[0])
-        minutes = int(time_parts[1])
-        seconds = int(time_parts[2])
-        total_duration_seconds += hours * 3600 + minutes * 60 + seconds
+    # Show list of files with their durations (probed in parallel, printed in order)
+    durations = get_durations_parallel(mp3_files)
+    for i, (file_path, duration) in enumerate(zip(mp3_files, durations), 1):
+        print(f"  {i:2d}. {file_path.name} ({format_duration(duration)})")
     
-    # Convert total duration back to HH:MM:SS format
-    total_hours = int(total_duration_seconds // 3600)
-    total_minutes = int((total_duration_seconds % 3600)) // 60
-    total_seconds = int(total_duration_seconds % 60)
-    total_duration_str = f"{total_hours:02d}:{total_minutes:02d}:{total_seconds:02d}"
+    total_duration_str = format_duration(sum(durations))
     
     print(f"\nTotal duration: {total_duration_str}")
     logger.info(f"Total duration: {total_duration_str}")
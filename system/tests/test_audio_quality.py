@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Test script: recording quality estimate that decides whether a chunk needs Demucs
+Verifies that clean synthetic speech scores low, noisy input scores high and the gate is off by default
+"""
+
+import sys
+import wave
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# Добавляем путь к скриптам, чтобы импортировать пакет audio
+scripts_path = Path(__file__).parent.parent / 'scripts'
+sys.path.append(str(scripts_path))
+
+SAMPLE_RATE = 16000
+DURATION_SEC = 10
+
+def synthetic_speech(seed=0):
+    """Гармонический "голос" 120-160 Гц со слогами и паузами, почти без фонового шума"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(DURATION_SEC * SAMPLE_RATE) / SAMPLE_RATE
+    pitch = 140 + 20 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 20))
+    syllables = (np.sin(2 * np.pi * 2 * t) > 0) & (np.sin(2 * np.pi * 0.3 * t) > -0.6)
+    speech = 0.3 * voiced * syllables / np.abs(voiced).max()
+    return speech + 1e-5 * rng.standard_normal(len(t))
+
+def to_int16(samples):
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+
+def write_wav(path, samples):
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(to_int16(samples).tobytes())
+
+def test_clean_vs_noisy():
+    """Clean speech scores near 0, the same speech with noise and pure noise near 1"""
+    print("Testing quality estimate...")
+
+    from audio.quality import estimate_audio_quality
+
+    rng = np.random.default_rng(1)
+    clean = synthetic_speech()
+    noisy = clean + 0.05 * rng.standard_normal(len(clean))
+    noise = 0.1 * rng.standard_normal(len(clean))
+
+    scores = {name: estimate_audio_quality(to_int16(samples))
+              for name, samples in [('clean', clean), ('noisy', noisy), ('noise', noise)]}
+
+    assert scores['clean']['score'] < 0.2, f"clean speech scored too high: {scores['clean']}"
+    assert scores['noisy']['score'] > 0.5, f"noisy speech scored too low: {scores['noisy']}"
+    assert scores['noise']['score'] > 0.5, f"pure noise scored too low: {scores['noise']}"
+    assert scores['clean']['snr_db'] > scores['noisy']['snr_db'] > scores['noise']['snr_db']
+
+    # Float и int16 входы дают одну оценку, слишком короткий вход - None
+    assert estimate_audio_quality(clean.astype(np.float32))['score'] == scores['clean']['score']
+    assert estimate_audio_quality(np.zeros(100, dtype=np.int16)) is None
+    for name, metrics in scores.items():
+        print(f"  ✓ {name}: SNR {metrics['snr_db']:.1f} dB, score {metrics['score']:.2f}")
+
+def test_quality_gate():
+    """The gate is off by default; with a threshold only the clean chunk skips Demucs"""
+    print("Testing Demucs quality gate...")
+
+    from audio.quality import assess_denoise_need, enable_quality_gate, get_quality_summary
+
+    work_dir = Path(tempfile.mkdtemp(prefix="test_audio_quality_"))
+    try:
+        clean_file = work_dir / "clean.wav"
+        noisy_file = work_dir / "noisy.wav"
+        clean = synthetic_speech()
+        write_wav(clean_file, clean)
+        write_wav(noisy_file, clean + 0.05 * np.random.default_rng(2).standard_normal(len(clean)))
+
+        assert not assess_denoise_need(clean_file)['skip'], "gate must be disabled by default"
+        assert get_quality_summary()['checked'] == 0
+
+        enable_quality_gate(0.2)
+        try:
+            assert assess_denoise_need(clean_file)['skip'], "clean chunk should skip Demucs"
+            assert not assess_denoise_need(noisy_file)['skip'], "noisy chunk must be denoised"
+        finally:
+            enable_quality_gate(0)
+
+        summary = get_quality_summary()
+        assert (summary['checked'], summary['skipped']) == (2, 1), f"unexpected summary: {summary}"
+        print("  ✓ disabled by default, clean skipped and noisy denoised at 0.2")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        test_clean_vs_noisy()
+        test_quality_gate()
+        print("✓ Audio quality tests passed")
+    except AssertionError as e:
+        print(f"✗ Test failed: {e}")
+        sys.exit(1)
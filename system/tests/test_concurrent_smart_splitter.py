@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Test script: several files are smart-split at the same time
+Verifies that parallel splits do not mix boundary results between files
+and that existing parts are reused only for the same source and cut points
+"""
+
+import sys
+import wave
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Добавляем путь к скриптам, чтобы импортировать пакет audio
+scripts_path = Path(__file__).parent.parent / 'scripts'
+sys.path.append(str(scripts_path))
+
+SAMPLE_RATE = 16000
+
+def create_synthetic_speech(output_path, duration, pause_times, seed):
+    """
+    Создает шумоподобную "речь" с паузами по 1 сек в заданных точках
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * SAMPLE_RATE)
+    t = np.arange(n) / SAMPLE_RATE
+
+    # Модулированный шум + тон похожи на речь по энергии
+    envelope = 0.5 + 0.5 * np.abs(np.sin(2 * np.pi * 2 * t))
+    audio = (rng.standard_normal(n) * 0.1 + 0.2 * np.sin(2 * np.pi * 180 * t)) * envelope
+
+    for pause in pause_times:
+        start, end = int((pause - 0.5) * SAMPLE_RATE), int((pause + 0.5) * SAMPLE_RATE)
+        audio[start:end] = rng.standard_normal(end - start) * 0.001
+
+    samples = np.clip(audio * 32767, -32768, 32767).astype(np.int16)
+    with wave.open(str(output_path), 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(samples.tobytes())
+
+def wav_duration(path):
+    with wave.open(str(path), 'rb') as wav_file:
+        return wav_file.getnframes() / wav_file.getframerate()
+
+def test_concurrent_smart_splitter():
+    """Parallel smart splits must give the same parts as sequential ones"""
+    print("Testing concurrent smart splitting...")
+
+    from audio.splitters import split_audio_smart_multithreaded_optimized
+
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    work_dir = Path(tempfile.mkdtemp(prefix="test_concurrent_split_"))
+    try:
+        # У каждого файла свои паузы - перепутанные результаты сразу видны
+        files = []
+        for i in range(4):
+            pauses = [27 - i * 2, 57 - i * 2, 87 - i * 2]
+            audio_path = work_dir / f"book_{i}.wav"
+            create_synthetic_speech(audio_path, 100, pauses, seed=i)
+            files.append((audio_path, pauses))
+
+        def split(index, audio_path, suffix):
+            return split_audio_smart_multithreaded_optimized(
+                str(audio_path), work_dir / f"parts_{index}_{suffix}",
+                max_duration_sec=30, analysis_window=10,
+                max_workers=2, logger=logger, boundary_method="energy"
+            )
+
+        sequential = [split(i, path, "seq") for i, (path, _) in enumerate(files)]
+
+        with ThreadPoolExecutor(max_workers=len(files)) as executor:
+            futures = [executor.submit(split, i, path, "par") for i, (path, _) in enumerate(files)]
+            parallel = [future.result() for future in futures]
+
+        for i, ((audio_path, pauses), seq_parts, par_parts) in enumerate(zip(files, sequential, parallel)):
+            seq_durations = [wav_duration(p) for p in seq_parts]
+            par_durations = [wav_duration(p) for p in par_parts]
+
+            assert len(par_parts) == 4, f"file {i}: expected 4 parts, got {len(par_parts)}"
+            assert np.allclose(seq_durations, par_durations, atol=0.05), \
+                f"file {i}: parallel parts differ from sequential: {par_durations} vs {seq_durations}"
+
+            # Разрезы должны попасть в паузы именно этого файла
+            cut_points = np.cumsum(par_durations)[:-1]
+            assert np.allclose(cut_points, pauses, atol=0.5), \
+                f"file {i}: cuts {cut_points.tolist()} do not match pauses {pauses}"
+
+            print(f"  ✓ {audio_path.name}: cuts at {[round(float(c), 2) for c in cut_points]}")
+
+        print("✓ Concurrent smart splitting test passed")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def test_split_reuse():
+    """Parts are reused for the same split; new cut points or a changed source re-split the file"""
+    print("Testing reuse of existing parts...")
+
+    from audio.splitters import cut_audio_at_points
+
+    logger = logging.getLogger(__name__)
+    work_dir = Path(tempfile.mkdtemp(prefix="test_split_reuse_"))
+    try:
+        audio_path = work_dir / "book.wav"
+        create_synthetic_speech(audio_path, 20, [], seed=0)
+
+        for overlap_sec in (0.0, 0.5):
+            parts_dir = work_dir / f"parts_{overlap_sec}"
+
+            def split(points, expected):
+                parts = cut_audio_at_points(str(audio_path), parts_dir, points,
+                                            overlap_sec=overlap_sec, logger=logger)
+                # Segment muxer режет по границам аудиокадров - допуск в несколько кадров
+                durations = [wav_duration(p) - overlap_sec * (i < len(parts) - 1) for i, p in enumerate(parts)]
+                return len(durations) == len(expected) and np.allclose(durations, expected, atol=0.1)
+
+            assert split([8.0], [8.0, 12.0])
+            mtime = (parts_dir / "part_1.wav").stat().st_mtime_ns
+            assert split([8.0], [8.0, 12.0])
+            assert (parts_dir / "part_1.wav").stat().st_mtime_ns == mtime, "same split must reuse parts"
+
+            # Столько же частей, но другие точки разреза
+            assert split([5.0], [5.0, 15.0]), "new cut points must re-split"
+
+            # Исходник заменен файлом другой длины
+            create_synthetic_speech(audio_path, 16, [], seed=1)
+            assert split([5.0], [5.0, 11.0]), "changed source must re-split"
+            create_synthetic_speech(audio_path, 20, [], seed=0)
+            print(f"  ✓ overlap {overlap_sec}s: reused once, re-split on new points and new source")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    try:
+        test_concurrent_smart_splitter()
+        test_split_reuse()
+    except AssertionError as e:
+        print(f"✗ Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Test script: streaming Demucs windows and their overlap-add stitching
+Uses a pass-through separator instead of the model, so the stitched result must equal the input
+"""
+
+import sys
+import wave
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Добавляем путь к скриптам, чтобы импортировать пакет audio
+scripts_path = Path(__file__).parent.parent / 'scripts'
+sys.path.append(str(scripts_path))
+
+SAMPLE_RATE = 16000
+DURATION_SEC = 25
+
+class PassThroughModel:
+    """Параметры модели htdemucs без весов"""
+    sources = ['drums', 'bass', 'other', 'vocals']
+    audio_channels = 2
+
+    def __init__(self, samplerate):
+        self.samplerate = samplerate
+
+class PassThroughBatcher:
+    """Вместо разделения кладет окно в стем vocals, остальные стемы - тишина"""
+
+    def __init__(self):
+        self.windows = []
+
+    def separate(self, wav):
+        self.windows.append(wav.shape[-1])
+        sources = torch.zeros((1, len(PassThroughModel.sources)) + tuple(wav.shape))
+        sources[0, PassThroughModel.sources.index('vocals')] = wav
+        return sources
+
+def write_wav(path, samples, sample_rate=SAMPLE_RATE):
+    """Стерео с одинаковыми каналами: апмикс моно в ffmpeg ослабляет сигнал на 3 дБ"""
+    stereo = np.repeat((np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)[:, None], 2, axis=1)
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(stereo.tobytes())
+
+def run_streaming(input_file, model_rate, overlap_sec):
+    from audio.stages import clean_audio_with_demucs_streaming
+
+    batcher = PassThroughBatcher()
+    stats = clean_audio_with_demucs_streaming(
+        input_file, None, PassThroughModel(model_rate), torch.device('cpu'), mode='vocals',
+        window_sec=10, overlap_sec=overlap_sec, batcher=batcher, output_rate=SAMPLE_RATE
+    )
+    return stats, batcher.windows
+
+def test_streaming_overlap():
+    """With and without crossfade the pass-through result equals the input, nothing is dropped"""
+    print("Testing streaming Demucs windows...")
+
+    work_dir = Path(tempfile.mkdtemp(prefix="test_demucs_streaming_"))
+    try:
+        input_file = work_dir / "input.wav"
+        t = np.arange(DURATION_SEC * SAMPLE_RATE) / SAMPLE_RATE
+        signal = 0.5 * np.sin(2 * np.pi * 220 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 0.7 * t))
+        write_wav(input_file, signal)
+        expected = np.round(np.clip(signal, -1.0, 1.0) * 32767) / 32768
+
+        for overlap_sec, windows in [(1.0, [160000, 160000, 112000]), (0.0, [160000, 160000, 80000])]:
+            stats, seen = run_streaming(input_file, SAMPLE_RATE, overlap_sec)
+            samples = stats['samples'][:, 0]
+            assert seen == windows, f"overlap {overlap_sec}: unexpected windows {seen}"
+            assert len(samples) == len(expected), f"overlap {overlap_sec}: {len(samples)} frames"
+            error = np.abs(samples - expected).max()
+            assert error < 1e-4, f"overlap {overlap_sec}: result differs from input by {error}"
+            print(f"  ✓ overlap {overlap_sec}s: {len(seen)} windows, {len(samples)} frames")
+
+        # Перекрытие меньше шага передискретизации 44.1 -> 16 кГц (10 мс) округляется до нуля
+        stats, seen = run_streaming(input_file, 44100, 0.005)
+        assert len(seen) == 3, f"unexpected windows {seen}"
+        assert abs(stats['frames'] - len(expected)) <= 1, f"{stats['frames']} frames at 44.1 kHz"
+        print(f"  ✓ overlap below the resampling step: {stats['frames']} frames")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        test_streaming_overlap()
+        print("✓ Demucs streaming tests passed")
+    except AssertionError as e:
+        print(f"✗ Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Test script: shared diarization service with batched model calls
+Verifies with a stub pipeline that model calls of concurrent chunks are merged,
+every caller gets its own slice back and the shared pipeline is never patched
+"""
+
+import sys
+import logging
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+
+import torch
+
+# Добавляем путь к скриптам, чтобы импортировать пакет audio
+scripts_path = Path(__file__).parent.parent / 'scripts'
+sys.path.append(str(scripts_path))
+
+class StubSegmentation:
+    """Модель сегментации: один тензор на выходе, запоминает размеры батчей"""
+    
+    def __init__(self):
+        self.batch_sizes = []
+    
+    def infer(self, chunks):
+        self.batch_sizes.append(len(chunks))
+        return chunks * 2
+
+class StubEmbedding:
+    """Модель эмбеддингов: кортеж на выходе, учитывает маски"""
+    
+    def __init__(self):
+        self.batch_sizes = []
+        self.dimension = 3
+    
+    def __call__(self, waveforms, masks=None):
+        self.batch_sizes.append(len(waveforms))
+        return waveforms.sum(dim=-1), (waveforms * masks.unsqueeze(1)).sum(dim=-1)
+
+class StubPipeline:
+    """Пайплайн: сегментация, затем эмбеддинги; все вызовы ждут у барьера, чтобы попасть в один батч"""
+    
+    def __init__(self, callers):
+        self._segmentation = StubSegmentation()
+        self._embedding = StubEmbedding()
+        self._barrier = threading.Barrier(callers)
+    
+    def __call__(self, audio, hook=None, scale=1):
+        self._barrier.wait()
+        segmentation = self._segmentation.infer(audio['chunks'])
+        hook('segmentation', None, total=1, completed=1)
+        self._barrier.wait()
+        embeddings = self._embedding(audio['waveforms'], masks=audio['masks'])
+        return segmentation * scale, embeddings
+
+def make_audio(value, size):
+    return {
+        'chunks': torch.full((size, 1, 4), float(value)),
+        'waveforms': torch.full((size, 1, 5), float(value)),
+        'masks': torch.ones(size, 5) * value
+    }
+
+def test_merged_calls_return_own_slices():
+    """Concurrent chunks share model batches and get back exactly their rows"""
+    print("Testing merged model calls...")
+
+    from audio.managers import DiarizationService
+
+    sizes = [1, 2, 3]
+    pipeline = StubPipeline(len(sizes))
+    original_infer = pipeline._segmentation.infer
+    original_embedding = pipeline._embedding
+
+    service = DiarizationService(pipeline, concurrency=len(sizes), max_wait=0.5)
+    # Общий пайплайн не изменяется: воркеры работают с копиями
+    assert 'infer' not in vars(pipeline._segmentation)
+    assert pipeline._embedding is original_embedding
+    try:
+        futures = [service.submit(make_audio(idx + 1, size), scale=idx + 1)
+                   for idx, size in enumerate(sizes)]
+        results = [future.result(timeout=30) for future in futures]
+    finally:
+        service.stop()
+
+    for idx, (size, (segmentation, (sums, masked))) in enumerate(zip(sizes, results)):
+        value = idx + 1
+        assert segmentation.shape == (size, 1, 4), f"segmentation slice {idx}: {tuple(segmentation.shape)}"
+        assert torch.all(segmentation == 2 * value * value), f"segmentation slice {idx} mixed with others"
+        assert torch.all(sums == 5 * value), f"embedding slice {idx}: {sums.flatten().tolist()}"
+        assert torch.all(masked == 5 * value * value), f"masked slice {idx}: {masked.flatten().tolist()}"
+
+    # Все три чанка прошли одним вызовом каждой модели
+    assert pipeline._segmentation.batch_sizes == [6], pipeline._segmentation.batch_sizes
+    assert original_embedding.batch_sizes == [6], original_embedding.batch_sizes
+    assert service.stats['merged_calls'] == 4, service.stats
+    assert service.stats['chunks'] == 3 and not service._progress
+
+    assert pipeline._segmentation.infer == original_infer
+    assert pipeline._embedding is original_embedding
+    print(f"  ✓ {len(sizes)} chunks, one call per model, stats {service.stats}")
+
+def test_process_groups():
+    """_process splits tuple outputs and masks by caller and reports errors to every caller"""
+    print("Testing batch splitting...")
+
+    from audio.managers import DiarizationService
+
+    pipeline = StubPipeline(1)
+    service = DiarizationService(pipeline, concurrency=1, max_wait=0)
+    try:
+        group = []
+        for value, size in [(1, 2), (3, 1)]:
+            audio = make_audio(value, size)
+            group.append(('embedding', pipeline._embedding, audio['waveforms'], audio['masks'], Future()))
+        service._process(group)
+        first, second = (call[4].result(timeout=5) for call in group)
+        assert isinstance(first, tuple) and len(first) == 2
+        assert first[0].shape == (2, 1) and second[0].shape == (1, 1)
+        assert torch.all(first[1] == 5) and torch.all(second[1] == 45), (first[1], second[1])
+
+        def broken(batch):
+            raise RuntimeError("model failed")
+        failing = [('segmentation', broken, torch.zeros(1, 1, 4), None, Future()) for _ in range(2)]
+        service._process(failing)
+        assert all(isinstance(call[4].exception(timeout=5), RuntimeError) for call in failing)
+    finally:
+        service.stop()
+    print("  ✓ tuple outputs and masks split per caller, errors reach every caller")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        test_merged_calls_return_own_slices()
+        test_process_groups()
+        print("✓ Diarization service tests passed")
+    except AssertionError as e:
+        print(f"✗ Test failed: {e}")
+        sys.exit(1)
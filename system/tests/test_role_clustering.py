@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Test script: turn embeddings and role clustering
+Verifies the cosine silhouette against sklearn, role clustering edge cases and
+batched turn embedding extraction with a stub embedding model
+"""
+
+import sys
+import logging
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Добавляем путь к скриптам, чтобы импортировать пакет audio
+scripts_path = Path(__file__).parent.parent / 'scripts'
+sys.path.append(str(scripts_path))
+
+SAMPLE_RATE = 16000
+
+def test_cosine_silhouette():
+    """Vectorized silhouette matches sklearn's cosine silhouette, singletons included"""
+    print("Testing cosine silhouette...")
+
+    from sklearn.metrics import silhouette_score
+    from audio.roles import cosine_silhouette, normalize_embeddings
+
+    rng = np.random.default_rng(0)
+    embeddings = normalize_embeddings(rng.standard_normal((300, 64)))
+    for labels in [rng.integers(0, 4, 300), np.r_[np.zeros(299, dtype=int), 1]]:
+        ours = cosine_silhouette(embeddings, labels)
+        reference = silhouette_score(embeddings, labels, metric='cosine')
+        assert abs(ours - reference) < 1e-4, f"silhouette {ours} != sklearn {reference}"
+    assert cosine_silhouette(embeddings, np.zeros(300)) == 0.0
+    print(f"  ✓ matches sklearn ({ours:.4f})")
+
+def test_role_clusterer():
+    """Separable voices give their own roles; 0, 1 and 3 turns are handled"""
+    print("Testing role clusterer...")
+
+    from audio.roles import RoleClusterer
+
+    clusterer = RoleClusterer()
+    labels, n_roles = clusterer.fit_predict(np.zeros((0, 8)))
+    assert (labels.shape, n_roles) == ((0,), 1), (labels, n_roles)
+    labels, n_roles = clusterer.fit_predict(np.ones((1, 8)))
+    assert (labels.tolist(), n_roles) == ([0], 1), (labels, n_roles)
+
+    # Три реплики: кандидат один (2 роли), двое реплик одного голоса - роль 0
+    voices = np.eye(8)[[0, 0, 1]] + 0.01
+    labels, n_roles = clusterer.fit_predict(voices)
+    assert (labels.tolist(), n_roles) == ([0, 0, 1], 2), (labels, n_roles)
+
+    # 3 голоса, выборка меньше числа реплик: число ролей выбирается по выборке
+    rng = np.random.default_rng(1)
+    centers = rng.standard_normal((3, 64))
+    truth = rng.choice(3, 600, p=[0.6, 0.25, 0.15])
+    embeddings = centers[truth] + 0.3 * rng.standard_normal((600, 64))
+    clusterer = RoleClusterer(sample_size=200)
+    labels, n_roles = clusterer.fit_predict(embeddings)
+    assert n_roles == 3, f"expected 3 roles, got {n_roles} ({clusterer.scores})"
+    assert np.array_equal(labels, truth), "roles do not follow the voices (role_00 is the most frequent)"
+    print(f"  ✓ edge cases, 3 voices found, silhouette {clusterer.scores}")
+
+class StubEmbedding:
+    """Модель эмбеддингов: [среднее по маске, длина по маске], запоминает размеры батчей"""
+
+    sample_rate = SAMPLE_RATE
+    dimension = 2
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, waveforms, masks=None):
+        self.batch_sizes.append(len(waveforms))
+        lengths = masks.sum(dim=1)
+        means = (waveforms[:, 0] * masks).sum(dim=1) / lengths.clamp(min=1)
+        return torch.stack([means, lengths], dim=1).numpy()
+
+def test_turn_embedding_extractor():
+    """Turns are cropped, batched by length and returned in the original order"""
+    print("Testing turn embedding extractor...")
+
+    from audio.roles import TurnEmbeddingExtractor
+
+    # Отсчеты секунды t равны t: среднее реплики показывает, какой кусок она получила
+    waveform = torch.repeat_interleave(torch.arange(10, dtype=torch.float32), SAMPLE_RATE).unsqueeze(0)
+    audio = {'waveform': waveform, 'sample_rate': SAMPLE_RATE, 'uri': 'book'}
+    turns = [(2.0, 3.0), (0.0, 6.0), (5.0, 5.5), (8.0, 12.0)]
+
+    model = StubEmbedding()
+    extractor = TurnEmbeddingExtractor(model, batch_size=2, max_turn_sec=4.0)
+    embeddings = extractor.extract(audio, turns)
+
+    # Реплика 0-6 обрезана до центральных 4 сек (1-5), 8-12 - до конца аудио (8-10)
+    expected = [(2.0, 1.0), (2.5, 4.0), (5.0, 0.5), (8.5, 2.0)]
+    assert np.allclose(embeddings, [(mean, sec * SAMPLE_RATE) for mean, sec in expected]), embeddings
+    assert model.batch_sizes == [2, 2], f"unexpected batches: {model.batch_sizes}"
+    assert extractor.extract(audio, []).shape == (0, 2)
+    print(f"  ✓ {len(turns)} turns in batches {model.batch_sizes}, order restored")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        test_cosine_silhouette()
+        test_role_clusterer()
+        test_turn_embedding_extractor()
+        print("✓ Role clustering tests passed")
+    except AssertionError as e:
+        print(f"✗ Test failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Test script: overlapping chunks and cross-chunk speaker stitching
+Verifies overlap splitting, label reconciliation and that no turn is duplicated
+"""
+
+import sys
+import wave
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+# Добавляем путь к скриптам, чтобы импортировать пакет audio
+scripts_path = Path(__file__).parent.parent / 'scripts'
+sys.path.append(str(scripts_path))
+
+SAMPLE_RATE = 16000
+
+def write_wav(path, samples):
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(samples.astype(np.int16).tobytes())
+
+def wav_duration(path):
+    with wave.open(str(path), 'rb') as wav_file:
+        return wav_file.getnframes() / wav_file.getframerate()
+
+def test_overlap_split():
+    """Parts must extend overlap_sec into the next part"""
+    print("Testing overlapping split...")
+
+    from audio.splitters import split_audio_by_duration_optimized
+
+    work_dir = Path(tempfile.mkdtemp(prefix="test_overlap_split_"))
+    try:
+        source = work_dir / "source.wav"
+        write_wav(source, np.arange(100 * SAMPLE_RATE) % 1000)
+
+        parts = split_audio_by_duration_optimized(
+            str(source), work_dir / "parts", max_duration_sec=30, overlap_sec=5
+        )
+        durations = [wav_duration(p) for p in parts]
+
+        assert np.allclose(durations, [35, 35, 35, 10]), f"unexpected part durations: {durations}"
+        assert np.allclose(parts.starts, [0, 30, 60, 90]), f"unexpected part starts: {parts.starts}"
+        print(f"  ✓ part durations: {durations}, starts: {parts.starts}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def test_stitch_labels_and_duplicates():
+    """Chunk-local labels map to global ones and overlap turns are kept once"""
+    print("Testing speaker stitching...")
+
+    from audio.stitching import stitch_chunk_turns
+
+    # Файл 0-70 сек, чанки [0, 40] и [30, 70], перекрытие 30-40
+    # Глобально: A говорит 0-35, B - 35-70. Во втором чанке pyannote назвал их наоборот
+    chunks = [
+        {'start_time': 0.0, 'duration': 40.0,
+         'turns': [(0.0, 35.0, 'SPEAKER_00'), (35.0, 40.0, 'SPEAKER_01')]},
+        {'start_time': 30.0, 'duration': 40.0,
+         'turns': [(0.0, 5.0, 'SPEAKER_01'), (5.0, 40.0, 'SPEAKER_00')]},
+    ]
+
+    speakers = stitch_chunk_turns(chunks, logger=logging.getLogger(__name__))
+
+    assert sorted(speakers) == ['SPEAKER_00', 'SPEAKER_01'], f"unexpected labels: {sorted(speakers)}"
+
+    first = [(p['start'], p['end']) for p in speakers['SPEAKER_00']]
+    second = [(p['start'], p['end']) for p in speakers['SPEAKER_01']]
+    assert first == [(0.0, 35.0)], f"SPEAKER_00 pieces: {first}"
+    assert second == [(35.0, 70.0)], f"SPEAKER_01 pieces: {second}"
+
+    # Суммарная длительность равна длине файла - дублей нет
+    total = sum(p['end'] - p['start'] for pieces in speakers.values() for p in pieces)
+    assert abs(total - 70.0) < 1e-6, f"total speech {total} != 70"
+    print("  ✓ labels reconciled, no duplicated speech")
+
+def test_stitch_reidentifies_by_embedding():
+    """A speaker silent in the overlap keeps its label via the centroid embedding"""
+    print("Testing re-identification by embedding...")
+
+    from audio.stitching import stitch_chunk_turns
+
+    # Чанки [0, 40], [30, 70], [60, 100]. B говорит только в первом и третьем чанке,
+    # в перекрытиях звучит лишь A - сопоставить B можно только по эмбеддингу
+    voice_a = np.array([1.0, 0.0, 0.0])
+    voice_b = np.array([0.0, 1.0, 0.0])
+    chunks = [
+        {'start_time': 0.0, 'duration': 40.0,
+         'turns': [(0.0, 10.0, 'SPEAKER_00'), (10.0, 40.0, 'SPEAKER_01')],
+         'embeddings': {'SPEAKER_00': voice_b, 'SPEAKER_01': voice_a}},
+        {'start_time': 30.0, 'duration': 40.0,
+         'turns': [(0.0, 40.0, 'SPEAKER_00')],
+         'embeddings': {'SPEAKER_00': voice_a * 2}},
+        {'start_time': 60.0, 'duration': 40.0,
+         'turns': [(0.0, 20.0, 'SPEAKER_00'), (20.0, 40.0, 'SPEAKER_01')],
+         'embeddings': {'SPEAKER_00': voice_a, 'SPEAKER_01': voice_b + 0.1}},
+    ]
+
+    speakers = stitch_chunk_turns(chunks)
+
+    assert sorted(speakers) == ['SPEAKER_00', 'SPEAKER_01'], f"unexpected labels: {sorted(speakers)}"
+    b_pieces = [(p['start'], p['end']) for p in speakers['SPEAKER_00']]
+    assert b_pieces == [(0.0, 10.0), (80.0, 100.0)], f"speaker B pieces: {b_pieces}"
+
+    # Без эмбеддингов B в третьем чанке - новый спикер
+    for chunk in chunks:
+        chunk.pop('embeddings')
+    assert len(stitch_chunk_turns(chunks)) == 3
+    print("  ✓ silent speaker matched by voice, new label without embeddings")
+
+def test_write_stitched_speakers():
+    """Speaker files are assembled from the right chunk audio"""
+    print("Testing stitched speaker writer...")
+
+    from audio.stitching import stitch_chunk_turns, write_stitched_speakers
+
+    work_dir = Path(tempfile.mkdtemp(prefix="test_stitch_writer_"))
+    try:
+        # Чанки 0-20 и 15-35: значение сэмпла = номер секунды файла
+        timeline = np.repeat(np.arange(35), SAMPLE_RATE)
+        chunk_paths = []
+        for idx, (start, end) in enumerate([(0, 20), (15, 35)]):
+            path = work_dir / f"chunk_{idx}.wav"
+            write_wav(path, timeline[start * SAMPLE_RATE:end * SAMPLE_RATE])
+            chunk_paths.append(str(path))
+
+        chunks = [
+            {'start_time': 0.0, 'duration': 20.0, 'turns': [(0.0, 20.0, 'A')]},
+            {'start_time': 15.0, 'duration': 20.0, 'turns': [(0.0, 20.0, 'A')]},
+        ]
+        speakers = stitch_chunk_turns(chunks)
+        files = write_stitched_speakers(speakers, chunks, chunk_paths, work_dir / "diarized", "book")
+
+        assert len(files) == 1, f"expected one speaker file, got {files}"
+        with wave.open(files[0], 'rb') as wav_file:
+            samples = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+
+        assert np.array_equal(samples, timeline), "stitched audio does not match the source timeline"
+        assert Path(files[0]).parent.name == "speaker_SPEAKER_00"
+        print(f"  ✓ {Path(files[0]).name}: {len(samples) / SAMPLE_RATE:.1f}s, matches source")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def test_segment_sample_bounds_and_gather():
+    """Seconds map to exact sample bounds, clipped to the buffer; gather concatenates them in order"""
+    print("Testing sample bounds and gather...")
+
+    from audio.stitching import segment_sample_bounds, gather_segments
+
+    samples = np.arange(100, dtype=np.int16)
+    bounds = segment_sample_bounds([(0.1, 0.2), (0.5, 0.5), (0.9, 1.5), (-0.1, 0.05)], 100, len(samples))
+    assert bounds.tolist() == [[10, 20], [90, 100], [0, 5]], f"unexpected bounds: {bounds.tolist()}"
+
+    # offset - время начала буфера: сегмент целиком до буфера отбрасывается
+    shifted = segment_sample_bounds([(1.0, 1.1), (2.0, 2.2)], 100, len(samples), offset=2.0)
+    assert shifted.tolist() == [[0, 20]], f"unexpected shifted bounds: {shifted.tolist()}"
+
+    gathered = gather_segments(samples, bounds)
+    expected = np.concatenate([samples[10:20], samples[90:100], samples[0:5]])
+    assert np.array_equal(gathered, expected), f"gathered: {gathered.tolist()}"
+    assert len(gather_segments(samples, segment_sample_bounds([], 100, len(samples)))) == 0
+    print("  ✓ bounds clipped and empty segments dropped, gather matches slicing")
+
+class StubAnnotation:
+    """Аннотация pyannote с itertracks(yield_label=True)"""
+
+    def __init__(self, turns):
+        self.turns = turns
+
+    def itertracks(self, yield_label=False):
+        for start, end, speaker in self.turns:
+            yield SimpleNamespace(start=start, end=end), None, speaker
+
+def test_speaker_segments_writer():
+    """Speaker files are cut from in-memory audio at its own rate or resampled on request"""
+    print("Testing speaker segments writer...")
+
+    from audio.stages import create_speaker_segments_with_metadata
+
+    work_dir = Path(tempfile.mkdtemp(prefix="test_speaker_writer_"))
+    try:
+        # Частота входа отличается от 16 кГц: значение отсчета = номер секунды
+        rate = 22050
+        samples = np.repeat(np.arange(10, dtype=np.int16) * 1000, rate)
+        audio = {'samples': samples, 'sample_rate': rate, 'uri': 'book'}
+        diarization = StubAnnotation([(0.0, 2.0, 'A'), (5.0, 6.0, 'B'), (7.0, 8.0, 'A'), (9.0, 9.1, 'B')])
+
+        files = create_speaker_segments_with_metadata(audio, diarization, work_dir / "own", min_segment_duration=0.3)
+        assert len(files) == 2, f"expected two speaker files, got {files}"
+        with wave.open(files[0], 'rb') as wav_file:
+            assert wav_file.getframerate() == rate
+            written = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+        expected = np.concatenate([samples[0:2 * rate], samples[7 * rate:8 * rate]])
+        assert np.array_equal(written, expected), "speaker A audio does not match the source"
+        metadata = (Path(files[0]).parent / "metadata_book.txt").read_text(encoding='utf-8')
+        assert "Total segments: 2" in metadata, metadata
+
+        files = create_speaker_segments_with_metadata(audio, diarization, work_dir / "16k", sample_rate=SAMPLE_RATE)
+        assert len(files) == 2, f"resampled input produced {files}"
+        assert [wav_duration(f) for f in files] == [3.0, 1.0], [wav_duration(f) for f in files]
+        print(f"  ✓ {rate} Hz input written as is and resampled to {SAMPLE_RATE} Hz")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        test_overlap_split()
+        test_stitch_labels_and_duplicates()
+        test_stitch_reidentifies_by_embedding()
+        test_write_stitched_speakers()
+        test_segment_sample_bounds_and_gather()
+        test_speaker_segments_writer()
+        print("✓ Speaker stitching tests passed")
+    except AssertionError as e:
+        print(f"✗ Test failed: {e}")
+        sys.exit(1)